@@ -1,12 +1,15 @@
 
+import collections
 import copy
 import datetime
+import functools
 import glob
 import logging
 import math 
 import operator
 import os
 import pickle
+import re
 import shutil
 import sys
 import urllib.request, urllib.parse, urllib.error
@@ -20,18 +23,21 @@ import nornir_shared.files
 import nornir_pools
 
 from . import VolumeManagerHelpers as VMH
+from . import filesystemsnapshot
+from . import volumedatacache
+from . import linkednodecache
+from . import volumedatawriter
+from . import validationcache
+from . import transformheader
 import nornir_buildmanager.operations.tile as tile
 import nornir_buildmanager.operations.versions as versions
 import nornir_shared.misc as misc
 import nornir_shared.prettyoutput as prettyoutput
-import nornir_shared.reflection as reflection
 import xml.etree.ElementTree as ElementTree 
 
 # Used for debugging with conditional break's, each node gets a temporary unique ID
 nid = 0
 
-__LoadedVolumeXMLDict__ = dict()
-
 
 def ValidateAttributesAreStrings(Element, logger=None):
 
@@ -73,8 +79,14 @@ class VolumeManager():
         VolumeManager.Load(VolumePath, Create=True)
 
     @classmethod
-    def Load(cls, VolumePath, Create=False, UseCache=True):
-        '''Load the volume information for the specified directory or create one if it doesn't exist'''
+    def Load(cls, VolumePath, Create=False, UseCache=True, MaxLoadedNodes=None):
+        '''Load the volume information for the specified directory or create one if it doesn't exist
+        :param bool UseCache: If false the root VolumeData.xml is parsed from disk even if an unchanged copy is in the VolumeData cache
+        :param int MaxLoadedNodes: Number of linked container nodes kept in memory before the least recently used are unloaded
+        '''
+        # Make sure files saved by an earlier load of the volume are on disk
+        volumedatawriter.Flush()
+
         Filename = os.path.join(VolumePath, "VolumeData.xml")
         if not os.path.exists(Filename):
             prettyoutput.Log("Provided volume description file does not exist: " + Filename)
@@ -86,6 +98,7 @@ class VolumeManager():
                 VolumeRoot.attrib['Path'] = VolumePath
                 (wrapped, VolumeRoot) = cls.WrapElement(VolumeRoot)
                 VolumeManager.__SetElementParent__(VolumeRoot)
+                VolumeRoot._SetDirty()
                 VolumeRoot.Save()
 
         SaveNewVolume = False
@@ -94,27 +107,31 @@ class VolumeManager():
                 os.makedirs(VolumePath, exist_ok=True)
 
                 VolumeRoot = ElementTree.Element('Volume', {"Name" : os.path.basename(VolumePath), "Path" : VolumePath})
-                SaveNewVolume = True                
+                SaveNewVolume = True
+                volumedatacache.Open(VolumePath)
+                validationcache.Open(VolumePath)
                 # VM =  VolumeManager(VolumeData, Filename)
                 # return VM
             else:
                 return None
         else:
             # 5/16/2012 Loading these XML files is really slow, so they are cached.
-            # if not __LoadedVolumeXMLDict__.get(Filename, None) is None and UseCache:
-            #    XMLTree = __LoadedVolumeXMLDict__[Filename]
-            # else:
-            XMLTree = ElementTree.parse(Filename)
-            # VolumeData = Volumes.CreateFromDOM(XMLTree)
-            # __LoadedVolumeXMLDict__[Filename] = XMLTree
-
-            VolumeRoot = XMLTree.getroot()
+            # The cache is checked against the size and modification time of each file
+            # so it is safe to use unless the caller explicitly asks for a fresh parse
+            cache = volumedatacache.Open(VolumePath)
+            validationcache.Open(VolumePath)
+            if UseCache:
+                VolumeRoot = cache.Parse(Filename)
+            else:
+                VolumeRoot = ElementTree.parse(Filename).getroot()
 
         VolumeRoot.attrib['Path'] = VolumePath
         VolumeRoot = XContainerElementWrapper.wrap(VolumeRoot)
         VolumeManager.__SetElementParent__(VolumeRoot)
+        VolumeRoot._LinkedNodeCache = linkednodecache.LinkedNodeCache(MaxLoadedNodes)
         
         if SaveNewVolume:
+            VolumeRoot._SetDirty()
             VolumeRoot.Save()
 
         prettyoutput.Log("Volume Root: " + VolumeRoot.attrib['Path'])
@@ -131,8 +148,7 @@ class VolumeManager():
         :return: (bool, An object inheriting from XElementWrapper) Returns true if the element had to be wrapped
         '''
         
-        OverrideClassName = e.tag + 'Node'
-        OverrideClass = reflection.get_module_class('nornir_buildmanager.VolumeManagerETree', OverrideClassName, LogErrIfNotFound=False)
+        OverrideClass = __NodeClassForTag__.get(e.tag, None)
         
         if OverrideClass is None:
             if "Path" in e.attrib:
@@ -226,10 +242,117 @@ class VolumeManager():
             cls.Save(VolumeObj.Parent)
             
             
+class _TrackedAttrib(dict):
+    '''Attribute dictionary that notifies its element when a value changes so the element knows it must be saved'''
+
+    __slots__ = ('_Owner',)
+
+    def __init__(self, Owner, *args, **kwargs):
+        super(_TrackedAttrib, self).__init__(*args, **kwargs)
+        self._Owner = Owner
+
+    def __reduce__(self):
+        # The default reduce for dict subclasses restores the items with __setitem__ before _Owner is set
+        return (_TrackedAttrib, (self._Owner, dict(self)))
+
+    def _Changed(self, key=None):
+        if self._Owner is not None:
+            self._Owner._OnAttribChanged(key)
+
+    def __setitem__(self, key, value):
+        if key in self and dict.__getitem__(self, key) == value:
+            return
+
+        super(_TrackedAttrib, self).__setitem__(key, value)
+        self._Changed(key)
+
+    def __delitem__(self, key):
+        super(_TrackedAttrib, self).__delitem__(key)
+        self._Changed(key)
+
+    def pop(self, key, *args):
+        Found = key in self
+        value = super(_TrackedAttrib, self).pop(key, *args)
+        if Found:
+            self._Changed(key)
+        return value
+
+    def popitem(self):
+        item = super(_TrackedAttrib, self).popitem()
+        self._Changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return dict.__getitem__(self, key)
+
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        super(_TrackedAttrib, self).update(*args, **kwargs)
+        self._Changed()
+
+    def clear(self):
+        if len(self) > 0:
+            super(_TrackedAttrib, self).clear()
+            self._Changed()
+
+
+# Child attributes indexed for GetChildByAttrib and related lookups
+_IndexedAttributes = frozenset(['Number', 'Name', 'Downsample', 'Path', 'MappedSectionNumber'])
+
+# Element names that can be looked up in the child index, anything else is passed to ElementTree
+_SimpleTagRegEx = re.compile(r'^[A-Za-z_][\w\-]*$')
+
+# Matches a first XPath step of the form Tag[@Attrib='value'] that can be answered from the child index
+_IndexedStepRegEx = re.compile(r'^([A-Za-z_][\w\-]*)\[@([A-Za-z_]\w*)=([\'"])([^\'"]*)\3\]$')
+
+# Number of parsed XPath queries kept by _CompileXPath
+XPathPlanCacheSize = 1024
+
+# The parts of an XPath query XElementWrapper.find and findall need.
+# IndexKey is (Tag, AttribName, AttribValue) if the first step can use the child index, otherwise None.
+XPathPlan = collections.namedtuple('XPathPlan', ['UnlinkedElementsXPath', 'LinkedElementsXPath', 'RemainingXPath', 'IndexKey'])
+
+
+@functools.lru_cache(maxsize=XPathPlanCacheSize)
+def _CompileXPath(xpath):
+    '''Split an XPath query into the first step, the same step for link elements, and the remainder of the query'''
+
+    if '\\' in xpath:
+        Logger = logging.getLogger(__name__ + '.' + '_CompileXPath')
+        Logger.warning("Backslash found in xpath query, is this intentional or should it be a forward slash?")
+        Logger.warning("XPath: " + xpath)
+
+    parts = xpath.split('/')
+    UnlinkedElementsXPath = parts[0]
+    SubContainerName = UnlinkedElementsXPath.split('[')[0]
+    LinkedSubContainerName = SubContainerName + "_Link"
+    LinkedElementsXPath = UnlinkedElementsXPath.replace(SubContainerName, LinkedSubContainerName, 1)
+    RemainingXPath = xpath[len(UnlinkedElementsXPath) + 1:]
+
+    IndexKey = None
+    match = _IndexedStepRegEx.match(UnlinkedElementsXPath)
+    if match is not None and match.group(2) in _IndexedAttributes:
+        IndexKey = (match.group(1), match.group(2), match.group(4))
+
+    return XPathPlan(UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath, IndexKey)
+
+
+# How XElementWrapper.__setattr__ handles a name
+_SetAttrInstance = 0  # Not defined by the class, stored in __dict__ or the XML attributes
+_SetAttrProperty = 1  # Property defined by the class
+_SetAttrClass = 2  # Other class attribute, such as the text and tail of ElementTree.Element
+
+
 class XElementWrapper(ElementTree.Element):
 
     logger = logging.getLogger(__name__ + '.' + 'XElementWrapper')
 
+    # Class -> {name : (kind, property setter)}, populated by __setattr__
+    _SetAttrPlans = {}
+
     def sort(self):
         '''Order child elements'''
         
@@ -254,7 +377,8 @@ class XElementWrapper(ElementTree.Element):
         sorted_linked   = sorted(linked,   key=lambda child: child.attrib['Path'])
         sorted_other    = sorted(other,    key=lambda child: str(child))
         
-        self[:] = sorted_withKeys + sorted_linked + sorted_other + sorted_withoutKeys
+        # Reordering does not change which children we have, so bypass our __setitem__ and keep the child index
+        super(XElementWrapper, self).__setitem__(slice(None), sorted_withKeys + sorted_linked + sorted_other + sorted_withoutKeys)
         
         # self._children.sort(key=operator.attrgetter('SortKey'))
 
@@ -370,7 +494,10 @@ class XElementWrapper(ElementTree.Element):
 
         super(XElementWrapper, self).__init__(tag, attrib=attrib, **extra)
 
-        self._Parent = None
+        # Replace the attribute dictionary with one that tracks changes
+        self.attrib = self.attrib
+
+        self.__dict__['_Parent'] = None
 
         if not self.tag.endswith("_Link"):
             self.attrib['CreationDate'] = XElementWrapper.__GetCreationTimeString__()
@@ -496,6 +623,9 @@ class XElementWrapper(ElementTree.Element):
                 prettyoutput.Log(newElement.ToElementString() + " no path attribute but being set as container")
             assert('Path' in newElement.attrib)
 
+            # The wrapped element has the same content as the element it replaces, it does not need to be saved
+            newElement.__dict__['_Dirty'] = False
+
         return newElement
     
     def ToElementString(self):
@@ -520,36 +650,60 @@ class XElementWrapper(ElementTree.Element):
         object). See the __getattribute__() method below for a way to actually get total control in
          new-style classes.'''
         
+        # Instance and class attributes were already checked by the normal lookup.  None of our
+        # base classes implement __getattr__, so the only remaining place to look is the XML attributes
+        try:
+            return self.attrib[name]
+        except KeyError:
+            raise AttributeError(name)
 
-        if name in self.__dict__:
-            return self.__dict__[name]
+    @classmethod
+    def _BuildSetAttrPlan(cls, name):
+        '''Decide how __setattr__ assigns a name on instances of this class
+        :return: (kind, property setter) where kind is one of the _SetAttr constants
+        '''
+        if not hasattr(cls, name):
+            return (_SetAttrInstance, None)
 
-        superClass = super(XElementWrapper, self)
-        if not superClass is None:
-            try:
-                if hasattr(superClass, '__getattr__'):
-                    return superClass.__getattr__(name)
-            except AttributeError:
-                pass
-            
-        if(name in self.attrib):
-            return self.attrib[name]
+        attribute = getattr(cls, name)
+        if isinstance(attribute, property):
+            return (_SetAttrProperty, attribute.fset)
 
-        raise AttributeError(name)
+        return (_SetAttrClass, None)
 
     def __setattr__(self, name, value):
 
         '''Called when an attribute assignment is attempted. This is called instead of the normal mechanism (i.e. store the value in the instance dictionary). name is the attribute name, value is the value to be assigned to it.'''
-        if(hasattr(self.__class__, name)):
-            attribute = getattr(self.__class__, name)
-            if isinstance(attribute, property):
-                if not attribute.fset is None:
-                    attribute.fset(self, value)
+        
+        # Looking the name up on the class is expensive and the answer never changes, so it is cached per class
+        plans = XElementWrapper._SetAttrPlans.get(self.__class__, None)
+        if plans is None:
+            plans = {}
+            XElementWrapper._SetAttrPlans[self.__class__] = plans
+
+        plan = plans.get(name, None)
+        if plan is None:
+            plan = self.__class__._BuildSetAttrPlan(name)
+            plans[name] = plan
+
+        (kind, fset) = plan
+        if kind != _SetAttrInstance:
+            if kind == _SetAttrProperty:
+                if not fset is None:
+                    fset(self, value)
                     return
                 else:
-                    assert (not attribute.fset is None)  # Why are we trying to set a property without a setter?
+                    assert (not fset is None)  # Why are we trying to set a property without a setter?
             else:
+                if name == 'attrib':
+                    value = _TrackedAttrib(self, value)
+
                 super(XElementWrapper, self).__setattr__(name, value)
+
+                if name == 'attrib':
+                    self._OnAttribChanged()
+                elif name == 'text' or name == 'tail':
+                    self._MarkDirty()
                 return
 
         if(name in self.__dict__):
@@ -614,6 +768,9 @@ class XElementWrapper(ElementTree.Element):
                         self.remove(Child)
 
     def GetChildrenByAttrib(self, ElementName, AttribName, AttribValue):
+        if XElementWrapper._CanUseChildIndex(ElementName, AttribName):
+            return list(self._IterIndexedChildren(ElementName, AttribName, XElementWrapper._AttribValueString(AttribValue)))
+
         XPathStr = "%(ElementName)s[@%(AttribName)s='%(AttribValue)s']" % {'ElementName' : ElementName, 'AttribName' : AttribName, 'AttribValue' : AttribValue}
         Children = self.findall(XPathStr)
 
@@ -624,6 +781,12 @@ class XElementWrapper(ElementTree.Element):
 
     def GetChildByAttrib(self, ElementName, AttribName, AttribValue):
 
+        if XElementWrapper._CanUseChildIndex(ElementName, AttribName):
+            for Child in self._IterIndexedChildren(ElementName, AttribName, XElementWrapper._AttribValueString(AttribValue)):
+                return Child
+
+            return None
+
         XPathStr = ""
         if isinstance(AttribValue, float):
             XPathStr = "%(ElementName)s[@%(AttribName)s='%(AttribValue)g']" % {'ElementName' : ElementName, 'AttribName' : AttribName, 'AttribValue' : AttribValue}
@@ -662,6 +825,10 @@ class XElementWrapper(ElementTree.Element):
         elif not isinstance(AttribNames, list):
             raise Exception("Unexpected attribute names for UpdateOrAddChildByAttrib")
 
+        if len(AttribNames) == 1 and XElementWrapper._CanUseChildIndex(Element.tag, AttribNames[0]):
+            Child = self.GetChildByAttrib(Element.tag, AttribNames[0], Element.attrib[AttribNames[0]])
+            return self._AddChildIfNotFound(Element, Child)
+
         attribXPathTemplate = "@%(AttribName)s='%(AttribValue)s'"
         attribXPaths = []
         
@@ -684,8 +851,6 @@ class XElementWrapper(ElementTree.Element):
         if(XPath is None):
             XPath = Element.tag
 
-        NewNodeCreated = False
-
         '''Eliminates duplicates if they are found'''
 #        if self.Contains(Element):
 #            return
@@ -696,6 +861,11 @@ class XElementWrapper(ElementTree.Element):
 
         '''Returns the existing element if it exists, adds ChildElement with specified attributes if it does not exist.'''
         Child = self.find(XPath)
+        return self._AddChildIfNotFound(Element, Child)
+
+    def _AddChildIfNotFound(self, Element, Child):
+        '''Second half of UpdateOrAddChild.  Appends Element if the search for an existing child returned None'''
+        NewNodeCreated = False
         if Child is None:
             if not Element is None:
                 self.append(Element)
@@ -724,6 +894,188 @@ class XElementWrapper(ElementTree.Element):
         super(XElementWrapper, self).append(Child)
         Child.Parent = self
         assert(Child in self)
+        self._OnChildAdded(Child)
+
+    def insert(self, index, Child):
+        super(XElementWrapper, self).insert(index, Child)
+        self._OnChildAdded(Child)
+
+    def extend(self, Children):
+        Children = list(Children)
+        super(XElementWrapper, self).extend(Children)
+        for Child in Children:
+            self._OnChildAdded(Child)
+
+    def remove(self, Child):
+        super(XElementWrapper, self).remove(Child)
+        self._IndexRemoveChild(Child)
+        self._MarkDirty()
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            super(XElementWrapper, self).__delitem__(index)
+            self._InvalidateChildIndex()
+        else:
+            Child = self[index]
+            super(XElementWrapper, self).__delitem__(index)
+            self._IndexRemoveChild(Child)
+
+        self._MarkDirty()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            super(XElementWrapper, self).__setitem__(index, value)
+            self._InvalidateChildIndex()
+        else:
+            OldChild = self[index]
+            super(XElementWrapper, self).__setitem__(index, value)
+            self._IndexRemoveChild(OldChild)
+            self._IndexAddChild(value)
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+    def clear(self):
+        super(XElementWrapper, self).clear()
+        self.attrib = self.attrib
+        self._InvalidateChildIndex()
+        self._MarkDirty()
+
+    def _OnChildAdded(self, Child):
+        self._IndexAddChild(Child)
+        self._MarkDirty()
+
+        # A changed container added to the tree must be found by the next Save of our ancestors
+        if isinstance(Child, XContainerElementWrapper) and (Child.IsDirty or Child.__dict__.get('_DirtyDescendants', False)):
+            Child._MarkAncestorsHaveDirtyDescendants()
+
+    def _OnAttribChanged(self, key=None):
+        self._MarkDirty()
+        self._OnIndexedAttribChanged(key)
+
+    def _OnIndexedAttribChanged(self, key):
+        '''Our parent's child index is out of date if one of the indexed attributes changed'''
+        if key is None or key in _IndexedAttributes:
+            Parent = self.__dict__.get('_Parent', None)
+            if Parent is not None:
+                Parent._InvalidateChildIndex()
+
+    @staticmethod
+    def _ChildIndexKeys(Child):
+        '''Index keys for a child.  Links are indexed under the tag of the element they link to'''
+        tag = Child.tag
+        if tag.endswith('_Link'):
+            tag = tag[:-len('_Link')]
+
+        attrib = Child.attrib
+        return [(tag, AttribName, attrib[AttribName]) for AttribName in _IndexedAttributes if AttribName in attrib]
+
+    def _GetChildIndex(self):
+        '''
+        Children keyed by (tag, attribute name, attribute value) for the attributes in _IndexedAttributes.
+        Built on first use and kept up to date as children are added, removed or change attributes.
+        '''
+        index = self.__dict__.get('_ChildIndex', None)
+        if index is None:
+            index = {}
+            for Child in self:
+                for key in XElementWrapper._ChildIndexKeys(Child):
+                    entries = index.get(key, None)
+                    if entries is None:
+                        index[key] = [Child]
+                    else:
+                        entries.append(Child)
+
+            self.__dict__['_ChildIndex'] = index
+
+        return index
+
+    def _InvalidateChildIndex(self):
+        self.__dict__.pop('_ChildIndex', None)
+
+    def _IndexAddChild(self, Child):
+        index = self.__dict__.get('_ChildIndex', None)
+        if index is None:
+            return
+
+        for key in XElementWrapper._ChildIndexKeys(Child):
+            entries = index.get(key, None)
+            if entries is None:
+                index[key] = [Child]
+            else:
+                entries.append(Child)
+
+    def _IndexRemoveChild(self, Child):
+        index = self.__dict__.get('_ChildIndex', None)
+        if index is None:
+            return
+
+        for key in XElementWrapper._ChildIndexKeys(Child):
+            entries = index.get(key, None)
+            iEntry = None
+            if entries is not None:
+                iEntry = next((i for (i, e) in enumerate(entries) if e is Child), None)
+
+            if iEntry is None:
+                # The index does not match the child, start over on the next lookup
+                self._InvalidateChildIndex()
+                return
+
+            del entries[iEntry]
+            if len(entries) == 0:
+                del index[key]
+
+    def _IndexedChildren(self, ElementName, AttribName, AttribValue):
+        '''Children, including unloaded links, with the tag and attribute value in document order'''
+        entries = self._GetChildIndex().get((ElementName, AttribName, AttribValue), None)
+        if entries is None:
+            return []
+
+        if len(entries) == 1:
+            return list(entries)
+
+        positions = {id(c) : i for (i, c) in enumerate(self)}
+        return sorted(entries, key=lambda c: positions.get(id(c), -1))
+
+    @staticmethod
+    def _CanUseChildIndex(ElementName, AttribName):
+        return AttribName in _IndexedAttributes and _SimpleTagRegEx.match(ElementName) is not None
+
+    @staticmethod
+    def _AttribValueString(AttribValue):
+        '''Format an attribute value the same way GetChildByAttrib formats it for an XPath query'''
+        if isinstance(AttribValue, float):
+            return '%g' % AttribValue
+
+        return '%s' % AttribValue
+
+    def _IterIndexedChildren(self, ElementName, AttribName, AttribValue):
+        '''Yield the wrapped children with the tag and attribute value.  Matching links are loaded.'''
+        cache = self._GetLinkedNodeCache()
+        if cache is not None:
+            cache.Touch(self)
+
+        Candidates = self._IndexedChildren(ElementName, AttribName, AttribValue)
+        Links = [c for c in Candidates if c.tag.endswith('_Link')]
+        if len(Links) > 0:
+            self._replace_links(Links)
+            Candidates = self._IndexedChildren(ElementName, AttribName, AttribValue)
+
+        for c in Candidates:
+            if c.tag.endswith('_Link'):
+                # Link could not be loaded
+                continue
+
+            yield self._ReplaceChildIfUnwrapped(c)
+
+    def _MarkDirty(self):
+        '''Record that the VolumeData.xml file containing this element must be written by the next Save'''
+        node = self
+        while node is not None and not isinstance(node, XContainerElementWrapper):
+            node = node.__dict__.get('_Parent', None)
+
+        if node is not None:
+            node._SetDirty()
 
     def FindParent(self, ParentTag):
         '''Find parent with specified tag'''
@@ -767,6 +1119,44 @@ class XElementWrapper(ElementTree.Element):
             # SaveElement.append(LinkElement)
             self._ReplaceChildElementInPlace(child, LinkElement)
             
+    def ReplaceChildWithUpdatedLink(self, child, attrib):
+        '''
+        Replace a loaded container, or the link to it, with a link so it is loaded
+        from disk the next time it is searched.  Used when another process has
+        rewritten the container's VolumeData.xml.  Unlike ReplaceChildWithLink
+        the in-memory container is not saved.
+        :param dict attrib: Attributes of the container as written by the other process
+        '''
+        if not any(c is child for c in self):
+            return
+
+        LinkTag = child.tag if child.tag.endswith('_Link') else child.tag + '_Link'
+        LinkElement = XElementWrapper(LinkTag, attrib=dict(attrib))
+        self._ReplaceChildElementInPlace(child, LinkElement)
+
+        cache = self._GetLinkedNodeCache()
+        if cache is not None:
+            cache.Remove(child)
+
+        # Our VolumeData.xml stores a copy of the link attributes
+        self._MarkDirty()
+
+    def UpdateLinkedChild(self, xpath, attrib):
+        '''
+        Call ReplaceChildWithUpdatedLink for the container or link matching a simple xpath such as
+        Section[@Path='0001'] without loading the link.
+        :return: True if a child matched the xpath
+        '''
+        plan = _CompileXPath(xpath)
+        child = super(XElementWrapper, self).find(plan.UnlinkedElementsXPath)
+        if child is None:
+            child = super(XElementWrapper, self).find(plan.LinkedElementsXPath)
+            if child is None:
+                return False
+
+        self.ReplaceChildWithUpdatedLink(child, attrib)
+        return True
+
     def _ReplaceChildIfUnwrapped(self, child):
         if isinstance(child, XElementWrapper):
             return child
@@ -780,106 +1170,175 @@ class XElementWrapper(ElementTree.Element):
             
         return wrappedElement
 
-    # replacement for find function that loads subdirectory xml files
-    def find(self, xpath):
+    # Number of links loaded together when a search reaches a link node
+    LinkReadAhead = 8
 
-        (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath) = self.__ElementLinkNameFromXPath(xpath)
-        
+    def _GetLinkedNodeCache(self):
+        '''The LinkedNodeCache of the volume this element belongs to, or None'''
+        node = self
+        while True:
+            Parent = node.__dict__.get('_Parent', None)
+            if Parent is None:
+                break
+            node = Parent
+
+        return node.__dict__.get('_LinkedNodeCache', None)
+
+    def _CurrentChild(self, child, hint=None):
+        '''
+        Return the child, or the node that replaced it if it was swapped between
+        a link and a loaded container since it was found.
+        :return: The current child or None if it is no longer a child of this element
+        '''
+        if hint is not None and hint < len(self) and self[hint] is child:
+            return child
+
+        for c in self:
+            if c is child:
+                return child
+
+        Path = child.attrib.get('Path', None)
+        if Path is None:
+            return None
+
+        BaseTag = child.tag[:-len('_Link')] if child.tag.endswith('_Link') else child.tag
+        for c in self:
+            if c.attrib.get('Path', None) == Path and (c.tag == BaseTag or c.tag == BaseTag + '_Link'):
+                return c
+
+        return None
+
+    def _MatchingChildren(self, UnlinkedElementsXPath, LinkedElementsXPath):
+        '''
+        :return: List of (index, child) for children matching either the xpath or, for containers, the
+                 equivalent xpath for link nodes.  Links are not loaded.
+        '''
+        matches = super(XElementWrapper, self).findall(UnlinkedElementsXPath)
+
+        LinkMatches = []
         if isinstance(self, XContainerElementWrapper):  # Only containers have linked elements
             LinkMatches = super(XElementWrapper, self).findall(LinkedElementsXPath)
-            if LinkMatches is None:
-                return None
+
+        if len(matches) == 0 and len(LinkMatches) == 0:
+            return []
+
+        # Record positions so we can quickly check the child was not replaced later
+        positions = {id(c): i for (i, c) in enumerate(self)}
+
+        if len(LinkMatches) == 0:
+            return [(positions.get(id(m), None), m) for m in matches]
+
+        # Merge links and loaded elements in document order
+        ids = set([id(m) for m in matches])
+        ids.update([id(m) for m in LinkMatches])
+        Candidates = [(i, c) for (i, c) in enumerate(self) if id(c) in ids]
+        Candidates.extend([(None, m) for m in matches if id(m) not in positions])
+        return Candidates
+
+    def _LoadLinksAhead(self, Candidates, iStart):
+        '''Load the link for the candidate at iStart along with the next few candidates that are also links'''
+        link_nodes = []
+        for (i, c) in Candidates[iStart:]:
+            if len(link_nodes) >= XElementWrapper.LinkReadAhead:
+                break
+
+            if i is None or not (c.tag.endswith('_Link') or isinstance(c, XContainerElementWrapper)):
+                continue
+
+            current = self._CurrentChild(c, i)
+            if current is not None and current.tag.endswith('_Link') and not any(current is l for l in link_nodes):
+                link_nodes.append(current)
+
+        if len(link_nodes) > 0:
+            self._replace_links(link_nodes)
+
+    def _IterMatchingChildren(self, UnlinkedElementsXPath, LinkedElementsXPath, IndexKey=None):
+        '''
+        Yield the wrapped children matching the xpath.  Links are loaded as the
+        iteration reaches them instead of all at once.
+        :param tuple IndexKey: (Tag, AttribName, AttribValue) if the xpath can be answered from the child index
+        '''
+        if IndexKey is not None:
+            for c in self._IterIndexedChildren(*IndexKey):
+                yield c
+            return
+
+        Candidates = self._MatchingChildren(UnlinkedElementsXPath, LinkedElementsXPath)
+
+        for (iCandidate, (i, c)) in enumerate(Candidates):
+            if i is None:
+                # Matched an element that is not one of our children, such as '.'
+                if isinstance(c, XElementWrapper):
+                    yield c
+                continue
+
+            if c.tag.endswith('_Link') or isinstance(c, XContainerElementWrapper):
+                # Containers may have been loaded or unloaded since the search began
+                current = self._CurrentChild(c, i)
+                if current is not None and current.tag.endswith('_Link'):
+                    self._LoadLinksAhead(Candidates, iCandidate)
+                    current = self._CurrentChild(c, i)
+
+                if current is None or current.tag.endswith('_Link'):
+                    # Link could not be loaded or the loaded element was invalid
+                    continue
+
+                c = current
             
-            num_matches = len(LinkMatches)
-            if num_matches > 0:
-                # if num_matches > 1:
-                #    prettyoutput.Log("Need to load {0} links".format(num_matches))
-                self._replace_links(LinkMatches)
+            if not isinstance(c, XElementWrapper):
+                if self._CurrentChild(c, i) is not c:
+                    continue
+
+                c = self._ReplaceChildIfUnwrapped(c)
+
+            yield c
+
+    # replacement for find function that loads subdirectory xml files
+    def find(self, xpath):
 
-        matchiterator = super(XElementWrapper, self).iterfind(UnlinkedElementsXPath)
-        for match in matchiterator:
+        (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath, IndexKey) = _CompileXPath(xpath)
+
+        cache = self._GetLinkedNodeCache()
+        if cache is not None:
+            cache.Touch(self)
+
+        for match in self._IterMatchingChildren(UnlinkedElementsXPath, LinkedElementsXPath, IndexKey):
             # Run in a loop because find returns the first match, if the first match is invalid look for another
-#             NotValid = match.CleanIfInvalid()
-#             if NotValid:
-#                 continue
-            
-            match = self._ReplaceChildIfUnwrapped(match)
-#
             if len(RemainingXPath) > 0:
                 foundChild = match.find(RemainingXPath)
- 
+
                 # Continue searching links if we don't find a result on the loaded elements
                 if not foundChild is None:
                     assert(isinstance(foundChild, XElementWrapper))
                     return foundChild
             else:
                 return match
- 
+
         return None
 
     def findall(self, match):
 
-        (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath) = self.__ElementLinkNameFromXPath(match)
+        (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath, IndexKey) = _CompileXPath(match)
 
-        # TODO: Need to modify to only search one level at a time
-        # OK, check for linked elements that also meet the criteria
+        cache = self._GetLinkedNodeCache()
+        if cache is not None:
+            cache.Touch(self)
 
-        LinkMatches = list(super(XElementWrapper, self).findall(LinkedElementsXPath))
-        if LinkMatches is None:
-            return  # matches
-        
-        num_matches = len(LinkMatches)
-        if num_matches > 0:
-            # if num_matches > 1:
-            #    prettyoutput.Log("Need to load {0} links".format(num_matches))
-            self._replace_links(LinkMatches)
-            
-        # return matches
-        matches = super(XElementWrapper, self).findall(UnlinkedElementsXPath)
+        for m in self._IterMatchingChildren(UnlinkedElementsXPath, LinkedElementsXPath, IndexKey):
+            # Pin the match so it is not unloaded while the caller is using it
+            if cache is not None:
+                cache.Pin(m)
 
-        for m in matches:
-#             NotValid = m.CleanIfInvalid()
-#             if NotValid:
-#                 continue
-            if '_Link' in m.tag:
-                # TODO: Can this code path ever execute?  Seems like we pre-load the links above
-                m_replaced = self._replace_link(m)
-                if m_replaced is None:
-                    continue
-                else: 
-                    m = m_replaced
-            else:
-                m = self._ReplaceChildIfUnwrapped(m)
-                
-            if len(RemainingXPath) > 0:
-                subContainerMatches = list(m.findall(RemainingXPath))
-                if subContainerMatches is not None:
-                    for sm in subContainerMatches:
-                        assert(isinstance(sm, XElementWrapper))  # T
-                        # if not isinstance(sm, XElementWrapper):
-                            # m.remove(sm)
-                            # sm = VolumeManager.WrapElement(sm)
-                            # m.insert(sm)
-                            
+            try:
+                if len(RemainingXPath) > 0:
+                    for sm in m.findall(RemainingXPath):
+                        assert(isinstance(sm, XElementWrapper))
                         (yield sm)
-            else: 
-                (yield m)
-                
-    def __ElementLinkNameFromXPath(self, xpath):
-        # OK, check if we have a linked element to load.
-
-        if '\\' in xpath:
-            Logger = logging.getLogger(__name__ + '.' + '__ElementLinkNameFromXPath')
-            Logger.warn("Backslash found in xpath query, is this intentional or should it be a forward slash?")
-            Logger.warn("XPath: " + xpath)
-
-        parts = xpath.split('/')
-        UnlinkedElementsXPath = parts[0]
-        SubContainerName = UnlinkedElementsXPath.split('[')[0]
-        LinkedSubContainerName = SubContainerName + "_Link"
-        LinkedElementsXPath = UnlinkedElementsXPath.replace(SubContainerName, LinkedSubContainerName, 1)
-        RemainingXPath = xpath[len(UnlinkedElementsXPath) + 1:]
-        return (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath)
+                else:
+                    (yield m)
+            finally:
+                if cache is not None:
+                    cache.Unpin(m)
 
     def LoadAllLinkedNodes(self):
         '''Recursively load all of the linked nodes on this element'''
@@ -1027,7 +1486,7 @@ class XFileElementWrapper(XResourceElementWrapper):
         return
 
     def IsValid(self):
-        if not os.path.exists(self.FullPath):
+        if not filesystemsnapshot.Exists(self.FullPath):
             return [False, 'File does not exist']
 
         return super(XFileElementWrapper, self).IsValid()
@@ -1092,10 +1551,11 @@ class XContainerElementWrapper(XResourceElementWrapper):
 
     def IsValid(self):
         ResourcePath = self.FullPath
-        if not os.path.isdir(ResourcePath):
+        snapshot = filesystemsnapshot.GetSnapshot(ResourcePath)
+        if snapshot is None:
             return [False, 'Directory does not exist']
         elif not self.Parent is None:
-            if len(os.listdir(ResourcePath)) == 0:
+            if len(snapshot.Entries) == 0:
                 return [False, 'Directory is empty']
 
         return super(XContainerElementWrapper, self).IsValid()
@@ -1133,9 +1593,7 @@ class XContainerElementWrapper(XResourceElementWrapper):
         '''Loads an XML file from the file system and returns the root element'''
         Filename = os.path.join(fullpath, "VolumeData.xml")
          
-        XMLTree = ElementTree.parse(Filename)
-        
-        return XMLTree.getroot()
+        return volumedatawriter.Parse(Filename)
 
     def _load_and_wrap_link_element(self, fullpath):
         '''Loads an xml file containing a subset of our meta-data referred to by a LINK element.  Wraps the loaded XML in the correct meta-data class'''
@@ -1181,6 +1639,10 @@ class XContainerElementWrapper(XResourceElementWrapper):
         if Cleaned:
             return None
         
+        cache = self._GetLinkedNodeCache()
+        if cache is not None:
+            cache.Add(loaded_element)
+        
         return loaded_element
     
     def _replace_links(self, link_nodes, fullpath=None):
@@ -1241,6 +1703,11 @@ class XContainerElementWrapper(XResourceElementWrapper):
             if not Cleaned:
                 loaded_elements.append(wrapped_loaded_element)
                 
+        cache = self._GetLinkedNodeCache()
+        if cache is not None:
+            for loaded_element in loaded_elements:
+                cache.Add(loaded_element)
+                
         return loaded_elements
 
     def __init__(self, tag, attrib=None, **extra):
@@ -1250,13 +1717,41 @@ class XContainerElementWrapper(XResourceElementWrapper):
 
         super(XContainerElementWrapper, self).__init__(tag=tag, attrib=attrib, **extra)
 
+        # New containers have not been written to disk
+        self.__dict__['_Dirty'] = True
+
         # if Path is None:
         assert('Path' in self.attrib)
         # else:     
         # self.attrib['Path'] = Path
 
+    @property
+    def IsDirty(self):
+        '''True if our VolumeData.xml file does not match the element in memory'''
+        return self.__dict__.get('_Dirty', True)
+
+    def _SetDirty(self):
+        self.__dict__['_Dirty'] = True
+        self._MarkAncestorsHaveDirtyDescendants()
+
+    def _MarkAncestorsHaveDirtyDescendants(self):
+        P = self.__dict__.get('_Parent', None)
+        while P is not None and not P.__dict__.get('_DirtyDescendants', False):
+            P.__dict__['_DirtyDescendants'] = True
+            P = P.__dict__.get('_Parent', None)
+
+    def _OnAttribChanged(self, key=None):
+        self._MarkDirty()
+        self._OnIndexedAttribChanged(key)
+
+        # Our parent's VolumeData.xml stores a copy of our attributes in the link element
+        Parent = self.__dict__.get('_Parent', None)
+        if Parent is not None:
+            Parent._MarkDirty()
+
     def Save(self, tabLevel=None, recurse=True):
-        '''If recurse = False we only save this element, no child elements are saved'''
+        '''If recurse = False we only save this element, no child elements are saved.
+           Containers that have not changed since they were loaded or saved are not written.'''
         
         if tabLevel is None:
             tabLevel = 0
@@ -1264,6 +1759,16 @@ class XContainerElementWrapper(XResourceElementWrapper):
                 logger = logging.getLogger(__name__ + '.' + 'Save')
                 logger.info("Saving " + self.FullPath)
 
+        if not self.IsDirty:
+            if recurse and self.__dict__.get('_DirtyDescendants', False):
+                for child in list(self):
+                    if isinstance(child, XContainerElementWrapper):
+                        child.Save(tabLevel + 1)
+
+                self.__dict__['_DirtyDescendants'] = False
+
+            return
+
         self.sort()
 
         # pool = Pools.GetGlobalThreadPool()
@@ -1321,6 +1826,9 @@ class XContainerElementWrapper(XResourceElementWrapper):
                 SaveElement.append(child)
 
         self.__SaveXML(xmlfilename, SaveElement)
+        self.__dict__['_Dirty'] = False
+        if recurse:
+            self.__dict__['_DirtyDescendants'] = False
 #        pool.add_task("Saving self.FullPath",   self.__SaveXML, xmlfilename, SaveElement)
 
         # If we are the root of all saves then make sure they have all completed before returning
@@ -1341,11 +1849,10 @@ class XContainerElementWrapper(XResourceElementWrapper):
 
         prettyoutput.Log("Saving %s" % XMLFilename)
         
+        # Serialize now, the elements may change before the background writer runs
         OutputXML = ElementTree.tostring(SaveElement, encoding="utf-8")
         # print OutputXML
-        with open(XMLFilename, 'wb') as hFile:
-            hFile.write(OutputXML)
-            hFile.close()
+        volumedatawriter.Write(XMLFilename, OutputXML)
 
 
 class XNamedContainerElementWrapped(XContainerElementWrapper):
@@ -2542,14 +3049,15 @@ class MosaicBaseNode(XFileElementWrapper):
         if not os.path.exists(self.FullPath):
             return None
 
-        if ext == '.stos':
-            return stosfile.StosFile.LoadChecksum(self.FullPath)
-        elif ext == '.mosaic':
-            return mosaicfile.MosaicFile.LoadChecksum(self.FullPath)
-        else:
+        if ext != '.stos' and ext != '.mosaic':
             raise Exception("Cannot compute checksum for unknown transform type")
 
-        return None
+        # Parsing the transform is slow, reuse the checksum if the file has not changed
+        checksum = validationcache.Get(self.FullPath, 'Checksum')
+        if checksum is None:
+            checksum = transformheader.Read(self.FullPath).Checksum
+
+        return checksum
 
     def ResetChecksum(self):
         '''Recalculate the checksum for the element'''
@@ -2937,9 +3445,7 @@ class ImageSetNode(ImageSetBaseNode):
         :return: (Bool, String) containing whether all tiles exist and a reason string
         '''
     
-        globfullpath = os.path.join(level_full_path, '*' + self.ImageFormatExt)
-
-        files = glob.glob(globfullpath)
+        files = filesystemsnapshot.Glob(level_full_path, '*' + self.ImageFormatExt)
 
         if(len(files) == 0):
             return [False, "No files in level"]
@@ -2982,7 +3488,7 @@ class ImageNode(VMH.InputTransformHandler, XFileElementWrapper):
         return ImageNode(tag='Image', Path=Path, attrib=attrib, **extra)
   
     def IsValid(self):
-        if not os.path.exists(self.FullPath):
+        if not filesystemsnapshot.Exists(self.FullPath):
             return [False, 'File does not exist']
 
         if(self.Checksum != nornir_shared.checksum.FilesizeChecksum(self.FullPath)):
@@ -3006,18 +3512,28 @@ class ImageNode(VMH.InputTransformHandler, XFileElementWrapper):
         '''
         dims = self.attrib.get('Dimensions', None)
         if dims is None:
-            dims = nornir_imageregistration.GetImageSize(self.FullPath)
+            dims = self._ReadDimensions()
             self.attrib['Dimensions'] = "{0:d} {1:d}".format(dims[1], dims[0])
         else:
             dims = dims.split(' ')
             dims = (int(dims[1]), int(dims[0]))
             
             # Todo: Remove after initial testing 
-            actual_dims = nornir_imageregistration.GetImageSize(self.FullPath)
+            actual_dims = self._ReadDimensions()
             assert(actual_dims[0] == dims[0])
             assert(actual_dims[1] == dims[1])
             
         return dims
+
+    def _ReadDimensions(self):
+        ''':return: (height, width) from the image header, or from the validation cache if the file has not changed'''
+        dims = validationcache.Get(self.FullPath, 'Dimensions')
+        if dims is None:
+            dims = nornir_imageregistration.GetImageSize(self.FullPath)
+            dims = (int(dims[0]), int(dims[1]))
+            validationcache.Set(self.FullPath, 'Dimensions', dims)
+
+        return dims
     
     @Dimensions.setter
     def Dimensions(self, dims):
@@ -3254,9 +3770,7 @@ class TilePyramidNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
         :return: (Bool, String) containing whether all tiles exist and a reason string
         '''
     
-        globfullpath = os.path.join(level_full_path, '*' + self.ImageFormatExt)
-
-        files = glob.glob(globfullpath)
+        files = filesystemsnapshot.Glob(level_full_path, '*' + self.ImageFormatExt)
 
         if(len(files) == 0):
             return [False, "No files in level"]
@@ -3401,7 +3915,7 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
                                                                                     'X' : GridXString,
                                                                                     'Y' : nornir_buildmanager.templates.Current.GridTileCoordTemplate % iY,
                                                                                     'postfix' : FilePostfix})
-            if(os.path.exists(MatchString)):
+            if(filesystemsnapshot.Exists(MatchString)):
                 [YSize, XSize] = nornir_imageregistration.GetImageSize(MatchString)
                 if YSize != self.TileYDim or XSize != self.TileXDim:
                     return [False, "Image size does not match meta-data"]
@@ -3412,7 +3926,7 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
                                                                                     'X' : GridXDim,
                                                                                     'Y' : iY,
                                                                                     'postfix' : FilePostfix})
-            if(os.path.exists(MatchString)):
+            if(filesystemsnapshot.Exists(MatchString)):
                 [YSize, XSize] = nornir_imageregistration.GetImageSize(MatchString)
                 if YSize != self.TileYDim or XSize != self.TileXDim:
                     return [False, "Image size does not match meta-data"]
@@ -3490,7 +4004,7 @@ class LevelNode(XContainerElementWrapper):
     def IsValid(self):
         '''Remove level directories without files, or with more files than they should have'''
 
-        if not os.path.isdir(self.FullPath):
+        if not filesystemsnapshot.IsDir(self.FullPath):
             return [False, 'Directory does not exist']
          
         PyramidNode = self.Parent
@@ -3564,7 +4078,7 @@ class HistogramBase(VMH.InputTransformHandler, XElementWrapper):
         if self.DataNode is None:
             return [False, "No data node found"]
         else:
-            if not os.path.exists(self.DataNode.FullPath):
+            if not filesystemsnapshot.Exists(self.DataNode.FullPath):
                 return [False, "No file to match data node"]
 
         '''Check for the transform node and ensure the checksums match'''
@@ -3722,6 +4236,20 @@ class PruneNode(HistogramBase):
         return obj
 
 
+def _BuildNodeClassRegistry():
+    '''Map element tags to the <Tag>Node class that wraps them'''
+    registry = {}
+    for (name, value) in list(globals().items()):
+        if len(name) > len('Node') and name.endswith('Node') and isinstance(value, type) and issubclass(value, XElementWrapper):
+            registry[name[:-len('Node')]] = value
+
+    return registry
+
+
+# Element tag -> XElementWrapper subclass, used by VolumeManager.WrapElement
+__NodeClassForTag__ = _BuildNodeClassRegistry()
+
+
 if __name__ == '__main__':
     VolumeManager.Load("C:\Temp")
 
@@ -15,4 +15,4 @@ import nornir_buildmanager.VolumeManagerETree as VolumeManager
 from . import validation
 from nornir_buildmanager.metadata import tilesetinfo
 
-__all__ = ['pipelinemanager', 'VolumeManagerETree', 'templates', 'operations', 'metadata']
\ No newline at end of file
+__all__ = ['pipelinemanager', 'pipelinescheduler', 'VolumeManagerETree', 'templates', 'operations', 'metadata']
\ No newline at end of file
@@ -76,6 +76,14 @@ def _AddParserRootArguments(parser):
                         help='Provide additional output',
                         dest='verbose')
 
+    parser.add_argument('-maxloadednodes',
+                        action='store',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='Number of linked nodes, such as sections and channels, kept in memory before the least recently used are saved and unloaded.  Lower values reduce memory use on large volumes.',
+                        dest='maxloadednodes')
+
 
 def _GetPipelineXMLPath():
     return os.path.join(ConfigDataPath(), 'Pipelines.xml')
@@ -103,6 +111,7 @@ def BuildParserRoot():
     
     pipeline_subparsers = parser.add_subparsers(title='Commands')
     _AddPipelineParsers(pipeline_subparsers)
+    _AddBuildAllParser(pipeline_subparsers)
     
     return parser
 
@@ -125,6 +134,35 @@ def _AddPipelineParsers(subparsers):
         CommandParserDict[pipeline_name] = pipeline_parser
 
 
+def _AddBuildAllParser(subparsers):
+
+    build_all_parser = subparsers.add_parser('BuildAll',
+                                             help='Run several pipelines in order without reloading the volume.  Consecutive pipelines that iterate over sections run section by section so later pipelines can start on a section before earlier pipelines finish the others.',
+                                             epilog='Example: nornir-build volumepath BuildAll -workers 8 Prune,Histogram,AdjustContrast,Mosaic,Assemble -Sections 1-10')
+
+    build_all_parser.add_argument('-workers',
+                        action='store',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='Number of processes used to run pipelines on different sections at the same time.  By default everything runs in this process.',
+                        dest='workers')
+
+    build_all_parser.add_argument('pipelines',
+                        action='store',
+                        type=str,
+                        help='Comma separated list of pipelines to run, in order',
+                        )
+
+    build_all_parser.add_argument('pipelineargs',
+                        nargs=argparse.REMAINDER,
+                        help='Arguments for the pipelines.  Each pipeline uses the arguments it defines and ignores the rest.')
+
+    build_all_parser.set_defaults(func=call_build_all, PipelineXmlFile=_GetPipelineXMLPath(), PipelineName='BuildAll')
+
+    CommandParserDict['BuildAll'] = build_all_parser
+
+
 def print_help(args):
 
     if args.pipelinename is None:
@@ -144,6 +182,13 @@ def call_update(args):
 def call_pipeline(args):
     pipelinemanager.PipelineManager.RunPipeline(PipelineXmlFile=args.PipelineXmlFile, PipelineName=args.PipelineName, args=args)
 
+
+
+def call_build_all(args):
+    PipelineNames = [name.strip() for name in args.pipelines.split(',') if len(name.strip()) > 0]
+    scheduler = pipelinescheduler.PipelineScheduler.Load(args.PipelineXmlFile, PipelineNames, args, PipelineArgs=args.pipelineargs, MaxWorkers=args.workers)
+    scheduler.Execute()
+
     
 def _GetFromNamespace(ns, attribname, default=None):
     if attribname in ns:
@@ -0,0 +1,254 @@
+'''
+Cached directory listings used to validate volume elements.
+
+Validating the elements of a volume asks the file system whether thousands of
+files and directories exist and lists level directories that may hold tens of
+thousands of tiles.  On network file systems these metadata calls dominate the
+time spent selecting and iterating elements.
+
+The first query about a directory lists it once with os.scandir and remembers
+the names, and whether each is a directory.  Later queries cost a single stat
+of the directory.  The listing is read again when the modification time of the
+directory changes, which happens whenever an entry is added, removed or
+renamed.  File systems with coarse timestamps can change a directory within
+the same timestamp tick as the listing, so listings of directories modified
+within RacyInterval seconds of being listed are not kept.  Existence queries
+about entries of such a directory, usually a directory a build is writing
+into, stat the entry itself instead of listing the directory again.
+
+Only the names in a directory are cached.  The size or contents of a file can
+change without changing the directory, so callers needing those must stat the
+file.
+'''
+
+import collections
+import fnmatch
+import os
+import stat
+import threading
+import time
+
+# Directories modified this many seconds or less before they were listed are listed again on the next query
+RacyInterval = 2.0
+
+# Number of directory listings to keep
+MaxSnapshots = 4096
+
+
+class DirectorySnapshot(object):
+    '''The entries of a directory when it was listed'''
+
+    @property
+    def Path(self):
+        return self._Path
+
+    @property
+    def MTime(self):
+        '''Modification time of the directory, in nanoseconds, when it was listed'''
+        return self._MTime
+
+    @property
+    def Entries(self):
+        '''Dictionary mapping entry names to True for directories and False for other entries'''
+        return self._Entries
+
+    @property
+    def IsRacy(self):
+        '''True if the directory was modified too recently before it was listed for the listing to be trusted later'''
+        return self._ScanTime - self._MTime <= RacyInterval * 1e9
+
+    def __init__(self, Path, MTime, Entries, ScanTime):
+        self._Path = Path
+        self._MTime = MTime
+        self._Entries = Entries
+        self._ScanTime = ScanTime
+
+        # Names are compared the way the file system compares them
+        if os.path.normcase('A') == 'A':
+            self._NormcasedEntries = Entries
+        else:
+            self._NormcasedEntries = {os.path.normcase(k): v for (k, v) in Entries.items()}
+
+    def Lookup(self, Name):
+        ''':return: True for a directory, False for other entries, or None if the directory has no entry with the name'''
+        return self._NormcasedEntries.get(os.path.normcase(Name), None)
+
+    @classmethod
+    def Scan(cls, Path):
+        ''':return: A snapshot of the directory or None if it is not a directory'''
+        ScanTime = time.time_ns()
+        try:
+            MTime = os.stat(Path).st_mtime_ns
+            Entries = {}
+            with os.scandir(Path) as it:
+                for entry in it:
+                    try:
+                        Entries[entry.name] = entry.is_dir()
+                    except OSError:
+                        Entries[entry.name] = False
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        return DirectorySnapshot(Path, MTime, Entries, ScanTime)
+
+    def IsCurrent(self, MTime):
+        ''':return: True if the directory, now with modification time MTime, is known to have the listed entries'''
+        return MTime == self._MTime and not self.IsRacy
+
+
+_Snapshots = collections.OrderedDict()
+_SnapshotsLock = threading.Lock()
+
+# Directories found to be recently modified, mapped to the time their listing can next be trusted.
+# Entries of these directories are stat'ed directly without checking the directory again until then.
+_RecentlyModified = {}
+
+
+def _Key(Path):
+    return os.path.normcase(os.path.abspath(Path))
+
+
+def _TrustedSnapshot(DirectoryFullPath):
+    '''
+    Lists the directory if there is no current listing and the directory was not modified recently.
+    :return: (Exists, snapshot) where snapshot is a trusted DirectorySnapshot of the directory or None
+    '''
+    Key = _Key(DirectoryFullPath)
+    Now = time.time_ns()
+
+    if _RecentlyModified.get(Key, 0) > Now:
+        return (True, None)
+
+    try:
+        MTime = os.stat(DirectoryFullPath).st_mtime_ns
+    except OSError:
+        Invalidate(DirectoryFullPath)
+        return (False, None)
+
+    with _SnapshotsLock:
+        snapshot = _Snapshots.get(Key, None)
+        if snapshot is not None and snapshot.IsCurrent(MTime):
+            _Snapshots.move_to_end(Key)
+            return (True, snapshot)
+
+        if Now - MTime <= RacyInterval * 1e9:
+            if len(_RecentlyModified) > MaxSnapshots:
+                _RecentlyModified.clear()
+
+            _RecentlyModified[Key] = MTime + int(RacyInterval * 1e9) + 1
+            return (True, None)
+
+        _RecentlyModified.pop(Key, None)
+
+    return (True, GetSnapshot(DirectoryFullPath))
+
+
+def GetSnapshot(DirectoryFullPath):
+    '''
+    :return: A current DirectorySnapshot of the directory, or None if the directory does not exist.
+             Listings of recently modified directories are returned but not kept.
+    '''
+    Key = _Key(DirectoryFullPath)
+
+    try:
+        MTime = os.stat(DirectoryFullPath).st_mtime_ns
+    except OSError:
+        Invalidate(DirectoryFullPath)
+        return None
+
+    with _SnapshotsLock:
+        snapshot = _Snapshots.get(Key, None)
+        if snapshot is not None and snapshot.IsCurrent(MTime):
+            _Snapshots.move_to_end(Key)
+            return snapshot
+
+    snapshot = DirectorySnapshot.Scan(DirectoryFullPath)
+
+    with _SnapshotsLock:
+        if snapshot is None or snapshot.IsRacy:
+            _Snapshots.pop(Key, None)
+        else:
+            _Snapshots[Key] = snapshot
+            _Snapshots.move_to_end(Key)
+            while len(_Snapshots) > MaxSnapshots:
+                _Snapshots.popitem(last=False)
+
+    return snapshot
+
+
+def Invalidate(Path=None):
+    '''Forget the listing of a directory, or of every directory if Path is None'''
+    with _SnapshotsLock:
+        if Path is None:
+            _Snapshots.clear()
+            _RecentlyModified.clear()
+        else:
+            _Snapshots.pop(_Key(Path), None)
+            _RecentlyModified.pop(_Key(Path), None)
+
+
+def _StatEntry(FullPath):
+    try:
+        return stat.S_ISDIR(os.stat(FullPath).st_mode)
+    except OSError:
+        return None
+
+
+def _Entry(FullPath):
+    ''':return: True for a directory, False for other entries, or None if the path does not exist'''
+    # Only the directory key is normcased, names are looked up the way the file system compares them
+    (Parent, Name) = os.path.split(os.path.normpath(os.path.abspath(FullPath)))
+    if len(Name) == 0:
+        # Root of a file system
+        return True if os.path.isdir(Parent) else None
+
+    (ParentExists, snapshot) = _TrustedSnapshot(Parent)
+    if not ParentExists:
+        return None
+
+    if snapshot is None:
+        # The directory is being written to, listing it again for every query would be slower than asking about the entry
+        return _StatEntry(FullPath)
+
+    return snapshot.Lookup(Name)
+
+
+def Exists(FullPath):
+    '''Replacement for os.path.exists'''
+    return _Entry(FullPath) is not None
+
+
+def IsDir(FullPath):
+    '''Replacement for os.path.isdir'''
+    return _Entry(FullPath) is True
+
+
+def IsFile(FullPath):
+    '''True if the path exists and is not a directory'''
+    return _Entry(FullPath) is False
+
+
+def ListDir(DirectoryFullPath):
+    '''Replacement for os.listdir.  :return: Sorted list of entry names, empty if the directory does not exist'''
+    snapshot = GetSnapshot(DirectoryFullPath)
+    if snapshot is None:
+        return []
+
+    return sorted(snapshot.Entries.keys())
+
+
+def Glob(DirectoryFullPath, Pattern):
+    '''
+    Replacement for glob.glob(os.path.join(DirectoryFullPath, Pattern)) where Pattern has no directory separators.
+    As with glob, names beginning with a period only match patterns beginning with a period.
+    :return: Sorted list of full paths
+    '''
+    snapshot = GetSnapshot(DirectoryFullPath)
+    if snapshot is None:
+        return []
+
+    Names = fnmatch.filter(snapshot.Entries.keys(), Pattern)
+    if not Pattern.startswith('.'):
+        Names = [n for n in Names if not n.startswith('.')]
+
+    return [os.path.join(DirectoryFullPath, n) for n in sorted(Names)]
@@ -8,6 +8,7 @@ import collections
 import glob
 import logging
 import os
+import shutil
 import tempfile
 
 import PIL
@@ -29,6 +30,9 @@ from . import GetFileNameForTileNumber
 
 DimensionScale = collections.namedtuple('DimensionScale', ('UnitsPerPixel', 'Units'))
 
+# Meta-data read from a DM4 file that the mosaic builder needs.  GridSize and ImageShape are [Y,X], Overlap is [Y,X] from 0 to 1.0 or None if it was not read
+DM4TileMetadata = collections.namedtuple('DM4TileMetadata', ('ImageBpp', 'ImageShape', 'GridSize', 'Overlap'))
+
 TileExtension = 'png'  # Pillow does not support 16-bit png files, so we use the npy extension
 
 mosaics_loaded = {} # A cache of mosaics we've already loaded during import
@@ -59,8 +63,8 @@ def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
     DirList = files.RecurseSubdirectoriesGenerator(ImportPath, RequiredFiles="*." + extension, ExcludeNames=[], ExcludedDownsampleLevels=[])
     for path in DirList:
         prettyoutput.CurseString("DM4Import", "Importing *.dm4 from {0}".format(path))
-        for idocFullPath in glob.glob(os.path.join(path, '*.dm4')):
-            yield from DigitalMicrograph4Import.ToMosaic(VolumeElement, idocFullPath, VolumeElement.FullPath, FlipList=FlipList, ContrastMap=ContrastMap, tile_overlap=tile_overlap)
+        dm4FullPaths = glob.glob(os.path.join(path, '*.dm4'))
+        yield from DigitalMicrograph4Import.ToMosaics(VolumeElement, dm4FullPaths, VolumeElement.FullPath, FlipList=FlipList, ContrastMap=ContrastMap, tile_overlap=tile_overlap)
     
     nornir_pools.WaitOnAllPools()
     
@@ -74,6 +78,24 @@ def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
         yield transformObj.Parent
 
     
+def ReadDM4Tile(dm4FileFullPath, output_fullpath=None, ReadOverlap=True):
+    '''
+    Parse a DM4 file once, returning the meta-data needed to place the tile in the
+    mosaic and, if output_fullpath is not None, writing the image.  Intended to be
+    called from a multithreading pool.
+    :param bool ReadOverlap: Read the montage overlap from the file.  Files without montage overlap tags raise an exception if True.
+    :return: DM4TileMetadata
+    '''
+    dm4data = DM4FileHandler(dm4FileFullPath)
+    dm4meta = dm4data.ReadTileMetadata(ReadOverlap)
+
+    if output_fullpath is not None:
+        im = dm4data.ReadImageAsPIL()
+        im.save(output_fullpath)
+
+    return dm4meta
+
+
 '''Convert a DM4 file to another image format.  Intended to be called from a multithreading pool'''
 
 
@@ -133,6 +155,7 @@ class DM4FileHandler():
         return self.tags.named_subdirs['ImageList'].unnamed_subdirs[1].named_subdirs['ImageData'].named_tags['PixelDepth']
     
     def __init__(self, dm4fullpath):
+        self._dm4fullpath = dm4fullpath
         self._dm4file = dm4reader.DM4File.open(dm4fullpath)
         self._tags = self._dm4file.read_directory()
         
@@ -158,20 +181,59 @@ class DM4FileHandler():
         
         return np.asarray((YDim, XDim), dtype=np.uint64)
     
+    def _MapImageData(self, image_shape):
+        '''
+        :return: Memory map of the pixel data in the file, or None if the data tag does not record where the
+                 pixels are stored.  Montage tiles are large and are often read over a network, so mapping
+                 them avoids reading the pixels into a buffer and then copying them into an array.
+        '''
+        DataTag = self.ImageDataTag
+        data_offset = getattr(DataTag, 'data_offset', None)
+        array_length = getattr(DataTag, 'array_length', None)
+        if data_offset is None or array_length is None:
+            return None
+
+        if int(array_length) != int(np.prod(image_shape)):
+            return None
+
+        # The header records the byte order of the tag data, read_tag_data handles files that are not little endian
+        header = getattr(self.dm4file, 'header', None)
+        if header is None or not getattr(header, 'little_endian', False):
+            return None
+
+        dtype = np.dtype(self.image_dtype).newbyteorder('<')
+        return np.memmap(self._dm4fullpath, dtype=dtype, mode='r', offset=int(data_offset), shape=tuple(int(d) for d in image_shape))
+
     def ReadImageAsNumpy(self):
-        image_shape = self.ReadImageShape()     
+        image_shape = self.ReadImageShape()
+        np_array = self._MapImageData(image_shape)
+        if np_array is not None:
+            return np.array(np_array)
+
         np_array = np.array(self.dm4file.read_tag_data(self.ImageDataTag), dtype=self.image_dtype)
         np_array = np.reshape(np_array, image_shape)
         
         return np_array
     
     def ReadImageAsPIL(self):
-        image_shape = self.ReadImageShape()     
-        im = PIL.Image.frombytes(data=self.dm4file.read_tag_data(self.ImageDataTag).tobytes(), mode='I;%d' % self.image_bpp, size=(image_shape[1], image_shape[0]))
+        image_shape = self.ReadImageShape()
+        data = self._MapImageData(image_shape)
+        if data is None:
+            data = self.dm4file.read_tag_data(self.ImageDataTag).tobytes()
+
+        im = PIL.Image.frombytes(data=data, mode='I;%d' % self.image_bpp, size=(image_shape[1], image_shape[0]))
         im = im.convert(mode='I')
     
         return im
 
+    def ReadTileMetadata(self, ReadOverlap=True):
+        ''':return: DM4TileMetadata for the file'''
+        Overlap = self.ReadMontageOverlap() if ReadOverlap else None
+        return DM4TileMetadata(ImageBpp=self.image_bpp,
+                               ImageShape=self.ReadImageShape(),
+                               GridSize=self.ReadMontageGridSize(),
+                               Overlap=Overlap)
+
     def ReadMontageGridSize(self):
         ''':return: Image grid dimensions as array, [YDim,XDim] as uint64''' 
         XDim_tag = self.tags.named_subdirs['ImageList'].unnamed_subdirs[1].named_subdirs['ImageTags'].named_subdirs['Montage'].named_subdirs['Acquisition'].named_tags['Number of X Steps']
@@ -259,7 +321,71 @@ class DigitalMicrograph4Import(object):
         return os.path.join(dirname, root + '_histogram.png')
             
     @classmethod
-    def ToMosaic(cls, VolumeObj, dm4FileFullPath, OutputPath=None, Extension=None, OutputImageExt=None, tile_overlap=None, TargetBpp=None, FlipList=None, ContrastMap=None, debug=None):
+    def ImportedTileExists(cls, VolumeObj, section_number, tile_number):
+        ''':return: True if a valid image for the tile exists in the full resolution level of any raw filter of the section'''
+        BlockObj = VolumeObj.GetChildByAttrib('Block', 'Name', 'SEM')
+        if BlockObj is None:
+            return False
+
+        SectionObj = BlockObj.GetSection(section_number)
+        if SectionObj is None:
+            return False
+
+        ChannelObj = SectionObj.GetChannel('SEM')
+        if ChannelObj is None:
+            return False
+
+        filename = GetFileNameForTileNumber(tile_number, ext=TileExtension)
+        for FilterObj in ChannelObj.Filters:
+            if not FilterObj.Name.startswith('Raw'):
+                continue
+
+            TilePyramidObj = FilterObj.find('TilePyramid')
+            if TilePyramidObj is None:
+                continue
+
+            LevelObj = TilePyramidObj.GetLevel(1)
+            if LevelObj is None:
+                continue
+
+            if nornir_shared.images.IsValidImage(os.path.join(LevelObj.FullPath, filename)):
+                return True
+
+        return False
+
+    @classmethod
+    def ToMosaics(cls, VolumeObj, dm4FullPaths, OutputPath=None, tile_overlap=None, FlipList=None, ContrastMap=None):
+        '''
+        Import a set of DM4 files.  Each file is parsed once by a worker which returns the meta-data and
+        writes the tile image to a staging directory in the volume.  The tile is moved into the tile pyramid
+        once the meta-data has been used to create the filter it belongs to.
+        '''
+        os.makedirs(VolumeObj.FullPath, exist_ok=True)
+        StagingPath = tempfile.mkdtemp(prefix='DM4Import', dir=VolumeObj.FullPath)
+        try:
+            pools = nornir_pools.GetGlobalLocalMachinePool()
+
+            tasks = []
+            for (i, dm4FileFullPath) in enumerate(dm4FullPaths):
+                (section_number, tile_number) = DigitalMicrograph4Import.GetMetaFromFilename(dm4FileFullPath)
+
+                # Tiles already imported only need their meta-data
+                staged_fullpath = None
+                if not cls.ImportedTileExists(VolumeObj, section_number, tile_number):
+                    staged_fullpath = os.path.join(StagingPath, "%d.%s" % (i, TileExtension))
+
+                task = pools.add_task(os.path.basename(dm4FileFullPath), ReadDM4Tile, dm4FileFullPath, staged_fullpath, tile_overlap is None)
+                tasks.append((dm4FileFullPath, staged_fullpath, task))
+
+            for (dm4FileFullPath, staged_fullpath, task) in tasks:
+                dm4meta = task.wait_return()
+                yield from cls.ToMosaic(VolumeObj, dm4FileFullPath, OutputPath, tile_overlap=tile_overlap, FlipList=FlipList, ContrastMap=ContrastMap,
+                                        dm4meta=dm4meta, StagedImageFullPath=staged_fullpath)
+        finally:
+            shutil.rmtree(StagingPath, ignore_errors=True)
+
+    @classmethod
+    def ToMosaic(cls, VolumeObj, dm4FileFullPath, OutputPath=None, Extension=None, OutputImageExt=None, tile_overlap=None, TargetBpp=None, FlipList=None, ContrastMap=None, debug=None, dm4meta=None, StagedImageFullPath=None):
         '''
         This function will convert an idoc file in the given path to a .mosaic file.
         It will also rename image files to the requested extension and subdirectory.
@@ -268,6 +394,8 @@ class DigitalMicrograph4Import(object):
         :param tuple tile_overlap: Tuple of percentages of overlap in (X,Y) for each tile, or None to read from DM4 file
         :param list FlipList: List of section numbers which should have images flipped
         :param dict ContrastMap: Dictionary mapping section number to (Min, Max, Gamma) tuples 
+        :param DM4TileMetadata dm4meta: Meta-data already read from the DM4 file, or None to read the file
+        :param str StagedImageFullPath: Image already converted from the DM4 file, moved into the tile pyramid if the tile is not present
         '''
          
         logger = logging.getLogger(__name__ + '.' + str(cls.__name__) + "ToMosaic")
@@ -275,14 +403,15 @@ class DigitalMicrograph4Import(object):
         
         (section_number, tile_number) = DigitalMicrograph4Import.GetMetaFromFilename(dm4FileFullPath)
         
-        # Open the DM4 file
-        dm4data = DM4FileHandler(dm4FileFullPath)
-        InputImageBpp = dm4data.image_bpp
+        if dm4meta is None:
+            dm4meta = ReadDM4Tile(dm4FileFullPath, ReadOverlap=tile_overlap is None)
+
+        InputImageBpp = dm4meta.ImageBpp
         
         if tile_overlap is not None:
             tile_overlap = np.asarray(tile_overlap, dtype=np.float32)
         else:
-            tile_overlap = dm4data.ReadMontageOverlap()
+            tile_overlap = dm4meta.Overlap
         
         BlockObj = BlockNode.Create('SEM')
         [saveBlock, BlockObj] = VolumeObj.UpdateOrAddChild(BlockObj)
@@ -313,12 +442,12 @@ class DigitalMicrograph4Import(object):
         if saveTransformObj:            
             yield ChannelObj
             
-        cls.AddTileToMosaic(transformObj, dm4data, tile_number, tile_overlap)
+        cls.AddTileToMosaic(transformObj, dm4meta, tile_number, tile_overlap)
             
         # histogramdatafullpath = cls.CreateImageHistogram(dm4data, dm4FileFullPath)
         # cls.PlotHistogram(histogramdatafullpath, section_number,0,1)
         
-        TilePyramidObj = cls.AddAndImportImageToTilePyramid(TilePyramidObj, dm4FileFullPath, tile_number)
+        TilePyramidObj = cls.AddAndImportImageToTilePyramid(TilePyramidObj, dm4FileFullPath, tile_number, StagedImageFullPath)
         if TilePyramidObj is not None:
             yield TilePyramidObj
         
@@ -359,7 +488,7 @@ class DigitalMicrograph4Import(object):
         pools.add_task(os.path.basename(dm4FileFullPath) + " -> " + os.path.basename(output_fullpath), ConvertDM4ToPng, dm4FileFullPath, output_fullpath)
         
     @classmethod
-    def AddAndImportImageToTilePyramid(cls, TilePyramidObj, dm4FileFullPath, tile_number):
+    def AddAndImportImageToTilePyramid(cls, TilePyramidObj, dm4FileFullPath, tile_number, StagedImageFullPath=None):
         [created, LevelObj] = TilePyramidObj.GetOrCreateLevel(1, GenerateData=False)
         filename = GetFileNameForTileNumber(tile_number, ext=TileExtension)  # Pillow does not support 16-bit PNG
         output_fullpath = os.path.join(LevelObj.FullPath, filename)
@@ -371,17 +500,22 @@ class DigitalMicrograph4Import(object):
         
         TilePyramidObj.NumberOfTiles += 1
         TilePyramidObj.ImageFormatExt = '.' + TileExtension
+
+        if StagedImageFullPath is not None and os.path.exists(StagedImageFullPath):
+            shutil.move(StagedImageFullPath, output_fullpath)
+            return TilePyramidObj
                     
         pools = nornir_pools.GetGlobalLocalMachinePool()
         pools.add_task(os.path.basename(dm4FileFullPath) + " -> " + os.path.basename(output_fullpath), ConvertDM4ToPng, dm4FileFullPath, output_fullpath)
         return TilePyramidObj
     
     @classmethod
-    def AddTileToMosaic(cls, transformObj, dm4data, tile_number, tile_overlap=None):
+    def AddTileToMosaic(cls, transformObj, dm4meta, tile_number, tile_overlap=None):
+        ''':param DM4TileMetadata dm4meta: Meta-data read from the DM4 file'''
         tile_filename = GetFileNameForTileNumber(tile_number, ext=TileExtension) 
-        (YDim, XDim) = dm4data.ReadMontageGridSize()
+        (YDim, XDim) = dm4meta.GridSize
         
-        image_shape = dm4data.ReadImageShape()
+        image_shape = dm4meta.ImageShape
         
         grid_position = (tile_number // XDim, tile_number % XDim) #Position as (Y,X)
         assert(grid_position[1] < YDim)  # Make sure the grid position is not off the grid
@@ -397,7 +531,7 @@ class DigitalMicrograph4Import(object):
             mosaics_loaded[transformObj.FullPath] = mosaicObj
             
         if tile_overlap is None:
-            tile_overlap = dm4data.ReadMontageOverlap()
+            tile_overlap = dm4meta.Overlap
         
         PerGridOffset = image_shape * (1.0 - tile_overlap)
         
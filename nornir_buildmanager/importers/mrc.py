@@ -24,6 +24,7 @@ from nornir_shared.files import RemoveOutdatedFile
 import nornir_shared.plot as plot
 import logging
 import collections
+import functools
 import nornir_pools
 import numpy
 import nornir_buildmanager.importers.serialemlog as serialemlog
@@ -32,6 +33,9 @@ import nornir_buildmanager.importers.serialem_utils as serialem_utils
 from pyglet.resource import file
 from . import GetFileNameForTileNumber
 
+# Approximate number of bytes of pixels each export task reads from the mrc file
+ExportBatchBytes = 1 << 27
+
 
 def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
     '''Import the specified directory into the volume'''
@@ -64,6 +68,58 @@ def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
     
     nornir_pools.WaitOnAllPools()
 
+
+def _ScaleContrast(values, dtype_max, min_max_gamma):
+    '''
+    :param ndarray values: Pixel values
+    :return: float32 array of the values scaled to the range of the pixel type and rounded
+    '''
+    #This mess is here because we can't really trust the min/max pixel values reported in the MRC file for a lot of our old data
+    #Quick correct out of bounds pixels
+    outliers = values > min_max_gamma.max
+    imgs = values.astype(numpy.float32)
+    imgs[outliers] = imgs[outliers] / 2.0
+    scale = dtype_max / min_max_gamma.max
+    if min_max_gamma.min > 0:
+        imgs = (imgs - min_max_gamma.min) * scale
+    else:
+        imgs = imgs * scale
+        
+    if min_max_gamma.gamma is not None and min_max_gamma.gamma != 1.0:
+        # Gamma from the histogram cutoff overrides, applied to the values scaled to 0 to 1.0
+        imgs = numpy.clip(imgs, 0, dtype_max) / dtype_max
+        imgs = numpy.power(imgs, 1.0 / min_max_gamma.gamma) * dtype_max
+        
+    return imgs.round()
+
+
+@functools.lru_cache(maxsize=16)
+def _ContrastLookupTable(dtype_str, min_max_gamma):
+    '''
+    :return: Array mapping every value of an 8 or 16-bit integer pixel type, or
+             its unsigned bit pattern for signed types, to the contrast adjusted
+             value.  None for other pixel types.
+    '''
+    dt = numpy.dtype(dtype_str)
+    if dt.kind not in 'ui' or dt.itemsize > 2:
+        return None
+    
+    values = numpy.arange(1 << (dt.itemsize * 8), dtype=numpy.dtype('u%d' % dt.itemsize)).view(dt)
+    return _ScaleContrast(values, numpy.iinfo(dt).max, min_max_gamma).astype(dt)
+
+
+def _EncoderImage(img):
+    '''
+    :return: Pillow image to encode.  16-bit unsigned images share the memory of the array.
+             Other images are converted to 32-bit integer images, so 8-bit tiles are written as 16-bit PNGs as they always have been.
+    '''
+    size = (img.shape[1], img.shape[0])
+    if img.dtype == numpy.dtype('<u2'):
+        return Image.frombuffer('I;16', size, img, 'raw', 'I;16', 0, 1)
+    
+    return Image.fromarray(img).convert(mode='I')
+
+
 class MRCImport(object):
     '''
     Imports an .MRC file into a volume
@@ -174,63 +230,102 @@ class MRCImport(object):
     
     @classmethod
     def ExportImages(cls, mrcfile, output_dir, img_ext, min_max_gamma):
+        '''
+        Export every tile of the mrc file as an image.  Tiles are divided into
+        batches of about ExportBatchBytes.  Each task receives the location of
+        the tiles in the file, not the header or pixels, and maps the file to
+        read its batch.
+        '''
         
         if isinstance(mrcfile, str):
-            mrc_obj = MRCFile.Load(mrcfile)
+            mrcfile = MRCFile.Load(mrcfile)
+        
+        tile_stack = mrcfile.tile_stack
+        tiles_per_batch = max(1, int(ExportBatchBytes // mrcfile.image_length_in_bytes))
         
         pool = nornir_pools.GetGlobalLocalMachinePool()
         
-        for iTile in range(0, mrc_obj.num_tiles):
-            pool.add_task(str(iTile),
-                              cls.ExportImage,
-                              mrcfile,
-                              output_dir,
-                              img_ext,
-                              iTile,
-                              min_max_gamma)
-            
-            #cls.ExportImage(mrcfile, output_dir, img_ext, iTile, min_max_gamma)
+        for iFirstTile in range(0, mrcfile.num_tiles, tiles_per_batch):
+            iLastTile = min(iFirstTile + tiles_per_batch, mrcfile.num_tiles)
+            pool.add_task("{0}-{1}".format(iFirstTile, iLastTile - 1),
+                          cls.ExportImageBatch,
+                          tile_stack,
+                          output_dir,
+                          img_ext,
+                          iFirstTile,
+                          iLastTile,
+                          min_max_gamma)
             
     @classmethod
     def ExportImage(cls, mrcfile, output_dir, img_ext, iTile, min_max_gamma=None):
+        ''':return: True if the image was written'''
 
         if isinstance(mrcfile, str):
             mrcfile = MRCFile.Load(mrcfile)
-     
-        filename = GetFileNameForTileNumber(tile_number=iTile, ext=img_ext)  # Pillow does not support 16-bit PNG
-        output_fullpath = os.path.join(output_dir, filename)
-        if nornir_shared.images.IsValidImage(output_fullpath):
-            return False
-
+            
+        return cls.ExportImageBatch(mrcfile.tile_stack, output_dir, img_ext, iTile, iTile + 1, min_max_gamma) > 0
+    
+    @classmethod
+    def ExportImageBatch(cls, tile_stack, output_dir, img_ext, iFirstTile, iLastTile, min_max_gamma=None):
+        '''
+        Export tiles iFirstTile up to but not including iLastTile
+        :param MRCTileStack tile_stack: Location of the tiles in the mrc file
+        :return: Number of images written
+        '''
+        
+        output_fullpaths = []
+        for iTile in range(iFirstTile, iLastTile):
+            filename = GetFileNameForTileNumber(tile_number=iTile, ext=img_ext)  # Pillow does not support 16-bit PNG
+            output_fullpaths.append(os.path.join(output_dir, filename))
+            
+        iTiles = [iTile for (iTile, output_fullpath) in zip(range(iFirstTile, iLastTile), output_fullpaths) if not nornir_shared.images.IsValidImage(output_fullpath)]
+        if len(iTiles) == 0:
+            return 0
+        
         if min_max_gamma is None:
-            im = mrcfile.get_tile_as_image(iTile)
-            im.save(output_fullpath,compress_level=1)
-        else:
-            #This mess is here because we can't really trust the min/max pixel values reported in the MRC file for a lot of our old data
-            #t = mrcfile._repair_out_of_bounds_pixels(iTile, 14)
-            img = mrcfile.get_tile_as_numpy(iTile)
-            dt = img.dtype
-            img = numpy.transpose(img)
-
-            #Quick correct out of bounds pixels
-            outliers = img > min_max_gamma.max
-            img = numpy.copy(img).astype(numpy.float32)
-            img[outliers] = img[outliers] / 2.0 
-            scale = numpy.iinfo(dt).max / min_max_gamma.max
-            if min_max_gamma.min > 0:
-                img = (img - min_max_gamma.min) * scale
-            else:
-                img = img * scale
-
-            img = img.round().astype(dt)
-
-            im = Image.fromarray(img).convert(mode='I')
-            im.save(output_fullpath,compress_level=1)
+            for iTile in iTiles:
+                im = tile_stack.get_tile_as_image(iTile)
+                im.save(output_fullpaths[iTile - iFirstTile], compress_level=1)
+                im.close()
+                
+            return len(iTiles)
+        
+        # Each tile is converted into the same buffer, which the encoder reads without a copy
+        img = None
+        for iTile in iTiles:
+            img = cls._AdjustContrast(tile_stack.tiles[iTile], min_max_gamma, out=img)
+            im = _EncoderImage(img)
+            im.save(output_fullpaths[iTile - iFirstTile], compress_level=1)
             im.close()
             del im
-            del img
-
-        return True
+            
+        return len(iTiles)
+    
+    @classmethod
+    def _AdjustContrast(cls, tile, min_max_gamma, out=None):
+        '''
+        :param ndarray tile: Tile (XDim, YDim) as stored in the mrc file
+        :param ndarray out: Array (YDim, XDim) of the tile's pixel type to write the result into, allocated if None
+        :return: Tile (YDim, XDim) scaled to the range of the pixel type
+        '''
+        dt = tile.dtype.newbyteorder('=')
+        shape = (tile.shape[1], tile.shape[0])
+        if out is None or out.shape != shape or out.dtype != dt:
+            out = numpy.empty(shape, dtype=dt)
+        
+        pixels = numpy.transpose(tile)
+        
+        lookup_table = _ContrastLookupTable(dt.str, min_max_gamma)
+        if lookup_table is not None:
+            if dt.kind == 'i':
+                # The table is indexed by the unsigned bit pattern of signed pixels
+                pixels = pixels.view(numpy.dtype('u%d' % dt.itemsize).newbyteorder(tile.dtype.byteorder))
+                
+            numpy.take(lookup_table, pixels, out=out, mode='clip')
+            return out
+        
+        numpy.copyto(out, _ScaleContrast(pixels, numpy.iinfo(dt).max, min_max_gamma), casting='unsafe')
+        return out
 
     @classmethod
     def GetSectionContrastSettings(cls, mrcfile, SectionNumber, ContrastMap, CameraBpp):
@@ -298,6 +393,7 @@ class MRCFile(object):
         Header = mrc.read(cls.HeaderLength);
         IsBigEndian = cls.IsBigEndian(Header)
         obj = MRCFile(mrc, IsBigEndian)
+        obj.filename = filename
           
         (obj.img_XDim, obj.img_YDim, obj.num_tiles, obj.img_pixel_mode) = struct.unpack(obj.EndianChar + 'IIII', Header[0x00:0x10])
         
@@ -437,19 +533,30 @@ class MRCFile(object):
         image_offset = first_image_offset + (image_byte_size * iTile)
         return image_offset
              
+    @property
+    def tile_stack(self):
+        '''
+        :return: MRCTileStack for the images in the file
+        '''
+        if self._tile_stack is None:
+            try:
+                pil_mode = self.pil_pixel_mode
+            except ValueError:
+                pil_mode = None
+            
+            self._tile_stack = MRCTileStack(self.filename,
+                                            offset=MRCFile.HeaderLength + self.extended_header_size,
+                                            dtype=self.pixel_dtype,
+                                            shape=(self.num_tiles, self.img_XDim, self.img_YDim),
+                                            pil_mode=pil_mode)
+            
+        return self._tile_stack
+             
     def get_tile_as_bytes(self, iTile):
         '''
         Return bytes
         '''
-        image_offset = self._get_image_offset(iTile)
-        
-        self.mrc.seek(image_offset)
-        image_byte_length = self.image_length_in_bytes
-        image_bytes = self.mrc.read(image_byte_length)
-        while len(image_bytes) < image_byte_length:
-            image_bytes = image_bytes + self.mrc.read(image_byte_length - len(image_bytes));
-        
-        return image_bytes
+        return self.tile_stack.tiles[iTile].tobytes()
     
     def _repair_out_of_bounds_pixels(self, iTile, camera_bpp):
         '''
@@ -500,20 +607,15 @@ class MRCFile(object):
     
     def get_tile_as_numpy(self, iTile):
         '''
-        Return a numpy array
+        Return a read-only numpy array that maps the tile in the file
         '''
-        image_bytes = self.get_tile_as_bytes(iTile)
-        img = numpy.frombuffer(image_bytes, dtype=self.pixel_dtype, count=self.img_shape.prod()).reshape(self.img_shape)
-        return img
+        return self.tile_stack.get_tile_as_numpy(iTile)
     
     def get_tile_as_image(self, iTile):
         '''
         Return a pillow image
         '''
-        image_bytes = self.get_tile_as_bytes(iTile)
-        im = PIL.Image.frombytes(data=image_bytes, mode=self.pil_pixel_mode, size=(self.img_shape[1], self.img_shape[0]))
-        im = im.convert(mode='I')
-        return im
+        return self.tile_stack.get_tile_as_image(iTile)
           
     def ReadTileMeta(self, mrc, iTile):
         mrc.seek(MRCFile.HeaderLength + (iTile * self.tile_header_size))
@@ -532,6 +634,7 @@ class MRCFile(object):
         
     def __init__(self, mrc, isBigEndian=False):
         self.mrc = mrc 
+        self.filename = getattr(mrc, 'name', None)
         self.IsBigEndian = isBigEndian  # True for big-endian
         
         self.img_XDim = None
@@ -557,6 +660,54 @@ class MRCFile(object):
         self.tile_header_flags = None
         
         self.tile_meta = []
+        
+        self._tile_stack = None
+
+
+class MRCTileStack(object):
+    '''
+    The images of an mrc file, mapped into memory when first accessed.  Only the
+    location of the images is pickled so the object can be passed to other
+    processes without reading the header or copying pixels.
+    '''
+    
+    @property
+    def tiles(self):
+        '''
+        :return: Read-only memory map of the images with shape (num_tiles, XDim, YDim)
+        '''
+        if self._tiles is None:
+            self._tiles = numpy.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+            
+        return self._tiles
+    
+    def __init__(self, filename, offset, dtype, shape, pil_mode=None):
+        self.filename = filename
+        self.offset = offset
+        self.dtype = numpy.dtype(dtype)
+        self.shape = tuple([int(d) for d in shape])
+        self.pil_mode = pil_mode
+        
+        self._tiles = None
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tiles'] = None
+        return state
+        
+    def get_tile_as_numpy(self, iTile):
+        return self.tiles[iTile]
+    
+    def get_tile_as_image(self, iTile):
+        '''
+        Return a pillow image
+        '''
+        if self.pil_mode is None:
+            raise ValueError("Pixel format of {0} cannot be converted to an image".format(self.filename))
+        
+        im = PIL.Image.frombytes(data=self.tiles[iTile].tobytes(), mode=self.pil_mode, size=(self.shape[2], self.shape[1]))
+        im = im.convert(mode='I')
+        return im
 
         
 class MRCTileHeaderFlags(enum.IntFlag):
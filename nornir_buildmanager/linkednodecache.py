@@ -0,0 +1,146 @@
+'''
+Bounds the number of linked container nodes a volume keeps in memory.
+
+Containers such as Section, Channel, Filter and TilePyramid are stored in their
+own VolumeData.xml and appear in their parent as a <Tag_Link> placeholder until
+they are searched.  Once loaded they used to stay in memory for the life of the
+process.  The LinkedNodeCache records the order in which loaded containers are
+used and, when asked to enforce its budget, swaps the least recently used ones
+back to their _Link placeholder.  Containers are saved before they are
+dropped so no changes are lost.
+
+Unloading only happens when EnforceBudget is called.  The pipeline manager
+does this between iterations so nodes held in local variables of a running
+stage are never swapped out from under it.
+'''
+
+import collections
+import logging
+
+
+class LinkedNodeCache(object):
+    '''Least recently used list of linked container nodes loaded into a volume'''
+
+    # Maximum number of loaded linked containers before the least recently used are unloaded
+    DefaultMaxNodes = 4096
+
+    logger = logging.getLogger(__name__ + '.' + 'LinkedNodeCache')
+
+    @property
+    def MaxNodes(self):
+        return self._MaxNodes
+
+    @MaxNodes.setter
+    def MaxNodes(self, value):
+        if value is None:
+            value = LinkedNodeCache.DefaultMaxNodes
+        self._MaxNodes = int(value)
+
+    def __init__(self, MaxNodes=None):
+        self._Nodes = collections.OrderedDict()
+        self._Pins = {}
+        self.MaxNodes = MaxNodes
+
+    def __len__(self):
+        return len(self._Nodes)
+
+    def __contains__(self, node):
+        return id(node) in self._Nodes
+
+    def Add(self, node):
+        '''Record a container that was just loaded from a link'''
+        self._Nodes[id(node)] = node
+
+    def Touch(self, node):
+        '''Mark a container as the most recently used'''
+        key = id(node)
+        if key in self._Nodes:
+            self._Nodes.move_to_end(key)
+
+    def Remove(self, node):
+        '''Forget a container and every registered container below it'''
+        for descendant in node.iter():
+            self._Nodes.pop(id(descendant), None)
+
+    def Pin(self, node):
+        '''Prevent the node and its ancestors from being unloaded until Unpin is called'''
+        key = id(node)
+        entry = self._Pins.get(key, None)
+        if entry is None:
+            self._Pins[key] = [node, 1]
+        else:
+            entry[1] += 1
+
+    def Unpin(self, node):
+        key = id(node)
+        entry = self._Pins.get(key, None)
+        if entry is None:
+            return
+
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._Pins[key]
+
+    @classmethod
+    def _AncestorIds(cls, nodes):
+        '''The ids of every node and all of their ancestors'''
+        ids = set()
+        for node in nodes:
+            while node is not None:
+                key = id(node)
+                if key in ids:
+                    break
+
+                ids.add(key)
+                node = node.__dict__.get('_Parent', None) if hasattr(node, '__dict__') else None
+
+        return ids
+
+    def EnforceBudget(self, InUse=None):
+        '''
+        Unload the least recently used containers until no more than MaxNodes remain loaded.
+        :param list InUse: Nodes that are referenced by the caller.  Neither they nor their ancestors are unloaded.
+        :return: Number of containers unloaded
+        '''
+        if len(self._Nodes) <= self.MaxNodes:
+            return 0
+
+        protected = [entry[0] for entry in self._Pins.values()]
+        if InUse is not None:
+            protected.extend(InUse)
+
+        protected_ids = LinkedNodeCache._AncestorIds(protected)
+
+        NumUnloaded = 0
+        for node in list(self._Nodes.values()):
+            if len(self._Nodes) <= self.MaxNodes:
+                break
+
+            if id(node) not in self._Nodes:
+                # Already dropped along with an ancestor
+                continue
+
+            if id(node) in protected_ids:
+                continue
+
+            if self.Unload(node):
+                NumUnloaded += 1
+
+        if NumUnloaded > 0:
+            self.logger.info("Unloaded {0} linked nodes, {1} remain loaded".format(NumUnloaded, len(self._Nodes)))
+
+        return NumUnloaded
+
+    def Unload(self, node):
+        '''Save the node and replace it with a link in its parent
+        :return: True if the node was unloaded'''
+        parent = node.Parent
+        if parent is None or not any(child is node for child in parent):
+            # Detached from the tree, nothing to swap out
+            self.Remove(node)
+            return False
+
+        node.Save()
+        parent.ReplaceChildWithLink(node)
+        self.Remove(node)
+        return True
@@ -21,16 +21,19 @@ from nornir_imageregistration.transforms import *
 from nornir_shared import prettyoutput, files, misc, plot
 from nornir_shared.processoutputinterceptor import ProgressOutputInterceptor, ProcessOutputInterceptor
 
+import nornir_buildmanager.operations.helpers.imagestats as imagestats
 import nornir_buildmanager.operations.helpers.mosaicvolume as mosaicvolume 
 import nornir_buildmanager.operations.helpers.stosgroupvolume as stosgroupvolume
 import nornir_imageregistration.stos_brute as stos_brute
 import nornir_pools
 import nornir_imageregistration
+import numpy
+from PIL import Image
 
 
 class StomPreviewOutputInterceptor(ProgressOutputInterceptor):
 
-    def __init__(self, proc, processData=None, OverlayFilename=None, DiffFilename=None, WarpedFilename=None):
+    def __init__(self, proc, processData=None, OverlayFilename=None, DiffFilename=None, WarpedFilename=None, Tasks=None):
         self.Proc = proc
         self.ProcessData = processData
         self.Output = list()  # List of output lines
@@ -40,6 +43,7 @@ class StomPreviewOutputInterceptor(ProgressOutputInterceptor):
         self.OverlayFilename = OverlayFilename
         self.DiffFilename = DiffFilename
         self.WarpedFilename = WarpedFilename
+        self.Tasks = Tasks  # Optional list the preview tasks are appended to so the caller can check their results
         return
 
     def Parse(self, line):
@@ -125,34 +129,108 @@ class StomPreviewOutputInterceptor(ProgressOutputInterceptor):
                 else:
                     OverlayFilename = self.OverlayFilename
 
-                Pool = nornir_pools.GetGlobalProcessPool()
-
-                cmd = 'magick convert -colorspace RGB ' + tempfilenameOne + ' ' + tempfilenameTwo + ' ' + tempfilenameOne + ' -combine -interlace PNG ' + OverlayFilename
-                prettyoutput.Log(cmd)
-                Pool.add_process(cmd, cmd + " && exit", shell=True)
-                # subprocess.Popen(cmd + " && exit", shell=True)
-
                 if self.DiffFilename is None:
                     DiffFilename = 'diff_' + OverlayFile.replace("temp", "", 1) + '.png'
                 else:
                     DiffFilename = self.DiffFilename
 
-                cmd = 'magick composite ' + tempfilenameOne + ' ' + tempfilenameTwo + ' -compose difference  -interlace PNG ' + DiffFilename
-                prettyoutput.Log(cmd)
-
-                Pool.add_process(cmd, cmd + " && exit", shell=True)
-
-                if not self.WarpedFilename is None:
-                    cmd = 'magick convert ' + tempfilenameTwo + " -interlace PNG " + self.WarpedFilename
-                    Pool.add_process(cmd, cmd + " && exit", shell=True)
-
-                # subprocess.call(cmd + " && exit", shell=True)
+                # The process pool has one worker per core, which bounds the number of image pairs in memory.
+                # Workers do not share our working directory, so every path passed to them must be absolute.
+                Pool = nornir_pools.GetGlobalProcessPool()
+                task = Pool.add_task(OverlayFilename, WriteStomPreviewImages,
+                                     os.path.abspath(tempfilenameOne), os.path.abspath(tempfilenameTwo),
+                                     os.path.abspath(OverlayFilename), os.path.abspath(DiffFilename),
+                                     None if self.WarpedFilename is None else os.path.abspath(self.WarpedFilename))
+                if self.Tasks is not None:
+                    self.Tasks.append(task)
             else:
                 prettyoutput.Log("Unexpected number of images output from ir-stom, expected 2: " + str(outputfiles))
 
         return
 
 
+def _ReadStomImage(ImageFullPath):
+    with Image.open(ImageFullPath) as img:
+        if img.mode not in ('L', 'I;16', 'I;16B', 'I;16L', 'I', 'F'):
+            img = img.convert('L')
+
+        return numpy.asarray(img)
+
+
+def _ToUnitRange(image):
+    '''Scale an image to 0 to 1.0 by its own bit depth'''
+    if image.dtype.kind == 'f':
+        return image.astype(numpy.float32, copy=False)
+
+    if image.dtype == numpy.uint8:
+        return image.astype(numpy.float32) / 255.0
+
+    # 16-bit images, which Pillow may also read into int32 arrays
+    return image.astype(numpy.float32) / 65535.0
+
+
+def _ToUInt8(image):
+    if image.dtype == numpy.uint8:
+        return image
+
+    if image.dtype.kind == 'f':
+        return numpy.clip(image * 255.0, 0, 255).astype(numpy.uint8)
+
+    # 16-bit images
+    return numpy.right_shift(numpy.clip(image, 0, 65535).astype(numpy.uint16), 8).astype(numpy.uint8)
+
+
+def _WriteArrayImage(image, OutputFullPath):
+    if image.dtype.kind == 'f':
+        # PNG has no floating point format, keep the precision of a 16-bit image
+        image = numpy.round(numpy.clip(image, 0, 1.0) * 65535.0).astype(numpy.uint16)
+
+    if image.dtype == numpy.uint16:
+        Image.frombuffer('I;16', (image.shape[1], image.shape[0]), numpy.ascontiguousarray(image, dtype='<u2'), 'raw', 'I;16', 0, 1).save(OutputFullPath)
+    else:
+        Image.fromarray(image).save(OutputFullPath)
+
+
+def WriteStomPreviewImages(ControlImageFullPath, WarpedImageFullPath, OverlayFullPath, DiffFullPath, WarpedOutputFullPath=None):
+    '''
+    Create the previews of a section registration from the control image and the warped mapped image written by ir-stom.
+    Each input is read once and each output is encoded once.
+    The overlay is an RGB image with the control image in the red and blue channels and the warped image in the green channel.
+    The diff image is the absolute difference of the two images.
+    '''
+    Control = _ReadStomImage(ControlImageFullPath)
+    Warped = _ReadStomImage(WarpedImageFullPath)
+
+    if Control.shape != Warped.shape:
+        raise ValueError("ir-stom output images have different sizes %s and %s" % (str(Control.shape), str(Warped.shape)))
+
+    WarpedOutput = Warped
+
+    if Control.dtype != Warped.dtype:
+        # Compare images of different bit depths on a common 0 to 1.0 scale
+        Control = _ToUnitRange(Control)
+        Warped = _ToUnitRange(Warped)
+
+    ControlBytes = _ToUInt8(Control)
+    Overlay = numpy.empty(Control.shape + (3,), dtype=numpy.uint8)
+    Overlay[:, :, 0] = ControlBytes
+    Overlay[:, :, 1] = _ToUInt8(Warped)
+    Overlay[:, :, 2] = ControlBytes
+    Image.fromarray(Overlay, 'RGB').save(OverlayFullPath)
+    del Overlay
+
+    if Control.dtype.kind == 'f':
+        Diff = numpy.abs(Control - Warped)
+    else:
+        Diff = numpy.abs(Control.astype(numpy.int32) - Warped).astype(Control.dtype)
+
+    _WriteArrayImage(Diff, DiffFullPath)
+    del Diff
+
+    if WarpedOutputFullPath is not None:
+        _WriteArrayImage(WarpedOutput, WarpedOutputFullPath)
+
+
 def SectionNumberKey(SectionNodeA):
     '''Sort section nodes by number'''
     return int(SectionNodeA.get('Number', None))
@@ -765,6 +843,8 @@ def AssembleStosOverlays(Parameters, StosMapNode, GroupNode, Logger, **kwargs):
     '''Executre ir-stom on a provided .stos file'''
 
     oldDir = os.getcwd()
+    TempFullPath = os.path.join(GroupNode.FullPath, 'Temp')
+    PreviewTasks = []
     #TransformXPathTemplate = "SectionMappings[@MappedSectionNumber='%(MappedSection)d']/Transform[@ControlSectionNumber='%(ControlSection)d']"
   
     SectionMappingSaveRequired = False
@@ -866,7 +946,8 @@ def AssembleStosOverlays(Parameters, StosMapNode, GroupNode, Logger, **kwargs):
                         ProcessOutputInterceptor.Intercept(StomPreviewOutputInterceptor(NewP,
                                                                                                                   OverlayFilename=OverlayImageNode.FullPath,
                                                                                                                    DiffFilename=DiffImageNode.FullPath,
-                                                                                                                   WarpedFilename=WarpedImageNode.FullPath))
+                                                                                                                   WarpedFilename=WarpedImageNode.FullPath,
+                                                                                                                   Tasks=PreviewTasks))
 
                         SectionMappingSaveRequired = True
 
@@ -884,8 +965,21 @@ def AssembleStosOverlays(Parameters, StosMapNode, GroupNode, Logger, **kwargs):
         #Pool = nornir_pools.GetGlobalProcessPool()
         #Pool.wait_completion()
         nornir_pools.WaitOnAllPools()
+
+        for task in PreviewTasks:
+            try:
+                task.wait_return()
+            except Exception as e:
+                prettyoutput.LogErr("Could not create registration preview {0}\n{1}".format(task.name, str(e)))
     finally:
-        shutil.rmtree('Temp', ignore_errors=True)
+        # The previews read their inputs from Temp, so it is only removed once every preview task is done
+        for task in PreviewTasks:
+            try:
+                task.wait()
+            except Exception:
+                pass
+
+        shutil.rmtree(TempFullPath, ignore_errors=True)
 
         os.chdir(oldDir)
 
@@ -1076,45 +1170,37 @@ def SelectBestRegistrationChain(Parameters, InputGroupNode, InputStosMapNode, Ou
             # No need to test, copy over the transform
             WinningTransform = PotentialTransforms[0]
         else:
-            TaskList = []
+            CandidateTransforms = []
+            CandidateImages = []
             for Transform in PotentialTransforms:
-                try:
-                    ImageSearchXPath = ImageSearchXPathTemplate % {'InputTransformChecksum' : Transform.Checksum}
-                    ImageNode = InputSectionMappingNode.find(ImageSearchXPath)
+                ImageSearchXPath = ImageSearchXPathTemplate % {'InputTransformChecksum' : Transform.Checksum}
+                ImageNode = InputSectionMappingNode.find(ImageSearchXPath)
 
-                    if ImageNode is None:
-                        Logger.error(str(mappedSection) + ' -> ' + str(controlSection))
-                        Logger.error("No image node found for transform")
-                        Logger.error("Checksum: " + Transform.Checksum)
-                        continue
-
-                    identifyCmd = 'magick identify -format %[mean] -verbose ' + ImageNode.FullPath
+                if ImageNode is None:
+                    Logger.error(str(mappedSection) + ' -> ' + str(Transform.ControlSectionNumber))
+                    Logger.error("No image node found for transform")
+                    Logger.error("Checksum: " + Transform.Checksum)
+                    continue
 
-                    if Pool is None:
-                        Pool = nornir_pools.GetLocalMachinePool()
-                        
-                    task = Pool.add_process(ImageNode.attrib['Path'], identifyCmd + " && exit", shell=True)
-                    task.TransformNode = Transform
-                    TaskList.append(task)
-                    Logger.info("Evaluating " + str(mappedSection) + ' -> ' + str(controlSection))
+                CandidateTransforms.append(Transform)
+                CandidateImages.append(ImageNode)
+                Logger.info("Evaluating " + str(mappedSection) + ' -> ' + str(Transform.ControlSectionNumber))
 
-                except Exception as e:
-                    Logger.error("Could not evalutate mapping " + str(mappedSection) + ' -> ' + str(controlSection))
+            if Pool is None:
+                Pool = nornir_pools.GetGlobalThreadPool()
 
             BestMean = None
 
-            for t in TaskList:
-                try:
-                    MeanStr = t.wait_return()
-                    MeanVal = float(MeanStr)
-                    if BestMean is None:
-                        WinningTransform = t.TransformNode
-                        BestMean = MeanVal
-                    elif BestMean > float(MeanVal):
-                        WinningTransform = t.TransformNode
-                        BestMean = MeanVal
-                except:
-                    pass
+            # The comparison image with the lowest mean intensity has the least difference between sections
+            for (Transform, stats) in zip(CandidateTransforms, imagestats.ImageNodeStatistics(CandidateImages, Pool=Pool)):
+                if isinstance(stats, Exception):
+                    Logger.error("Could not evalutate mapping " + str(mappedSection) + ' -> ' + str(Transform.ControlSectionNumber) + "\n" + str(stats))
+                    continue
+
+                MeanVal = stats['Mean']
+                if BestMean is None or BestMean > MeanVal:
+                    WinningTransform = Transform
+                    BestMean = MeanVal
 
         if WinningTransform is None:
             Logger.error("Winning transform is none, section #" + str(mappedSection))
@@ -1999,6 +2085,56 @@ def _GetStosToMosaicTransform(StosTransformNode, TransformNode, OutputTransformN
     return (added, OutputTransformNode)
 
 
+# Number of tile transforms each pool task composes with the section to volume transform
+TilesPerComposeTask = 64
+
+
+def _AddStosToTileTransforms(StoVTransform, ImageToTransform, Logger):
+    '''
+    Replace each tile to section transform in ImageToTransform with a tile to volume transform.
+
+    Each pool task calls triangulation.AddTransforms for a chunk of tiles, so the section to volume
+    transform is sent to the worker once per chunk instead of once per tile.
+    '''
+
+    # This is a parallel operation, but the Python GIL is so slow using threads is slower.
+    Pool = nornir_pools.GetLocalMachinePool()
+
+    Items = list(ImageToTransform.items())
+    Tasks = []
+    for iStart in range(0, len(Items), TilesPerComposeTask):
+        Chunk = Items[iStart:iStart + TilesPerComposeTask]
+        task = Pool.add_task("Compose tiles %s-%s" % (Chunk[0][0], Chunk[-1][0]), _AddStosToTileTransformChunk, StoVTransform, Chunk)
+        task.imagenames = [imagename for (imagename, t) in Chunk]
+        Tasks.append(task)
+
+    for task in Tasks:
+        try:
+            Composed = task.wait_return()
+        except Exception as e:
+            Logger.warning("Exception transforming tiles. Skipping %s\n%s" % (", ".join(task.imagenames), str(e)))
+            continue
+
+        for (imagename, MosaicToVolume, error) in Composed:
+            if MosaicToVolume is None:
+                Logger.warning("Exception transforming tile. Skipping %s\n%s" % (imagename, error))
+                continue
+
+            ImageToTransform[imagename] = MosaicToVolume
+
+
+def _AddStosToTileTransformChunk(StoVTransform, TileTransforms):
+    ''':return: List of (image name, tile to volume transform or None, error message) for each (image name, tile transform)'''
+    output = []
+    for (imagename, MosaicToSectionTransform) in TileTransforms:
+        try:
+            output.append((imagename, triangulation.AddTransforms(StoVTransform, MosaicToSectionTransform), None))
+        except Exception as e:
+            output.append((imagename, None, str(e)))
+
+    return output
+
+
 def _ApplyStosToMosaicTransform(StosTransformNode, TransformNode, OutputTransformName, Logger, **kwargs):
     '''
     return: Transform node if there was an create/update.  None if no change
@@ -2053,34 +2189,7 @@ def _ApplyStosToMosaicTransform(StosTransformNode, TransformNode, OutputTransfor
         MosaicTransform = mosaic.Mosaic.LoadFromMosaicFile(TransformNode.FullPath)
         assert(MosaicTransform.FixedBoundingBox.BottomLeft[0] == 0 and MosaicTransform.FixedBoundingBox.BottomLeft[1] == 0)
         # MosaicTransform.TranslateToZeroOrigin() 
-        Tasks = []
-         
-        UsePool = True
-        if UsePool:
-            # This is a parallel operation, but the Python GIL is so slow using threads is slower.
-            Pool = nornir_pools.GetLocalMachinePool()
-    
-            for imagename, MosaicToSectionTransform in list(MosaicTransform.ImageToTransform.items()):
-                task = Pool.add_task(imagename, triangulation.AddTransforms, StoVTransform, MosaicToSectionTransform)
-                task.imagename = imagename
-                if hasattr(MosaicToSectionTransform, 'gridWidth'):
-                    task.dimX = MosaicToSectionTransform.gridWidth
-                if hasattr(MosaicToSectionTransform, 'gridHeight'):
-                    task.dimY = MosaicToSectionTransform.gridHeight
-    
-                Tasks.append(task)
-                   
-            for task in Tasks:
-                try:
-                    MosaicToVolume = task.wait_return()
-                    MosaicTransform.ImageToTransform[task.imagename] = MosaicToVolume
-                except:
-                    Logger.warn("Exception transforming tile. Skipping %s" % task.imagename)
-                    pass
-        else:
-            for imagename, MosaicToSectionTransform in list(MosaicTransform.ImageToTransform.items()):
-                MosaicToVolume = StoVTransform.AddTransform(MosaicToSectionTransform)
-                MosaicTransform.ImageToTransform[imagename] = MosaicToVolume
+        _AddStosToTileTransforms(StoVTransform, MosaicTransform.ImageToTransform, Logger)
 
         if len(MosaicTransform.ImageToTransform) > 0:
             OutputMosaicFile = MosaicTransform.ToMosaicFile()
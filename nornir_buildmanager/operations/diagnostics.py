@@ -128,3 +128,44 @@ def PrintImageSetsOlderThanTilePyramids(node, **kwargs):
         return node
         
     return None
+
+
+def _FormatBytes(value):
+    if value is None:
+        return "None"
+
+    for units in ['B', 'KB', 'MB', 'GB']:
+        if abs(value) < 1024.0:
+            return "{0:.1f}{1}".format(value, units)
+        value = value / 1024.0
+
+    return "{0:.1f}TB".format(value)
+
+
+def ReportPipelineTimings(VolumeNode, Top=None, **kwargs):
+    '''Print the time spent in each pipeline stage, slowest first, and the sections each stage spent the most time on'''
+    import nornir_buildmanager.pipelinetimings as pipelinetimings
+
+    if Top is None:
+        Top = 5
+
+    records = pipelinetimings.Read(VolumeNode.FullPath)
+    if len(records) == 0:
+        print("No timings recorded in " + pipelinetimings.TimingsFullPath(VolumeNode.FullPath))
+        return None
+
+    print('{0: <48} {1: >6} {2: >10} {3: >10} {4: >11} {5: >9} {6: >9} {7: >8}'.format('Stage', 'Calls', 'Wall(s)', 'CPU(s)', 'ProcPeakRSS', 'Read', 'Written', 'Tasks'))
+    for summary in pipelinetimings.Summarize(records):
+        print('{0: <48} {1: >6} {2: >10.1f} {3: >10.1f} {4: >11} {5: >9} {6: >9} {7: >8}'.format(summary['Stage'],
+                                                                                          summary['Calls'],
+                                                                                          summary['WallTime'],
+                                                                                          summary['CPUTime'],
+                                                                                          _FormatBytes(summary['ProcessPeakRSS']),
+                                                                                          _FormatBytes(summary['BytesRead']),
+                                                                                          _FormatBytes(summary['BytesWritten']),
+                                                                                          summary['PoolTasks']))
+
+        for (WallTime, Section) in summary['Sections'][:Top]:
+            print('    Section {0:04d} {1: >10.1f}s'.format(Section, WallTime))
+
+    return None
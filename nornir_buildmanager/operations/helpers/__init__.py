@@ -1 +1 @@
-__all__ = ['mosaicvolume', 'stosgroupvolume']
+__all__ = ['imagestats', 'mosaicvolume', 'stosgroupvolume']
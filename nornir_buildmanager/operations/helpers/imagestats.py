@@ -0,0 +1,117 @@
+'''
+Image statistics calculated in this process with Pillow and NumPy.
+
+Intensity statistics are scaled to the range 0 to 1 using the maximum value
+of the image's bit depth, so images with different bit depths can be
+compared.  Results are remembered for each image file and checksum, so
+statistics for an image that has not changed are only calculated once per
+process.
+'''
+
+import collections
+import os
+import threading
+
+import numpy
+from PIL import Image
+
+import nornir_pools
+
+# Number of images to remember statistics for
+MaxCachedStatistics = 1 << 16
+
+_StatisticsCache = collections.OrderedDict()
+_StatisticsCacheLock = threading.Lock()
+
+
+def _ImageArray(ImageFullPath):
+    ''':return: (numpy array of pixel values, maximum value for the bit depth or None for floating point images)'''
+    with Image.open(ImageFullPath) as img:
+        if img.mode == '1':
+            img = img.convert('L')
+        elif img.mode == 'PA':
+            img = img.convert('RGBA')
+        elif img.mode in ('P', 'CMYK', 'YCbCr', 'LAB', 'HSV'):
+            img = img.convert('RGB')
+
+        if img.mode == 'F':
+            return (numpy.asarray(img), None)
+
+        if img.mode == 'I' or img.mode.startswith('I;16'):
+            # Pillow reads 16-bit PNG and TIFF files as I or I;16
+            return (numpy.asarray(img), (1 << 16) - 1)
+
+        data = numpy.asarray(img)
+        if img.mode in ('RGBA', 'LA'):
+            # Transparency is not part of the intensity
+            data = data[..., :-1]
+
+        return (data, numpy.iinfo(data.dtype).max)
+
+
+def ImageStatistics(ImageFullPath):
+    '''
+    :return: Dictionary with the Mean, StdDev, Min, Max and NonZeroFraction of the image pixels.
+             Color images are measured across all color channels.
+    '''
+    (data, MaxValue) = _ImageArray(ImageFullPath)
+
+    Scale = 1.0 if MaxValue is None else 1.0 / MaxValue
+
+    return {'Mean' : float(data.mean(dtype=numpy.float64)) * Scale,
+            'StdDev' : float(data.std(dtype=numpy.float64)) * Scale,
+            'Min' : float(data.min()) * Scale,
+            'Max' : float(data.max()) * Scale,
+            'NonZeroFraction' : float(numpy.count_nonzero(data)) / data.size}
+
+
+def _CacheKey(ImageFullPath, Checksum):
+    if Checksum is None:
+        stat = os.stat(ImageFullPath)
+        Checksum = "{0}:{1}".format(stat.st_mtime_ns, stat.st_size)
+
+    return (os.path.abspath(ImageFullPath), str(Checksum))
+
+
+def CachedImageStatistics(ImageFullPath, Checksum=None):
+    '''
+    ImageStatistics, returning the remembered result if the image was measured before with the same checksum
+    :param str Checksum: Checksum of the image file.  The modification time and size of the file are used if None
+    '''
+    Key = _CacheKey(ImageFullPath, Checksum)
+    with _StatisticsCacheLock:
+        stats = _StatisticsCache.get(Key, None)
+        if stats is not None:
+            _StatisticsCache.move_to_end(Key)
+            return stats
+
+    stats = ImageStatistics(ImageFullPath)
+
+    with _StatisticsCacheLock:
+        _StatisticsCache[Key] = stats
+        while len(_StatisticsCache) > MaxCachedStatistics:
+            _StatisticsCache.popitem(last=False)
+
+    return stats
+
+
+def ImageNodeStatistics(ImageNodes, Pool=None):
+    '''
+    Measure the images of several ImageNodes using a thread pool
+    :return: List with the statistics dictionary for each node, or the exception raised reading the image
+    '''
+    if Pool is None:
+        Pool = nornir_pools.GetGlobalThreadPool()
+
+    tasks = []
+    for node in ImageNodes:
+        tasks.append(Pool.add_task(node.FullPath, CachedImageStatistics, node.FullPath, node.Checksum))
+
+    results = []
+    for t in tasks:
+        try:
+            results.append(t.wait_return())
+        except Exception as e:
+            results.append(e)
+
+    return results
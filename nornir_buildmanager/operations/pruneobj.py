@@ -1,8 +1,11 @@
 import copy
+import hashlib
 import logging
 import math
 import os.path
 
+import numpy
+
 from nornir_buildmanager import VolumeManagerETree
 from nornir_buildmanager.validation import transforms
 from nornir_imageregistration.image_stats import Prune
@@ -15,11 +18,65 @@ import nornir_shared.prettyoutput as prettyoutput
 import nornir_buildmanager
 
 
+# Prune scores of tiles in a level directory, keyed by tile content and overlap
+PruneFeatureCacheFilename = 'PruneFeatures.npz'
+
+
+def _TileDigest(TileFullPath):
+    ''':return: md5 hex digest of the tile file contents'''
+    md5 = hashlib.md5()
+    with open(TileFullPath, 'rb') as hFile:
+        for block in iter(lambda: hFile.read(1 << 20), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def _LoadPruneFeatureCache(CacheFullPath):
+    '''
+    :return: (Signatures, Scores).  Signatures maps tile name to (mtime_ns, size, digest) when the digest
+             was calculated.  Scores maps (digest, overlap) to the prune score.
+    '''
+    Signatures = {}
+    Scores = {}
+    if not os.path.exists(CacheFullPath):
+        return (Signatures, Scores)
+
+    try:
+        with numpy.load(CacheFullPath) as data:
+            for (name, stat, digest) in zip(data['Names'], data['Stats'], data['Digests']):
+                Signatures[str(name)] = (int(stat[0]), int(stat[1]), str(digest))
+
+            for (digest, overlap, score) in zip(data['ScoreDigests'], data['Overlaps'], data['Scores']):
+                Scores[(str(digest), float(overlap))] = float(score)
+    except (OSError, KeyError, ValueError) as e:
+        prettyoutput.LogErr("Ignoring unreadable prune feature cache " + CacheFullPath + "\n" + str(e))
+        return ({}, {})
+
+    return (Signatures, Scores)
+
+
+def _SavePruneFeatureCache(CacheFullPath, Signatures, Scores):
+    TempFullPath = CacheFullPath + '.tmp'
+    Names = sorted(Signatures.keys())
+    ScoreKeys = sorted(Scores.keys())
+
+    with open(TempFullPath, 'wb') as hFile:
+        numpy.savez(hFile,
+                    Names=numpy.asarray(Names, dtype=str),
+                    Stats=numpy.asarray([Signatures[n][0:2] for n in Names], dtype=numpy.int64).reshape((len(Names), 2)),
+                    Digests=numpy.asarray([Signatures[n][2] for n in Names], dtype=str),
+                    ScoreDigests=numpy.asarray([k[0] for k in ScoreKeys], dtype=str),
+                    Overlaps=numpy.asarray([k[1] for k in ScoreKeys], dtype=numpy.float64),
+                    Scores=numpy.asarray([Scores[k] for k in ScoreKeys], dtype=numpy.float64))
+
+    os.replace(TempFullPath, CacheFullPath)
+
 
 class PruneObj:
     """Executes ir-prune and produces a histogram"""
 
-    ImageMapFileTemplate = "PruneScores%s.txt"
+    ImageMapFileTemplate = "PruneScores%s.npz"
 
     HistogramXMLFileTemplate = 'PruneScores%s.xml'
     HistogramPNGFileTemplate = 'PruneScores%s.png'
@@ -233,7 +290,7 @@ class PruneObj:
         Parameters['Filter'] = FilterNode.Name
 
         MangledName = nornir_shared.misc.GenNameFromDict(Parameters) + '_' + TransformNode.Type
-        OutputFile = OutputFile + MangledName + '.txt'
+        OutputFile = OutputFile + MangledName + '.npz'
 
         SaveRequired = False
         PruneMapElement = FilterNode.GetChildByAttrib('Prune', 'Overlap', Overlap)
@@ -254,17 +311,16 @@ class PruneObj:
         # Create file holders for the .xml and .png files
         PruneDataNode = VolumeManagerETree.DataNode.Create(OutputFile)
         [added, PruneDataNode] = PruneMapElement.UpdateOrAddChild(PruneDataNode)
+        if not added and PruneDataNode.Path != OutputFile:
+            # Replace prune maps written in the older text format
+            PruneDataNode.Path = OutputFile
 
         FullTilePath = LevelNode.FullPath
 
         TransformObj = mosaicfile.MosaicFile.Load(TransformNode.FullPath)
         TransformObj.RemoveInvalidMosaicImages(FullTilePath)
 
-        files = []
-        for f in list(TransformObj.ImageToTransformString.keys()):
-            files.append(os.path.join(FullTilePath, f))
-
-        TileToScore = Prune(files, Overlap)
+        TileToScore = cls.ScoreTiles(FullTilePath, list(TransformObj.ImageToTransformString.keys()), Overlap)
 
         prune = PruneObj(TileToScore)
 
@@ -274,34 +330,105 @@ class PruneObj:
         PruneMapElement.NumImages = len(TileToScore)
 
         return FilterNode
-#
+
+    @classmethod
+    def ScoreTiles(cls, TilePath, TileNames, Overlap):
+        '''
+        Calculate the prune score of each tile.  Scores depend only on the tile image and the overlap, so
+        they are cached in the tile directory by the md5 of the tile file.  Only new or changed tiles are
+        passed to Prune.  Files are hashed again only if their modification time or size changed.
+        :return: Dictionary mapping tile name to score
+        '''
+        Overlap = float(Overlap)
+        CacheFullPath = os.path.join(TilePath, PruneFeatureCacheFilename)
+        (Signatures, Scores) = _LoadPruneFeatureCache(CacheFullPath)
+
+        TileToScore = {}
+        TileToDigest = {}
+        Uncached = []
+        CacheChanged = False
+        for name in TileNames:
+            TileFullPath = os.path.join(TilePath, name)
+            try:
+                stat = os.stat(TileFullPath)
+            except OSError:
+                prettyoutput.LogErr("Missing tile for prune score " + TileFullPath)
+                continue
+
+            signature = Signatures.get(name, None)
+            if signature is None or signature[0:2] != (stat.st_mtime_ns, stat.st_size):
+                signature = (stat.st_mtime_ns, stat.st_size, _TileDigest(TileFullPath))
+                Signatures[name] = signature
+                CacheChanged = True
+
+            digest = signature[2]
+            TileToDigest[name] = digest
+            score = Scores.get((digest, Overlap), None)
+            if score is None:
+                Uncached.append(name)
+            else:
+                TileToScore[name] = score
+
+        if len(Uncached) > 0:
+            prettyoutput.Log("Calculating prune scores for {0} of {1} tiles".format(len(Uncached), len(TileToDigest)))
+
+            # Prune may key results by full path or file name
+            BaseNameToName = {os.path.basename(name) : name for name in Uncached}
+            Calculated = Prune([os.path.join(TilePath, name) for name in Uncached], Overlap)
+            for (key, score) in Calculated.items():
+                name = BaseNameToName[os.path.basename(key)]
+                TileToScore[name] = score
+                Scores[(TileToDigest[name], Overlap)] = float(score)
+
+            CacheChanged = True
+
+        if CacheChanged:
+            # Forget tiles that were deleted and scores no tile refers to
+            Signatures = {name : sig for (name, sig) in Signatures.items() if name in TileToDigest or os.path.exists(os.path.join(TilePath, name))}
+            Digests = frozenset([sig[2] for sig in Signatures.values()])
+            Scores = {key : score for (key, score) in Scores.items() if key[0] in Digests}
+
+            try:
+                _SavePruneFeatureCache(CacheFullPath, Signatures, Scores)
+            except OSError as e:
+                prettyoutput.LogErr("Could not save prune feature cache " + CacheFullPath + "\n" + str(e))
+
+        return TileToScore
+
     def WritePruneMap(self, MapImageToScoreFile):
+        '''Save the scores as arrays of tile names and scores in NumPy .npz format'''
 
         if len(self.MapImageToScore) == 0:
             prettyoutput.LogErr('No prune scores to write to file ' + MapImageToScoreFile)
+            if(os.path.exists(MapImageToScoreFile)):
+                os.remove(MapImageToScoreFile)
             return
 
-        with open(MapImageToScoreFile, 'w') as outfile:
+        Names = sorted(self.MapImageToScore.keys())
+        Scores = numpy.asarray([self.MapImageToScore[f] for f in Names], dtype=numpy.float64)
 
-            if(len(list(self.MapImageToScore.keys())) == 0):
-                if(os.path.exists(MapImageToScoreFile)):
-                    os.remove(MapImageToScoreFile)
+        # Write through a file handle so numpy does not append .npz to the name
+        with open(MapImageToScoreFile, 'wb') as outfile:
+            numpy.savez(outfile, Names=numpy.asarray(Names, dtype=str), Scores=Scores)
 
-                prettyoutput.Log("No prune scores present in PruneMap being saved: " + MapImageToScoreFile)
-                outfile.close()
-                return
+    @classmethod
+    def ReadPruneMap(cls, MapImageToScoreFile):
 
-            for f in sorted(self.MapImageToScore.keys()):
-                score = self.MapImageToScore[f]
+        assert(os.path.exists(MapImageToScoreFile))
 
-                outfile.write(f + '\t' + str(score) + '\n')
+        with open(MapImageToScoreFile, 'rb') as infile:
+            IsNpz = infile.read(2) == b'PK'
 
-            outfile.close()
+        if IsNpz:
+            with numpy.load(MapImageToScoreFile) as data:
+                MapImageToScore = {str(name) : float(score) for (name, score) in zip(data['Names'], data['Scores'])}
 
-    @classmethod
-    def ReadPruneMap(cls, MapImageToScoreFile):
+            if len(MapImageToScore) == 0:
+                return None
 
-        assert(os.path.exists(MapImageToScoreFile))
+            return PruneObj(MapImageToScore)
+
+        # Prune maps written by earlier versions are tab separated text
         infile = open(MapImageToScoreFile, 'r')
         lines = infile.readlines()
  #      prettyoutput.Log( lines)
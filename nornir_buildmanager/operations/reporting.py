@@ -5,6 +5,7 @@ Created on Oct 3, 2012
 '''
 
 import datetime
+import hashlib
 import logging
 import os
 import shutil
@@ -128,10 +129,47 @@ class HTMLPaths(object):
 
         (self._ThumbnialRootRelative, self._ThumbnailDir) = self.__ThumbnailPaths()
 
+        # Names of the files in the thumbnail directory used by this report
+        self._ThumbnailsUsed = set()
+
     def CreateOutputDirs(self):
         os.makedirs(self.OutputDir, exist_ok=True)
         os.makedirs(self.ThumbnailDir, exist_ok=True)
 
+    def CachedThumbnailPaths(self, SourceFullPath, ThumbnailName, *KeyValues):
+        '''
+        Thumbnails are named by a hash of the source file's path, modification time and size and of
+        any values, such as the thumbnail size, that change the thumbnail.  The name does not change
+        between reports, so a thumbnail only needs to be created when the source changes.
+        :return: (Relative path, full path, True if the thumbnail does not exist)
+        '''
+        stat = os.stat(SourceFullPath)
+        Key = "|".join([os.path.abspath(SourceFullPath), str(stat.st_mtime_ns), str(stat.st_size)] + [str(v) for v in KeyValues])
+        ThumbnailFilename = hashlib.md5(Key.encode('utf-8')).hexdigest()[:16] + "_" + ThumbnailName
+
+        self._ThumbnailsUsed.add(ThumbnailFilename)
+        self._ThumbnailsUsed.add(_TempThumbnailFilename(ThumbnailFilename))
+
+        ThumbnailFullPath = os.path.join(self.ThumbnailDir, ThumbnailFilename)
+        return (os.path.join(self.ThumbnailRelative, ThumbnailFilename), ThumbnailFullPath, not os.path.exists(ThumbnailFullPath))
+
+    def RemoveUnusedThumbnails(self):
+        '''Delete files in the thumbnail directory that were not used by this report
+        :return: Number of files removed'''
+        if not os.path.isdir(self.ThumbnailDir):
+            return 0
+
+        NumRemoved = 0
+        for entry in os.scandir(self.ThumbnailDir):
+            if entry.is_file() and not entry.name in self._ThumbnailsUsed:
+                try:
+                    os.remove(entry.path)
+                    NumRemoved += 1
+                except OSError:
+                    pass
+
+        return NumRemoved
+
     @classmethod
     def __StripLeadingPathSeperator(cls, path):
         while(path[0] == os.sep or path[0] == os.altsep):
@@ -206,6 +244,18 @@ def GetTempFileSaltString():
     return saltString
 
 
+def _TempThumbnailFilename(ThumbnailFilename):
+    return 'tmp_' + ThumbnailFilename
+
+
+def _WriteThumbnail(func, InputFullPath, OutputFullPath, *args):
+    '''Call func(InputFullPath, TempFullPath, *args) and move the output into place, so an interrupted report does not leave a partial thumbnail in the cache'''
+    (OutputDir, OutputFilename) = os.path.split(OutputFullPath)
+    TempFullPath = os.path.join(OutputDir, _TempThumbnailFilename(OutputFilename))
+    func(InputFullPath, TempFullPath, *args)
+    os.replace(TempFullPath, OutputFullPath)
+
+
 def CopyFiles(DataNode, OutputDir=None, Move=False, **kwargs):
 
     if OutputDir is None:
@@ -570,21 +620,15 @@ def HTMLFromLogDataNode(DataNode, htmlpaths, MaxImageWidth=None, MaxImageHeight=
 
         LogSrcFullPath = os.path.join(RelPath, DataNode.Path)
 
-        DriftSettleThumbnailFilename = GetTempFileSaltString() + "DriftSettle.png"
-        DriftSettleImgSrcPath = os.path.join(htmlpaths.ThumbnailRelative, DriftSettleThumbnailFilename)
-        DriftSettleThumbnailOutputFullPath = os.path.join(htmlpaths.ThumbnailDir, DriftSettleThumbnailFilename)
-
-        # nfiles.RemoveOutdatedFile(logFilePath, DriftSettleThumbnailOutputFullPath)
-        # if not os.path.exists(DriftSettleThumbnailOutputFullPath):
-        TPool.add_task(DriftSettleThumbnailFilename, serialemlog.PlotDriftSettleTime, logFilePath, DriftSettleThumbnailOutputFullPath)
+        os.makedirs(htmlpaths.ThumbnailDir, exist_ok=True)
 
-        DriftGridThumbnailFilename = GetTempFileSaltString() + "DriftGrid.png"
-        DriftGridImgSrcPath = os.path.join(htmlpaths.ThumbnailRelative, DriftGridThumbnailFilename)
-        DriftGridThumbnailOutputFullPath = os.path.join(htmlpaths.ThumbnailDir, DriftGridThumbnailFilename)
+        (DriftSettleImgSrcPath, DriftSettleThumbnailOutputFullPath, CreateThumbnail) = htmlpaths.CachedThumbnailPaths(logFilePath, "DriftSettle.png")
+        if CreateThumbnail:
+            TPool.add_task(DriftSettleThumbnailOutputFullPath, _WriteThumbnail, serialemlog.PlotDriftSettleTime, logFilePath, DriftSettleThumbnailOutputFullPath)
 
-        # nfiles.RemoveOutdatedFile(logFilePath, DriftGridThumbnailFilename)
-        # if not os.path.exists(DriftGridThumbnailFilename):
-        TPool.add_task(DriftGridThumbnailFilename, serialemlog.PlotDriftGrid, logFilePath, DriftGridThumbnailOutputFullPath)
+        (DriftGridImgSrcPath, DriftGridThumbnailOutputFullPath, CreateThumbnail) = htmlpaths.CachedThumbnailPaths(logFilePath, "DriftGrid.png")
+        if CreateThumbnail:
+            TPool.add_task(DriftGridThumbnailOutputFullPath, _WriteThumbnail, serialemlog.PlotDriftGrid, logFilePath, DriftGridThumbnailOutputFullPath)
 
         # Build a histogram of drift settings
 #        x = []
@@ -662,21 +706,16 @@ def __ScaleImage(ImageNode, HtmlPaths, MaxImageWidth=None, MaxImageHeight=None):
 
         os.makedirs(HtmlPaths.ThumbnailDir, exist_ok=True)
 
-        ThumbnailFilename = GetTempFileSaltString() + ImageNode.Path
-        ImgSrcPath = os.path.join(HtmlPaths.ThumbnailRelative, ThumbnailFilename)
-
-        ThumbnailOutputFullPath = os.path.join(HtmlPaths.ThumbnailDir, ThumbnailFilename)
-
-        # nfiles.RemoveOutdatedFile(ImageNode.FullPath, ThumbnailOutputFullPath)
-        # if not os.path.exists(ThumbnailOutputFullPath):
-        Pool = nornir_pools.GetGlobalThreadPool()
-        Pool.add_task(ImageNode.FullPath, nornir_imageregistration.Shrink, ImageNode.FullPath, ThumbnailOutputFullPath, Scale)
-        #cmd = "magick convert " + ImageNode.FullPath + " -resize " + str(Scale * 100) + "% " + ThumbnailOutputFullPath
-        
-        #Pool.add_process(cmd, cmd + " && exit", shell=True)
-
         Width = int(Width * Scale)
         Height = int(Height * Scale)
+
+        (ImgSrcPath, ThumbnailOutputFullPath, CreateThumbnail) = HtmlPaths.CachedThumbnailPaths(ImageNode.FullPath, os.path.basename(ImageNode.Path), Width, Height)
+        if CreateThumbnail:
+            Pool = nornir_pools.GetGlobalThreadPool()
+            Pool.add_task(ImageNode.FullPath, _WriteThumbnail, nornir_imageregistration.Shrink, ImageNode.FullPath, ThumbnailOutputFullPath, Scale)
+            #cmd = "magick convert " + ImageNode.FullPath + " -resize " + str(Scale * 100) + "% " + ThumbnailOutputFullPath
+            
+            #Pool.add_process(cmd, cmd + " && exit", shell=True)
     else:
         ImgSrcPath = HtmlPaths.GetSubNodeFullPath(ImageNode)
         
@@ -898,6 +937,12 @@ def GenerateTableReport(OutputFile, ReportingElement, RowXPath, RowLabelAttrib=N
     HTML = DictToTable(tableDict)
 
     CreateHTMLDoc(os.path.join(Paths.OutputDir, Paths.OutputFile), HTMLBody=HTML)
+
+    # Thumbnails of sources that changed or are no longer in the report
+    NumRemoved = Paths.RemoveUnusedThumbnails()
+    if NumRemoved > 0 and Logger is not None:
+        Logger.info("Removed %d outdated thumbnails from %s" % (NumRemoved, Paths.ThumbnailDir))
+
     return None
 
 
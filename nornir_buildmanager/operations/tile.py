@@ -6,6 +6,8 @@ Created on May 22, 2012
 
 import copy
 import glob
+import hashlib
+import json
 import logging
 import math
 import os
@@ -13,12 +15,15 @@ import shutil
 import subprocess
 import multiprocessing
 import numpy
+import psutil
 import queue
 from PIL import Image
 
 import nornir_imageregistration
 from nornir_buildmanager.exceptions import NornirUserException
 import nornir_buildmanager.templates 
+import nornir_buildmanager.filesystemsnapshot as filesystemsnapshot
+import nornir_buildmanager.transformheader as transformheader
 from nornir_buildmanager.validation import transforms, image
 from nornir_imageregistration.files import mosaicfile
 from nornir_imageregistration.mosaic import Mosaic
@@ -43,8 +48,17 @@ HistogramTagStr = "HistogramData"
 ContrastMinCutoffDefault = 0.1
 ContrastMaxCutoffDefault = 0.5
 
+# Extension of the file next to a filter's histogram that holds the histogram of each tile
+HistogramPartialsExtension = '.partials.npz'
+
 DefaultImageExtension = '.png'
 
+# Bytes of decoded tiles kept in memory while building tileset levels if no limit is passed
+DefaultPyramidMemory = 1 << 30
+
+# File in each tileset level directory recording the source tiles each tile was built from
+TileSourceIndexFilename = 'TileSources.json'
+
 
 def VerifyImages(TilePyramidNode, **kwargs):
     '''Eliminate any image files which cannot be parsed by Image Magick's identify command'''
@@ -86,7 +100,7 @@ def VerifyTiles(LevelNode=None, **kwargs):
     TileExt = InputPyramidNode.attrib.get('ImageFormatExt', '.png')
 
     TileImageDir = InputLevelNode.FullPath
-    LevelFiles = glob.glob(os.path.join(TileImageDir, '*' + TileExt))
+    LevelFiles = filesystemsnapshot.Glob(TileImageDir, '*' + TileExt)
 
     if(len(LevelFiles) == 0):
         logger.info('No tiles found in level')
@@ -128,11 +142,12 @@ def FilterIsPopulated(InputFilterNode, Downsample, MosaicFullPath, OutputFilterN
     if OutputPyramidNode is None:
         return False
 
-    mFile = mosaicfile.MosaicFile.Load(MosaicFullPath)
-    if mFile is None:
+    # Compare the tile count from the header before paying to parse the transforms
+    header = transformheader.Read(MosaicFullPath)
+    if header is None:
         raise Exception("Unable to load mosaic file: %s" % MosaicFullPath)
     
-    if OutputPyramidNode.NumberOfTiles < mFile.NumberOfImages:
+    if OutputPyramidNode.NumberOfTiles < header.NumberOfImages:
         return False
 
     OutputLevelNode = OutputFilterNode.TilePyramid.GetLevel(Downsample)
@@ -146,6 +161,10 @@ def FilterIsPopulated(InputFilterNode, Downsample, MosaicFullPath, OutputFilterN
     ImageFiles = glob.glob(OutputLevelNode.FullPath + os.sep + '*' + InputPyramidNode.ImageFormatExt)
     basenameImageFiles = list(map(os.path.basename, ImageFiles))
 
+    mFile = mosaicfile.MosaicFile.Load(MosaicFullPath)
+    if mFile is None:
+        raise Exception("Unable to load mosaic file: %s" % MosaicFullPath)
+
     for i in mFile.ImageToTransformString:
         if not i in basenameImageFiles:
             # Don't return false unless the input exists
@@ -819,6 +838,110 @@ def InvertFilter(Parameters, InputFilterNode, OutputFilterName, **kwargs):
     return 
 
 
+def _TileHistogram(ImageFullPath):
+    ''':return: (sorted array of the distinct pixel values in the tile, number of pixels with each value)'''
+    with Image.open(ImageFullPath) as im:
+        pixels = numpy.asarray(im)
+
+    (values, counts) = numpy.unique(pixels, return_counts=True)
+    return (values.astype(numpy.float64), counts.astype(numpy.uint32))
+
+
+def _LoadHistogramPartials(PartialsFullPath):
+    ''':return: Dictionary mapping tile paths relative to the file to ((st_mtime_ns, st_size), values, counts), empty if the file is missing or unreadable'''
+    try:
+        with numpy.load(PartialsFullPath) as data:
+            (Names, Signatures, Offsets, Values, Counts) = (data['Names'], data['Signatures'], data['Offsets'], data['Values'], data['Counts'])
+    except (OSError, KeyError, ValueError):
+        return {}
+
+    Partials = {}
+    for (iTile, name) in enumerate(Names):
+        (start, end) = (Offsets[iTile], Offsets[iTile + 1])
+        Partials[str(name)] = ((int(Signatures[iTile][0]), int(Signatures[iTile][1])), Values[start:end], Counts[start:end])
+
+    return Partials
+
+
+def _SaveHistogramPartials(PartialsFullPath, Partials):
+    Names = sorted(Partials.keys())
+    Signatures = numpy.asarray([Partials[name][0] for name in Names], dtype=numpy.int64).reshape((len(Names), 2))
+    Offsets = numpy.zeros(len(Names) + 1, dtype=numpy.int64)
+    Offsets[1:] = numpy.cumsum([len(Partials[name][1]) for name in Names])
+    Values = numpy.concatenate([Partials[name][1] for name in Names] + [numpy.zeros(0, dtype=numpy.float64)])
+    Counts = numpy.concatenate([Partials[name][2] for name in Names] + [numpy.zeros(0, dtype=numpy.uint32)])
+
+    # numpy appends .npz to names without the extension, so write to a name that already has it
+    TempFullPath = PartialsFullPath + '.tmp.npz'
+    numpy.savez_compressed(TempFullPath, Names=numpy.asarray(Names, dtype=str), Signatures=Signatures, Offsets=Offsets, Values=Values, Counts=Counts)
+    os.replace(TempFullPath, PartialsFullPath)
+
+
+def UpdateHistogramPartials(TileFullPaths, PartialsFullPath, NumBins, Pool=None):
+    '''
+    Histogram a set of tiles in NumBins equal bins from the smallest to the
+    largest pixel value in the set.  The number of pixels with each distinct
+    value in each tile is kept in PartialsFullPath with the modification time
+    and size of the tile.  Only tiles that are new or changed since the file
+    was written are read.  The counts do not depend on the range of the set,
+    so they stay valid when tiles holding the smallest or largest value
+    change or are removed.
+    
+    :param list TileFullPaths: Tiles to include, tiles that do not exist are skipped
+    :param str PartialsFullPath: File the tile histograms are kept in
+    :return: (Array of NumBins counts, minimum value, maximum value, number of tiles read).  The minimum and maximum are None if there are no tiles.
+    '''
+    Partials = _LoadHistogramPartials(PartialsFullPath)
+    PartialsDir = os.path.dirname(PartialsFullPath)
+
+    # One directory listing per level instead of a stat for every tile
+    DirFiles = {}
+    Included = {}
+    TileNameToFullPath = {}
+    for TileFullPath in TileFullPaths:
+        (TileDir, TileFilename) = os.path.split(TileFullPath)
+        if TileDir not in DirFiles:
+            DirFiles[TileDir] = _ListLevelFiles(TileDir)
+
+        stat = DirFiles[TileDir].get(TileFilename, None)
+        if stat is None:
+            prettyoutput.LogErr("Missing tile for histogram: " + TileFullPath)
+            continue
+
+        # Tiles are recorded relative to the file so the volume can be moved
+        TileName = os.path.relpath(TileFullPath, PartialsDir)
+        Included[TileName] = stat
+        TileNameToFullPath[TileName] = TileFullPath
+
+    Outdated = [TileName for (TileName, stat) in Included.items() if TileName not in Partials or Partials[TileName][0] != stat]
+    if len(Outdated) > 0:
+        if Pool is None:
+            Pool = nornir_pools.GetGlobalProcessPool()
+
+        tasks = [Pool.add_task(TileName, _TileHistogram, TileNameToFullPath[TileName]) for TileName in Outdated]
+        for (TileName, task) in zip(Outdated, tasks):
+            (values, counts) = task.wait_return()
+            Partials[TileName] = (Included[TileName], values, counts)
+
+    # Tiles no longer in the set, such as pruned tiles, are dropped from the file
+    Removed = [name for name in Partials if name not in Included]
+    for name in Removed:
+        del Partials[name]
+
+    if len(Outdated) > 0 or len(Removed) > 0 or not os.path.exists(PartialsFullPath):
+        _SaveHistogramPartials(PartialsFullPath, Partials)
+
+    Values = numpy.concatenate([values for (stat, values, counts) in Partials.values()] + [numpy.zeros(0, dtype=numpy.float64)])
+    if len(Values) == 0:
+        return (numpy.zeros(NumBins, dtype=numpy.int64), None, None, len(Outdated))
+
+    Counts = numpy.concatenate([counts for (stat, values, counts) in Partials.values()])
+    (MinVal, MaxVal) = (Values.min(), Values.max())
+    (Bins, edges) = numpy.histogram(Values, bins=NumBins, range=(MinVal, MaxVal), weights=Counts)
+
+    return (numpy.rint(Bins).astype(numpy.int64), MinVal, MaxVal, len(Outdated))
+
+
 def HistogramFilter(Parameters, FilterNode, Downsample, TransformNode, **kwargs):
     '''Construct the intensity histogram for a filter
        @FilterNode'''
@@ -883,7 +1006,15 @@ def HistogramFilter(Parameters, FilterNode, Downsample, TransformNode, **kwargs)
         for k in list(mosaic.ImageToTransformString.keys()):
             fulltilepaths.append(os.path.join(FullTilePath, k))
 
-        histogramObj = nornir_imageregistration.Histogram(fulltilepaths, Bpp=Bpp, numBins=NumBins)
+        PartialsFullPath = os.path.join(os.path.dirname(DataNode.FullPath), HistogramBaseName + HistogramPartialsExtension)
+        (Bins, MinVal, MaxVal, NumRead) = UpdateHistogramPartials(fulltilepaths, PartialsFullPath, NumBins)
+        prettyoutput.Log("Histogram read %d tiles for %d tiles in the mosaic" % (NumRead, len(fulltilepaths)))
+        if MinVal is None:
+            prettyoutput.LogErr("No tiles found for histogram: " + InputMosaicFullPath)
+            return
+
+        histogramObj = Histogram.Init(MinVal, MaxVal, NumBins)
+        histogramObj.Bins = [int(count) for count in Bins]
         histogramObj.Save(DataNode.FullPath)
 
         # Create a data node for the histogram
@@ -1433,7 +1564,6 @@ def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, Til
     tile_dims = numpy.asarray((TileWidth, TileHeight), dtype=numpy.int64)
     
     if max_temp_image_area is None:
-        import psutil 
         memory_data = psutil.virtual_memory()
         bytes_per_pixel = int(2) #We use float16 for each pixel
         num_images_per_tile = int(2) #The assembled image and the distance image
@@ -1484,7 +1614,7 @@ def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, Til
         #OutputXML = os.path.join(LevelOne.FullPath, FilterNode.Name + '.xml')
         
         #pool = nornir_pools.GetGlobalThreadPool()
-        pool = nornir_pools.GetThreadPool("IOPool", num_threads=multiprocessing.cpu_count() * 2)
+        pool = nornir_pools.GetThreadPool("IOPool", num_threads=nornir_buildmanager.templates.Current.NumProcs * 2)
         
         mosaic = nornir_imageregistration.Mosaic.LoadFromMosaicFile(InputTransformNode.FullPath)
         expected_scale = 1.0 / LevelOne.Downsample
@@ -1919,143 +2049,423 @@ def BuildTilesetLevel(SourcePath, DestPath, DestGridDimensions, TileDim, FilePre
     if not Pool is None:
         Pool.wait_completion()
         
-def BuildTilesetLevelWithPillow(SourcePath, DestPath, DestGridDimensions, TileDim, FilePrefix, FilePostfix, Pool=None, **kwargs):
+# Tiles of the source row, the prefetched next row, the rows waiting for their
+# odd partner on each level and the tiles waiting to be written are held at once.
+# The rows waiting on coarser levels together are no larger than one source row.
+_StreamingWindowRows = 5
+
+# Tiles held while one output tile is merged: the double size composite, the
+# quadrant being pasted, the resized image and the array copied from it.
+_StreamingMergeTiles = 7
+
+# Bytes per pixel of the image modes _ReadGridTile returns
+_GridTileModeBytes = {'L' : 1, 'I;16' : 2, 'I' : 4, 'F' : 4}
+
+
+def _GridTileName(FilePrefix, FilePostfix, iX, iY):
+    return nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
+                                                                         'X' : iX,
+                                                                         'Y' : iY,
+                                                                         'postfix' : FilePostfix }
+
+
+def _GridTileFullPath(LevelPath, FilePrefix, FilePostfix, iX, iY):
+    return os.path.join(LevelPath, _GridTileName(FilePrefix, FilePostfix, iX, iY))
+
+
+def _ReadGridTile(FullPath):
+    ''':return: Image data of the tile or None if the tile does not exist'''
+    if not os.path.exists(FullPath):
+        return None
+
+    with Image.open(FullPath) as im:
+        if im.mode not in ('L', 'I;16', 'I', 'F'):
+            im = im.convert('L')
+
+        return numpy.array(im)
+
+
+def _WriteGridTile(image, FullPath):
+    Image.fromarray(image).save(FullPath)
+
+
+def _ShrinkQuadrants(TileDim, TopLeft, TopRight, BottomLeft, BottomRight):
     '''
-    :param tuple SourceGridDimensions: (GridDimY,GridDimX) Number of tiles along each axis
+    Merge up to four adjacent tiles and shrink the result by a factor of two
+    to the size of one tile.  Missing tiles are black.  The tiles are pasted
+    into a composite image and resized with the Lanczos filter, as
+    tileset_functions.CreateOneTilesetTileWithPillow does for tiles on disk.
     :param ndarray TileDim: Dimensions of tile (Y,X)
-    
+    :return: Merged tile or None if all four tiles are missing
     '''
-    
-    os.makedirs(DestPath, exist_ok=True)
-        
-    if Pool is None:
-        #Pool = nornir_pools.GetMultithreadingPool("IOPool", num_threads=multiprocessing.cpu_count() * 16)
-        #Pool = nornir_pools.GetGlobalMultithreadingPool()
-        #Pool = nornir_pools.GetGlobalThreadPool()
-        Pool = nornir_pools.GetThreadPool("IOPool", num_threads=multiprocessing.cpu_count() * 2)
-        #Pool = nornir_pools.GetGlobalSerialPool()
+    Quadrants = ((TopLeft, 0, 0), (TopRight, 0, 1), (BottomLeft, 1, 0), (BottomRight, 1, 1))
+    mode = None
+    for (tile, iY, iX) in Quadrants:
+        if tile is not None:
+            mode = Image.fromarray(tile[0:1, 0:1]).mode
+            break
 
-    # Merge all the tiles we can find into tiles of the same size
-    
-    #tile_params = []
-     
-    for iY in range(0, DestGridDimensions[0]):
+    if mode is None:
+        return None
+
+    (YDim, XDim) = (int(TileDim[0]), int(TileDim[1]))
+    composite = Image.new(mode, (XDim * 2, YDim * 2))
+    for (tile, iY, iX) in Quadrants:
+        if tile is None:
+            continue
+
+        (height, width) = (min(tile.shape[0], YDim), min(tile.shape[1], XDim))
+        composite.paste(Image.fromarray(tile[0:height, 0:width]), (iX * XDim, iY * YDim))
+
+    return numpy.array(composite.resize((XDim, YDim), resample=Image.LANCZOS))
 
-        '''We wait for the last task we queued for each row so we do not swamp the ProcessPool but are not waiting for the entire pool to empty'''
-        FirstTaskForRow = None
 
+def _ShrinkGridDimensions(GridDimensions):
+    ''':return: (GridDimY,GridDimX) of the level built from a level with GridDimensions'''
+    return (int(math.ceil(GridDimensions[0] / 2.0)), int(math.ceil(GridDimensions[1] / 2.0)))
+
+
+def _ListLevelFiles(LevelPath):
+    ''':return: Dictionary mapping the name of each file in the level directory to (st_mtime_ns, st_size)'''
+    files = {}
+    try:
+        with os.scandir(LevelPath) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        pass
+
+    return files
+
+
+def _TileSourceSignatures(SourceFiles, SourceGridDimensions, FilePrefix, FilePostfix):
+    '''
+    :param dict SourceFiles: Files of the source level from _ListLevelFiles
+    :return: Dictionary mapping the name of each tile of the next level that has at
+             least one source tile to (iX, iY, signature of the source tiles)
+    '''
+    DestGridDimensions = _ShrinkGridDimensions(SourceGridDimensions)
+    Signatures = {}
+    for iY in range(0, DestGridDimensions[0]):
         for iX in range(0, DestGridDimensions[1]):
+            parts = []
+            for (dY, dX) in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                name = _GridTileName(FilePrefix, FilePostfix, (iX * 2) + dX, (iY * 2) + dY)
+                stat = SourceFiles.get(name, None)
+                if stat is not None:
+                    parts.append('%s:%d:%d' % (name, stat[0], stat[1]))
+
+            if len(parts) == 0:
+                continue
+
+            sig = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()[0:16]
+            Signatures[_GridTileName(FilePrefix, FilePostfix, iX, iY)] = (iX, iY, sig)
+
+    return Signatures
+
+
+def _LoadTileSourceIndex(LevelPath):
+    ''':return: Dictionary mapping tile names to the signature of the source tiles they were built from, or None if the level has no index'''
+    try:
+        with open(os.path.join(LevelPath, TileSourceIndexFilename), 'r') as hFile:
+            return json.load(hFile)
+    except (OSError, ValueError):
+        return None
+
+
+def _SaveTileSourceIndex(LevelPath, Index):
+    FullPath = os.path.join(LevelPath, TileSourceIndexFilename)
+    TempFullPath = FullPath + '.tmp'
+    with open(TempFullPath, 'w') as hFile:
+        json.dump(Index, hFile, separators=(',', ':'), sort_keys=True)
+
+    os.replace(TempFullPath, FullPath)
+
+
+def _UpdateGridTile(TileDim, SourcePath, DestPath, iX, iY, FilePrefix, FilePostfix):
+    '''Rebuild one tile from the four tiles of the level below, removing it if none of them exist'''
+    Quadrants = [_ReadGridTile(_GridTileFullPath(SourcePath, FilePrefix, FilePostfix, (iX * 2) + dX, (iY * 2) + dY)) for (dY, dX) in ((0, 0), (0, 1), (1, 0), (1, 1))]
+    tile = _ShrinkQuadrants(TileDim, *Quadrants)
+    OutputFileFullPath = _GridTileFullPath(DestPath, FilePrefix, FilePostfix, iX, iY)
+    if tile is None:
+        if os.path.exists(OutputFileFullPath):
+            os.remove(OutputFileFullPath)
+    else:
+        _WriteGridTile(tile, OutputFileFullPath)
+
+
+def UpdateTilesetLevel(SourcePath, SourceGridDimensions, DestPath, TileDim, FilePrefix, FilePostfix, Pool=None, **kwargs):
+    '''
+    Rebuild the tiles of an existing level whose source tiles changed since the
+    level was built.  Each level directory holds an index of the modification
+    time and size of the source tiles each tile was built from.  Levels built
+    before the index existed are assumed to be current and the index is created.
+    
+    :param tuple SourceGridDimensions: (GridDimY,GridDimX) Number of tiles along each axis of the source level
+    :param ndarray TileDim: Dimensions of tile (Y,X)
+    :return: Number of tiles rebuilt or removed
+    '''
+    Signatures = _TileSourceSignatures(_ListLevelFiles(SourcePath), SourceGridDimensions, FilePrefix, FilePostfix)
+    Index = {name: sig for (name, (iX, iY, sig)) in Signatures.items()}
+
+    Recorded = _LoadTileSourceIndex(DestPath)
+    if Recorded is None:
+        _SaveTileSourceIndex(DestPath, Index)
+        return 0
+
+    DestFiles = _ListLevelFiles(DestPath)
+    Outdated = [(iX, iY) for (name, (iX, iY, sig)) in Signatures.items() if Recorded.get(name, None) != sig or name not in DestFiles]
+
+    # Tiles whose source tiles were all removed
+    Removed = [name for name in Recorded if name not in Signatures and name in DestFiles]
+
+    if len(Outdated) > 0:
+        if Pool is None:
+            Pool = nornir_pools.GetThreadPool("IOPool", num_threads=nornir_buildmanager.templates.Current.NumProcs * 2)
+
+        tasks = [Pool.add_task(str((iX, iY)), _UpdateGridTile, TileDim, SourcePath, DestPath, iX, iY, FilePrefix, FilePostfix) for (iX, iY) in Outdated]
+        for task in tasks:
+            task.wait()
+
+    for name in Removed:
+        os.remove(os.path.join(DestPath, name))
+
+    if len(Outdated) > 0 or len(Removed) > 0 or Recorded != Index:
+        _SaveTileSourceIndex(DestPath, Index)
 
+    return len(Outdated) + len(Removed)
+
+
+class _StreamingPyramidLevel(object):
+    '''
+    Writes the tiles of one level in a column band of a streaming pyramid build.
+    Rows of the level below arrive in order.  Even rows are kept until the odd
+    row arrives, then both are merged into a row of this level.
+    '''
+
+    def __init__(self, LevelPath, FirstColumn, TileDim, FilePrefix, FilePostfix, Pool):
+        self.LevelPath = LevelPath
+        self.FirstColumn = FirstColumn
+        self.TileDim = TileDim
+        self.FilePrefix = FilePrefix
+        self.FilePostfix = FilePostfix
+        self.Pool = Pool
+
+        self._PendingRow = None
+        self._NextRowY = 0
+        self._WriteTasks = []
+
+    def AddSourceRow(self, Row):
+        '''
+        :param list Row: Tiles of the level below, None where a tile is missing
+        :return: The row of this level when Row completes it, otherwise None
+        '''
+        if self._PendingRow is None:
+            self._PendingRow = Row
+            return None
+
+        Top = self._PendingRow
+        self._PendingRow = None
+        return self._WriteRow(Top, Row)
+
+    def Flush(self):
+        ''':return: The last row of this level if the level below had an odd number of rows, otherwise None'''
+        if self._PendingRow is None:
+            return None
+
+        Top = self._PendingRow
+        self._PendingRow = None
+        return self._WriteRow(Top, [None] * len(Top))
+
+    def WaitForWrites(self):
+        for task in self._WriteTasks:
+            task.wait()  # We do this to ensure any exceptions are raised
+
+        self._WriteTasks = []
+
+    def _WriteRow(self, Top, Bottom):
+        iY = self._NextRowY
+        self._NextRowY = self._NextRowY + 1
+
+        # Only one row of each level waits to be written
+        self.WaitForWrites()
+
+        NumColumns = (len(Top) + 1) // 2
+        Output = []
+        for iX in range(0, NumColumns):
             X1 = iX * 2
             X2 = X1 + 1
-            Y1 = iY * 2
-            Y2 = Y1 + 1
+            tile = _ShrinkQuadrants(self.TileDim,
+                                    Top[X1], Top[X2] if X2 < len(Top) else None,
+                                    Bottom[X1], Bottom[X2] if X2 < len(Bottom) else None)
+            Output.append(tile)
+            if tile is None:
+                continue
 
-            # OutputFile = FilePrefix + 'X' + nornir_buildmanager.templates.GridTileCoordFormat % iX + '_Y' + nornir_buildmanager.templates.GridTileCoordFormat % iY + FilePostfix
-            OutputFile = nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
-                                                 'X' : iX,
-                                                 'Y' : iY,
-                                                 'postfix' : FilePostfix }
+            OutputFileFullPath = _GridTileFullPath(self.LevelPath, self.FilePrefix, self.FilePostfix, self.FirstColumn + iX, iY)
+            self._WriteTasks.append(self.Pool.add_task(OutputFileFullPath, _WriteGridTile, tile, OutputFileFullPath))
 
-            OutputFileFullPath = os.path.join(DestPath, OutputFile)
+        return Output
 
-            # Skip if file already exists
-            # if(os.path.exists(OutputFileFullPath)):
-            #    continue
 
-            # TopLeft = FilePrefix + 'X' + nornir_buildmanager.templates.GridTileCoordFormat % X1 + '_Y' + nornir_buildmanager.templates.GridTileCoordFormat % Y1 + FilePostfix
-            # TopRight = FilePrefix + 'X' + nornir_buildmanager.templates.GridTileCoordFormat % X2 + '_Y' + nornir_buildmanager.templates.GridTileCoordFormat % Y1 + FilePostfix
-            # BottomLeft = FilePrefix + 'X' + nornir_buildmanager.templates.GridTileCoordFormat % X1 + '_Y' + nornir_buildmanager.templates.GridTileCoordFormat % Y2 + FilePostfix
-            # BottomRight = FilePrefix + 'X' + nornir_buildmanager.templates.GridTileCoordFormat % X2 + '_Y' + nornir_buildmanager.templates.GridTileCoordFormat % Y2 + FilePostfix
-            TopLeft = nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
-                                                 'X' : X1,
-                                                 'Y' : Y1,
-                                                 'postfix' : FilePostfix }
-            TopRight = nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
-                                                 'X' : X2,
-                                                 'Y' : Y1,
-                                                 'postfix' : FilePostfix }
-            BottomLeft = nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
-                                                 'X' : X1,
-                                                 'Y' : Y2,
-                                                 'postfix' : FilePostfix }
-            BottomRight = nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
-                                                 'X' : X2,
-                                                 'Y' : Y2,
-                                                 'postfix' : FilePostfix }
+def _GridTileBytesPerPixel(SourcePath, FilePrefix, FilePostfix):
+    ''':return: Bytes per pixel of the first tile found in the level, read from the image header.  2 if the level has no tiles.'''
+    try:
+        with os.scandir(SourcePath) as it:
+            for entry in it:
+                if not (entry.name.startswith(FilePrefix) and entry.name.endswith(FilePostfix)):
+                    continue
 
-            TopLeft = os.path.join(SourcePath, TopLeft)
-            TopRight = os.path.join(SourcePath, TopRight)
-            BottomLeft = os.path.join(SourcePath, BottomLeft)
-            BottomRight = os.path.join(SourcePath, BottomRight)
-            
-#             tile_params.append([TileDim,
-#                            TopLeft, TopRight,
-#                            BottomLeft, BottomRight,
-#                            OutputFileFullPath])
-
-            #task = Pool.add_task(OutputFileFullPath, tileset_functions.CreateOneTilesetTileWithPillow, TileDim,
-            task = Pool.add_task(OutputFileFullPath, tileset_functions.CreateOneTilesetTileWithPillowOverNetwork, TileDim,
-                            TopLeft=TopLeft, TopRight=TopRight,
-                            BottomLeft=BottomLeft, BottomRight=BottomRight,
-                            OutputFileFullPath=OutputFileFullPath)
-            
-            if FirstTaskForRow is None:
-                FirstTaskForRow = task
-                
-    #Pool.starmap_async(name=DestPath, func=tileset_functions.CreateOneTilesetTileWithPillow, iterable=tile_params)
+                try:
+                    with Image.open(entry.path) as im:
+                        return _GridTileModeBytes.get(im.mode, 1)
+                except (OSError, ValueError):
+                    continue
+    except FileNotFoundError:
+        pass
 
-        # TaskString = "Building tiles for downsample %g" % NextLevelNode.Downsample
-        # prettyoutput.CurseProgress(TaskString, iY + 1, newYDim)
+    return 2
 
-        # We can easily saturate the pool with hundreds of thousands of tasks.
-        # If the pool has a reasonable number of tasks then we should wait for
-        # a task from a row to complete before queueing more.
-#             if hasattr(Pool, 'num_active_tasks'):
-#                 if Pool.num_active_tasks > 2048:#multiprocessing.cpu_count() * 8:
-#                     FirstTaskForRow.wait()
-#                     FirstTaskForRow = None
-#         elif hasattr(Pool, 'tasks') and isinstance(Pool.tasks, queue.Queue):
-#             if Pool.num_active_tasks > multiprocessing.cpu_count() * 8:
-#                 FirstTaskForRow.wait()
-#                 FirstTaskForRow = None
-#         elif hasattr(Pool, 'ActiveTasks'):
-#             if Pool.num_active_tasks > multiprocessing.cpu_count() * 8:
-#                 FirstTaskForRow.wait()
-#                 FirstTaskForRow = None 
-
-        #prettyoutput.Log("\nBeginning Row %d of %d" % (iY + 1, DestGridDimensions[0]))
 
-    if not Pool is None:
-        Pool.wait_completion() 
-        #Pool.shutdown()
+def _StreamingPassSize(NumLevels, SourceGridDimX, TileDim, MaxMemory, BytesPerPixel=1):
+    '''
+    :param int BytesPerPixel: Bytes per pixel of the decoded tiles
+    :return: (Number of levels to build from the source level in one pass, width in source tiles of each column band)
+    '''
+    TileBytes = int(TileDim[0]) * int(TileDim[1]) * int(BytesPerPixel)
+    RowMemory = MaxMemory - (TileBytes * _StreamingMergeTiles)
+    MaxBandWidth = max(1, int(RowMemory // (TileBytes * _StreamingWindowRows)))
+
+    # A band must contain whole tiles of the coarsest level built from it
+    PassLevels = NumLevels
+    while PassLevels > 1 and (1 << PassLevels) > MaxBandWidth:
+        PassLevels = PassLevels - 1
+
+    Alignment = 1 << PassLevels
+    BandWidth = max(Alignment, (MaxBandWidth // Alignment) * Alignment)
+    BandWidth = min(BandWidth, int(math.ceil(SourceGridDimX / float(Alignment))) * Alignment)
+    return (PassLevels, BandWidth)
+
+
+def _ReadGridTileRow(SourcePath, iY, FirstColumn, EndColumn, FilePrefix, FilePostfix, Pool):
+    ''':return: List of tasks reading the tiles of a row'''
+    return [Pool.add_task(str(iX), _ReadGridTile, _GridTileFullPath(SourcePath, FilePrefix, FilePostfix, iX, iY)) for iX in range(FirstColumn, EndColumn)]
+
+
+def _BuildTilesetBand(SourcePath, SourceGridDimensions, LevelPaths, FirstColumn, EndColumn, TileDim, FilePrefix, FilePostfix, Pool):
+    '''Build the levels for the source columns FirstColumn to EndColumn, reading each source tile once'''
+    Levels = [_StreamingPyramidLevel(path, FirstColumn >> (iLevel + 1), TileDim, FilePrefix, FilePostfix, Pool) for (iLevel, path) in enumerate(LevelPaths)]
+
+    def Cascade(iLevel, Row):
+        while Row is not None and iLevel < len(Levels):
+            Row = Levels[iLevel].AddSourceRow(Row)
+            iLevel = iLevel + 1
+
+    NextRowTasks = _ReadGridTileRow(SourcePath, 0, FirstColumn, EndColumn, FilePrefix, FilePostfix, Pool)
+    for iY in range(0, SourceGridDimensions[0]):
+        RowTasks = NextRowTasks
+        if iY + 1 < SourceGridDimensions[0]:
+            NextRowTasks = _ReadGridTileRow(SourcePath, iY + 1, FirstColumn, EndColumn, FilePrefix, FilePostfix, Pool)
+
+        Cascade(0, [task.wait_return() for task in RowTasks])
+
+    # Levels with an odd number of rows in the level below still hold their last row
+    for iLevel in range(0, len(Levels)):
+        Cascade(iLevel + 1, Levels[iLevel].Flush())
+
+    for level in Levels:
+        level.WaitForWrites()
+
+
+def BuildTilesetLevelsStreaming(SourcePath, SourceGridDimensions, DestPaths, TileDim, FilePrefix, FilePostfix, MaxMemory=None, Pool=None, **kwargs):
+    '''
+    Build several levels of a tileset, each downsampled by two from the previous,
+    while reading the source level once.  Rows of the source level are decoded in
+    order and each row of a new level is passed to the next level in memory
+    instead of being read back from disk.  When the rows of a wide level do not
+    fit in MaxMemory the level is divided into column bands, and when a band
+    cannot contain whole tiles of the coarsest level the remaining levels are
+    built in another pass reading the last level written.
+    
+    :param tuple SourceGridDimensions: (GridDimY,GridDimX) Number of tiles along each axis of the source level
+    :param list DestPaths: Directories of the levels to build in order of increasing downsample
+    :param ndarray TileDim: Dimensions of tile (Y,X)
+    :param int MaxMemory: Approximate number of bytes of decoded tiles to keep in memory
+    '''
+    if MaxMemory is None:
+        MaxMemory = DefaultPyramidMemory
+
+    for path in DestPaths:
+        os.makedirs(path, exist_ok=True)
+
+    if Pool is None:
+        Pool = nornir_pools.GetThreadPool("IOPool", num_threads=nornir_buildmanager.templates.Current.NumProcs * 2)
+
+    SourceGridDimensions = (int(SourceGridDimensions[0]), int(SourceGridDimensions[1]))
+    (FirstSourcePath, FirstSourceGridDimensions) = (SourcePath, SourceGridDimensions)
+
+    BytesPerPixel = _GridTileBytesPerPixel(SourcePath, FilePrefix, FilePostfix)
+
+    iLevel = 0
+    while iLevel < len(DestPaths):
+        (NumLevels, BandWidth) = _StreamingPassSize(len(DestPaths) - iLevel, SourceGridDimensions[1], TileDim, MaxMemory, BytesPerPixel)
+        LevelPaths = DestPaths[iLevel:iLevel + NumLevels]
+
+        for FirstColumn in range(0, SourceGridDimensions[1], BandWidth):
+            EndColumn = min(FirstColumn + BandWidth, SourceGridDimensions[1])
+            _BuildTilesetBand(SourcePath, SourceGridDimensions, LevelPaths, FirstColumn, EndColumn, TileDim, FilePrefix, FilePostfix, Pool)
+
+        prettyoutput.Log("\nBuilt %d tileset levels from %s" % (NumLevels, SourcePath))
+
+        SourcePath = LevelPaths[-1]
+        Scale = 1 << NumLevels
+        SourceGridDimensions = (int(math.ceil(SourceGridDimensions[0] / float(Scale))), int(math.ceil(SourceGridDimensions[1] / float(Scale))))
+        iLevel = iLevel + NumLevels
+
+    # Record the source tiles each level was built from so later builds can update only what changed
+    LevelSourceGridDimensions = FirstSourceGridDimensions
+    for (LevelSourcePath, DestPath) in zip([FirstSourcePath] + DestPaths[:-1], DestPaths):
+        Signatures = _TileSourceSignatures(_ListLevelFiles(LevelSourcePath), LevelSourceGridDimensions, FilePrefix, FilePostfix)
+        _SaveTileSourceIndex(DestPath, {name: sig for (name, (iX, iY, sig)) in Signatures.items()})
+        LevelSourceGridDimensions = _ShrinkGridDimensions(LevelSourceGridDimensions)
 
 
 # OK, now build/check the remaining levels of the tile pyramids
-def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, **kwargs):
-    '''@TileSetNode'''
+def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, max_pyramid_memory=None, **kwargs):
+    '''@TileSetNode
+    :param float max_pyramid_memory: Bytes of decoded tiles to keep in memory while building levels.  Defaults to a quarter of available memory.
+    '''
     
     MinResolutionLevel = TileSetNode.MinResLevel
 
     temp_level_paths = [tileset_functions.GetTempDirForLevelDir(MinResolutionLevel.FullPath)] #Paths to levels we generate to ensure temp directories are cleaned later
     
-    while not MinResolutionLevel is None:
+    # Walk up from the full resolution level so tiles of existing levels whose
+    # source tiles changed are rebuilt.  Missing levels are all built from
+    # SourceLevel in one pass.
+    Level = TileSetNode.MaxResLevel
+    SourceLevel = Level
+    BuildLevels = []
+    
+    while not Level is None:
         
         # The grid attributes are missing if the meta-data was created but there are no tiles
-        if not (hasattr(MinResolutionLevel, 'GridDimX') and hasattr(MinResolutionLevel, 'GridDimY')):
+        if not (hasattr(Level, 'GridDimX') and hasattr(Level, 'GridDimY')):
             prettyoutput.Log("Tileset incomplete: " + TileSetNode.FullPath)
             break 
             
         # If the tileset is already a single tile, then do not downsample
-        if(MinResolutionLevel.GridDimX == 1 and MinResolutionLevel.GridDimY == 1):
+        if(Level.GridDimX == 1 and Level.GridDimY == 1):
             break
         
-        if HighestDownsample is not None and (MinResolutionLevel.Downsample >= float(HighestDownsample)):
+        if HighestDownsample is not None and (Level.Downsample >= float(HighestDownsample)):
             break
 
         ShrinkFactor = 0.5
-        newYDim = float(MinResolutionLevel.GridDimY) * ShrinkFactor
-        newXDim = float(MinResolutionLevel.GridDimX) * ShrinkFactor
+        newYDim = float(Level.GridDimY) * ShrinkFactor
+        newXDim = float(Level.GridDimX) * ShrinkFactor
     
         newXDim = int(math.ceil(newXDim))
         newYDim = int(math.ceil(newYDim))
@@ -2064,8 +2474,7 @@ def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, **kwargs
         if(newXDim == 1 and newYDim == 1):
             break
     
-        # Need to call ir-assemble
-        NextLevelNode = nb.VolumeManager.LevelNode.Create(MinResolutionLevel.Downsample * 2)
+        NextLevelNode = nb.VolumeManager.LevelNode.Create(Level.Downsample * 2)
         [added, NextLevelNode] = TileSetNode.UpdateOrAddChildByAttrib(NextLevelNode, 'Downsample')
         NextLevelNode.GridDimX = newXDim
         NextLevelNode.GridDimY = newYDim
@@ -2073,23 +2482,43 @@ def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, **kwargs
             yield TileSetNode
     
         # Check to make sure the level hasn't already been generated and we've just missed the
-        [Valid, Reason] = NextLevelNode.IsValid()
-        if not Valid:
-            temp_level_paths.append(NextLevelNode.FullPath)
-            # XMLOutput = os.path.join(NextLevelNode, os.path.basename(XmlFilePath))
-            BuildTilesetLevelWithPillow(MinResolutionLevel.FullPath, NextLevelNode.FullPath,
-                               DestGridDimensions=(newYDim, newXDim),
-                               TileDim=(TileSetNode.TileYDim, TileSetNode.TileXDim),
-                               FilePrefix=TileSetNode.FilePrefix,
-                               FilePostfix=TileSetNode.FilePostfix,
-                               Pool=Pool)
-            # This was a lot of work, make sure it is saved before queueing the next level
-            yield TileSetNode
-            prettyoutput.Log("\nTileset level %d completed" % NextLevelNode.Downsample)
+        # meta-data.  Once one level is missing every coarser level is rebuilt from it.
+        if len(BuildLevels) == 0 and NextLevelNode.IsValid()[0]:
+            NumUpdated = UpdateTilesetLevel(SourceLevel.FullPath,
+                                            SourceGridDimensions=(SourceLevel.GridDimY, SourceLevel.GridDimX),
+                                            DestPath=NextLevelNode.FullPath,
+                                            TileDim=(TileSetNode.TileYDim, TileSetNode.TileXDim),
+                                            FilePrefix=TileSetNode.FilePrefix,
+                                            FilePostfix=TileSetNode.FilePostfix,
+                                            Pool=Pool)
+            if NumUpdated > 0:
+                prettyoutput.Log("Updated %d tiles of tileset level %d" % (NumUpdated, NextLevelNode.Downsample))
+            else:
+                logging.info("Level was already generated " + str(TileSetNode))
+                
+            SourceLevel = NextLevelNode
         else:
-            logging.info("Level was already generated " + str(TileSetNode))
+            BuildLevels.append(NextLevelNode)
     
-        MinResolutionLevel = TileSetNode.MinResLevel
+        Level = NextLevelNode
+        
+    if len(BuildLevels) > 0:
+        temp_level_paths.extend([level.FullPath for level in BuildLevels])
+        
+        if max_pyramid_memory is None:
+            max_pyramid_memory = psutil.virtual_memory().available / 4
+        
+        BuildTilesetLevelsStreaming(SourceLevel.FullPath,
+                                    SourceGridDimensions=(SourceLevel.GridDimY, SourceLevel.GridDimX),
+                                    DestPaths=[level.FullPath for level in BuildLevels],
+                                    TileDim=(TileSetNode.TileYDim, TileSetNode.TileXDim),
+                                    FilePrefix=TileSetNode.FilePrefix,
+                                    FilePostfix=TileSetNode.FilePostfix,
+                                    MaxMemory=max_pyramid_memory,
+                                    Pool=Pool)
+        # This was a lot of work, make sure it is saved
+        yield TileSetNode
+        prettyoutput.Log("\nTileset levels %s completed" % ', '.join(['%d' % level.Downsample for level in BuildLevels]))
         
     tileset_functions.ClearTempDirectories(temp_level_paths)
     return
@@ -6,9 +6,13 @@ Created on Jul 3, 2012
 
 import copy
 import functools
+import hashlib
 import os
+import pickle
 
 import nornir_buildmanager.VolumeManagerETree
+import nornir_buildmanager.transformheader as transformheader
+import nornir_buildmanager.validationcache as validationcache
 from nornir_imageregistration.files import *
 from nornir_shared.files import RecurseSubdirectories
 import nornir_shared.prettyoutput as prettyoutput
@@ -17,6 +21,12 @@ import nornir_pools
 
 ECLIPSE = 'ECLIPSE' in os.environ
 
+# Section elements from the previous export are stored in this file in the volume directory
+SectionFragmentCacheFilename = 'VikingXMLSections.cache'
+
+# Increment if the elements written for a section change so cached fragments are rebuilt
+SectionFragmentFormatVersion = 1
+
 def CreateXMLIndex(path, server=None):
 
     VolumeXMLDirs = RecurseSubdirectories(Path=path, RequiredFiles='Volume.xml')
@@ -53,18 +63,14 @@ def CreateVikingXML(StosMapName=None, StosGroupName=None, OutputFile=None, Host=
     if units_of_measure is not None:
         AddScaleData(OutputVolumeNode, units_of_measure, units_per_pixel)
 
-    ParseSections(InputVolumeNode, OutputVolumeNode)
-
-    RemoveDuplicateScaleEntries(OutputVolumeNode, units_of_measure, units_per_pixel)
+    # Sections are the bulk of the document.  Only sections that changed since the last export are
+    # generated again, the rest are copied from the fragment cache as serialized XML.
+    SectionFragments = ParseSectionFragments(InputVolumeNode, path, units_of_measure, units_per_pixel)
+    OutputVolumeNode.attrib['num_sections'] = str(len(SectionFragments))
 
     ParseStos(InputVolumeNode, OutputVolumeNode, StosMapName, StosGroupName)
 
-    OutputXML = ETree.tostring(OutputVolumeNode).decode('utf-8')
-    # prettyoutput.Log(OutputXML)
-
-    hFile = open(OutputXMLFilename, 'w')
-    hFile.write(OutputXML)
-    hFile.close()
+    WriteVikingXML(OutputXMLFilename, OutputVolumeNode, SectionFragments)
 
     # Walk down to the path from the root directory, merging about.xml's as we go
     Url = RecursiveMergeAboutXML(path, OutputXMLFilename)
@@ -227,41 +233,174 @@ def ParseStos(InputVolumeNode, OutputVolumeNode, StosMapName, StosGroupName):
     OutputVolumeNode.attrib["num_stos"] = '%g' % num_stos
 
 
-def ParseSections(InputVolumeNode, OutputVolumeNode):
+def _StartTag(Element):
+    ''':return: The serialized start tag of the element'''
+    EmptyElement = ETree.Element(Element.tag, Element.attrib)
+    EndTag = '</%s>' % Element.tag
+    return ETree.tostring(EmptyElement, encoding='unicode', short_empty_elements=False)[:-len(EndTag)]
+
+
+def WriteVikingXML(OutputXMLFilename, OutputVolumeNode, SectionFragments):
+    '''
+    Write the volume element with the section fragments inserted after the volume's
+    scale element and before the slice-to-slice transforms, without building the document in memory.
+    :param list SectionFragments: Serialized Section elements
+    '''
+    with open(OutputXMLFilename, 'w') as hFile:
+        hFile.write(_StartTag(OutputVolumeNode))
+
+        ChildNodes = list(OutputVolumeNode)
+        for child in ChildNodes:
+            if child.tag == 'Scale':
+                hFile.write(ETree.tostring(child, encoding='unicode'))
+
+        for fragment in SectionFragments:
+            hFile.write(fragment)
+
+        for child in ChildNodes:
+            if child.tag != 'Scale':
+                hFile.write(ETree.tostring(child, encoding='unicode'))
+
+        hFile.write('</%s>' % OutputVolumeNode.tag)
+
+
+def _LoadSectionFragmentCache(VolumePath):
+    ''':return: Dictionary mapping section keys to (fingerprint, fragment), empty if the cache is missing or unreadable'''
+    CacheFullPath = os.path.join(VolumePath, SectionFragmentCacheFilename)
+    if not os.path.exists(CacheFullPath):
+        return {}
+
+    try:
+        with open(CacheFullPath, 'rb') as hFile:
+            (version, entries) = pickle.load(hFile)
+    except Exception as e:
+        prettyoutput.Log("Ignoring unreadable section fragment cache %s\n%s" % (CacheFullPath, str(e)))
+        return {}
+
+    if version != SectionFragmentFormatVersion:
+        return {}
+
+    return entries
+
+
+def _SaveSectionFragmentCache(VolumePath, entries):
+    CacheFullPath = os.path.join(VolumePath, SectionFragmentCacheFilename)
+    TempFullPath = CacheFullPath + '.tmp'
+    try:
+        with open(TempFullPath, 'wb') as hFile:
+            pickle.dump((SectionFragmentFormatVersion, entries), hFile, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(TempFullPath, CacheFullPath)
+    except OSError as e:
+        prettyoutput.LogErr("Could not save section fragment cache %s\n%s" % (CacheFullPath, str(e)))
+
+
+def _AddVolumeDataToFingerprint(DirFullPath, md5):
+    '''
+    Add the VolumeData.xml in the directory, the VolumeData.xml files of its linked child
+    elements, and the size and modification time of the transform files it lists to the digest.
+    '''
+    XMLFullPath = os.path.join(DirFullPath, 'VolumeData.xml')
+
+    # The digest and links of an unchanged VolumeData.xml are kept in the validation cache
+    entry = validationcache.Get(XMLFullPath, 'VikingXMLFingerprint')
+    if entry is None:
+        try:
+            with open(XMLFullPath, 'rb') as hFile:
+                data = hFile.read()
+        except OSError:
+            md5.update(('missing ' + XMLFullPath).encode('utf-8'))
+            return
+
+        root = ETree.fromstring(data)
+        LinkPaths = [c.attrib.get('Path', '') for c in root if c.tag.endswith('_Link')]
+        TransformPaths = [c.attrib.get('Path', '') for c in root if c.tag == 'Transform']
+        entry = (hashlib.md5(data).hexdigest(), LinkPaths, TransformPaths)
+        validationcache.Set(XMLFullPath, 'VikingXMLFingerprint', entry)
+
+    (Digest, LinkPaths, TransformPaths) = entry
+    md5.update(Digest.encode('utf-8'))
+
+    for TransformPath in TransformPaths:
+        try:
+            stats = os.stat(os.path.join(DirFullPath, TransformPath))
+            md5.update(('%s %d %d' % (TransformPath, stats.st_size, stats.st_mtime_ns)).encode('utf-8'))
+        except OSError:
+            md5.update(('missing ' + TransformPath).encode('utf-8'))
+
+    for LinkPath in LinkPaths:
+        _AddVolumeDataToFingerprint(os.path.join(DirFullPath, LinkPath), md5)
+
+
+def SectionFingerprint(BlockPath, SectionNode, units_of_measure, units_per_pixel):
+    '''
+    :return: A digest of everything the section's fragment is generated from, or None if the
+             section has changes that are not saved to disk and must be generated from memory
+    '''
+    if SectionNode.IsDirty or SectionNode.__dict__.get('_DirtyDescendants', False):
+        return None
+
+    md5 = hashlib.md5()
+    md5.update(('%d %s %s %s\n' % (SectionFragmentFormatVersion, BlockPath, units_of_measure, units_per_pixel)).encode('utf-8'))
+    _AddVolumeDataToFingerprint(SectionNode.FullPath, md5)
+    return md5.hexdigest()
+
+
+def _SectionFragment(BlockPath, SectionNode, units_of_measure, units_per_pixel, CachedEntry):
+    ''':return: (fingerprint, serialized Section element, True if the fragment was generated)'''
+    fingerprint = SectionFingerprint(BlockPath, SectionNode, units_of_measure, units_per_pixel)
+    if fingerprint is not None and CachedEntry is not None and CachedEntry[0] == fingerprint:
+        return (fingerprint, CachedEntry[1], False)
 
-    # Find all of the section tags
+    OutputSectionNode = ParseSection(BlockPath, SectionNode)
+    RemoveDuplicateScaleEntries(OutputSectionNode, units_of_measure, units_per_pixel)
+    return (fingerprint, ETree.tostring(OutputSectionNode, encoding='unicode'), True)
+
+
+def ParseSectionFragments(InputVolumeNode, VolumePath, units_of_measure, units_per_pixel):
+    '''
+    Generate the Section elements of the volume.  Fragments generated by earlier exports are reused
+    for sections whose VolumeData.xml files and transforms have not changed.
+    :return: List of serialized Section elements
+    '''
     Pool = nornir_pools.GetGlobalThreadPool()
-    
+
+    CachedFragments = _LoadSectionFragmentCache(VolumePath)
+    UpdatedFragments = {}
     SectionTasks = []
-    
+    SectionKeys = []
+
     print("Adding Sections\n")
     for BlockNode in InputVolumeNode.findall('Block'):
         for SectionNode in BlockNode.Sections:
+            key = (BlockNode.Path, SectionNode.Number)
+            task = Pool.add_task(str(SectionNode.Number), _SectionFragment, BlockNode.Path, SectionNode,
+                                 units_of_measure, units_per_pixel, CachedFragments.get(key, None))
+            SectionTasks.append(task)
+            SectionKeys.append(key)
 
-            OutputSectionNode = OutputVolumeNode.find("Section[@Number='%d']" % SectionNode.Number)
-            assert(OutputSectionNode is None)
-            
-            #if not ECLIPSE:
-                #print('\b' * 3)
+    Fragments = []
+    NumGenerated = 0
+    for (key, t) in zip(SectionKeys, SectionTasks):
+        (fingerprint, fragment, generated) = t.wait_return()
+        Fragments.append(fragment)
 
-            print('Queue %g' % SectionNode.Number)
-            
-            task = Pool.add_task(str(SectionNode.Number), ParseSection, BlockNode.Path, SectionNode)
-            SectionTasks.append(task)
+        if generated:
+            NumGenerated += 1
+            print('Generated %s' % t.name)
 
-    for t in SectionTasks:
-        if not ECLIPSE:
-            print('\b' * 8)
+        if fingerprint is not None:
+            UpdatedFragments[key] = (fingerprint, fragment)
+
+    prettyoutput.Log("Generated %d of %d sections, reused the rest from the previous export" % (NumGenerated, len(Fragments)))
+
+    # Sections that no longer exist are dropped from the cache
+    if UpdatedFragments != CachedFragments:
+        _SaveSectionFragmentCache(VolumePath, UpdatedFragments)
+
+    return Fragments
 
-        print('%s' % t.name)
-        
-        OutputSectionNode = t.wait_return()
-        
-        OutputVolumeNode.append(OutputSectionNode)
 
-    AllSectionNodes = OutputVolumeNode.findall('Section')
-    OutputVolumeNode.attrib['num_sections'] = str(len(AllSectionNodes))
-    
 def ParseSection(BlockPath, SectionNode):
     
     # Create a section node, or create on if it doesn't exist
@@ -311,22 +450,19 @@ def ParseChannels(SectionNode, OutputSectionNode):
 
 def ParseTransform(TransformNode, OutputSectionNode):
 
-    mFile = mosaicfile.MosaicFile.Load(TransformNode.FullPath)
+    # Only the image count and first tile name are needed, so skip parsing the transforms
+    header = transformheader.Read(TransformNode.FullPath)
 
-    if(mFile is None):
+    if(header is None):
         prettyoutput.LogErr("Unable to load transform: " + TransformNode.FullPath)
         return
 
-    if(mFile.NumberOfImages < 1):
+    if(header.NumberOfImages < 1 or header.FirstImageName is None):
         prettyoutput.LogErr("Not including empty .mosaic file")
         return
 
     # Figure out what the tile prefix and postfix are for this mosaic file by extrapolating from the first tile filename
-    for k in list(mFile.ImageToTransformString.keys()):
-        TileFileName = k
-        break
-
-    # TileFileName = mFile.ImageToTransformString.keys()[0]
+    TileFileName = header.FirstImageName
 
     # Figure out prefix and postfix parts of filenames
     parts = TileFileName.split('.')
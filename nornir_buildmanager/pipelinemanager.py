@@ -4,8 +4,11 @@ Created on Apr 2, 2012
 '''
 
 import collections
+import concurrent.futures
+import contextlib
 import copy
 import logging
+import multiprocessing
 import os
 import re
 import sys
@@ -13,6 +16,11 @@ import traceback
 import platform
 from xml.etree import ElementTree
 from nornir_buildmanager import VolumeManagerETree
+from nornir_buildmanager import volumedatacache
+from nornir_buildmanager import validationcache
+from nornir_buildmanager import volumedatawriter
+from nornir_buildmanager import pipelinetimings
+from nornir_buildmanager import templates
 
 from .pipeline_exceptions import *
 
@@ -295,6 +303,7 @@ class PipelineManager(object):
         self.PipelineData = pipelineData
         self.defaultArgs = dict()
         self.PipelineRoot = pipelinesRoot
+        self.Name = pipelineData.attrib.get('Name', None)
 
         if 'Description' in pipelineData.attrib:
             self._description = pipelineData.attrib['Description']
@@ -480,33 +489,54 @@ class PipelineManager(object):
            parser is an instance of the argparser class which should be 
            extended with any pipeline specific arguments args are the parameters from the command line'''
 
+        # Load the Volume.XML file in the output directory
+        VolumeTree = PipelineManager.LoadVolume(args)
+
+        self.ExecuteOnVolume(args, VolumeTree)
+        
+        nornir_pools.WaitOnAllPools()
+
+        volumedatawriter.Flush()
+        volumedatacache.SaveAll()
+        validationcache.SaveAll()
+
+    @classmethod
+    def LoadVolume(cls, args):
+        '''Load or create the volume specified by the volumepath argument'''
+        VolumeTree = VolumeManagerETree.VolumeManager.Load(args.volumepath, Create=True, MaxLoadedNodes=getattr(args, 'maxloadednodes', None))
+
+        if(VolumeTree is None):
+            PipelineManager.logger.critical("Could not load or create volume.xml " + args.volumepath)
+            prettyoutput.LogErr("Could not load or create volume.xml " + args.volumepath)
+            sys.exit()
+
+        return VolumeTree
+
+    def CreateArgumentSet(self, args):
+        '''The arguments the pipeline starts with, from the command line and the pipeline's parameters'''
         # DOM = self.PipelineData.toDOM()
         # PipelineElement = DOM.firstChild
         ArgSet = ArgumentSet()
 
-        PipelineElement = self.PipelineData
-
-        prettyoutput.Log("Adding pipeline arguments")
         # parser = self.GetArgParser(parser)
         # (args, unused) = parser.parse_known_args(passedArgs)
 
         ArgSet.AddArguments(args)
 
-        ArgSet.AddParameters(PipelineElement)
+        ArgSet.AddParameters(self.PipelineData)
+        return ArgSet
 
-        # Load the Volume.XML file in the output directory
-        self.VolumeTree = VolumeManagerETree.VolumeManager.Load(args.volumepath, Create=True)
+    def ExecuteOnVolume(self, args, VolumeTree):
+        '''Execute the pipeline on a volume that is already loaded.  Does not wait for pools or flush writes to disk'''
 
-        if(self.VolumeTree is None):
-            PipelineManager.logger.critical("Could not load or create volume.xml " + args.outputpath)
-            prettyoutput.LogErr("Could not load or create volume.xml " + args.outputpath)
-            sys.exit()
+        prettyoutput.Log("Adding pipeline arguments")
+        ArgSet = self.CreateArgumentSet(args)
+
+        self.VolumeTree = VolumeTree
 
         # dargs = copy.deepcopy(defaultDargs)
 
-        self.ExecuteChildPipelines(ArgSet, self.VolumeTree, PipelineElement)
-        
-        nornir_pools.WaitOnAllPools()
+        self.ExecuteChildPipelines(ArgSet, self.VolumeTree, self.PipelineData)
 
     def ExecuteChildPipelines(self, ArgSet, VolumeElem, PipelineNode):
         '''Run all of the child pipeline elements on the volume element'''
@@ -693,16 +723,129 @@ class PipelineManager(object):
         # Make sure downstream activities do not corrupt the dictionary for the caller
         CopiedArgSet = copy.copy(ArgSet)
 
+        MaxWorkers = PipelineManager._ParallelWorkerCount(PipelineNode, ArgSet)
+        if MaxWorkers > 0:
+            NumProcessed = self._ProcessIterateNodeInParallel(CopiedArgSet, VolumeElemIter, PipelineNode, MaxWorkers)
+        else:
+            NumProcessed = self._ProcessIterateNodeSerially(CopiedArgSet, VolumeElemIter, PipelineNode)
+
+        if(NumProcessed == 0):
+            raise PipelineSearchFailed(PipelineNode=PipelineNode, VolumeElem=RootForSearch, xpath=xpath)
+
+    def _ProcessIterateNodeSerially(self, ArgSet, VolumeElemIter, PipelineNode):
         NumProcessed = 0
         for VolumeElemChild in VolumeElemIter:
             if VolumeElemChild.CleanIfInvalid():
                 PipelineManager._SaveNodes(VolumeElemChild.Parent)
                 continue
 
-            NumProcessed += self.ExecuteChildPipelines(CopiedArgSet, VolumeElemChild, PipelineNode)
+            NumProcessed += self.ExecuteChildPipelines(ArgSet, VolumeElemChild, PipelineNode)
 
-        if(NumProcessed == 0):
-            raise PipelineSearchFailed(PipelineNode=PipelineNode, VolumeElem=RootForSearch, xpath=xpath)
+            PipelineManager._EnforceLoadedNodeBudget(VolumeElemChild, ArgSet)
+
+        return NumProcessed
+
+    @classmethod
+    def _ParallelWorkerCount(cls, PipelineNode, ArgSet):
+        '''
+        :return: Number of worker processes requested by the Parallel and MaxWorkers attributes of an
+                 <Iterate> node, or 0 if the iteration should run in this process
+        '''
+        Parallel = ArgSet.SubstituteStringVariables(PipelineNode.attrib.get('Parallel', 'false'))
+        if Parallel.lower() not in ('true', '1'):
+            return 0
+
+        if _InParallelIterateWorker:
+            # Nested parallel iterations run in the worker that reached them
+            return 0
+
+        if ArgSet.Arguments.get('debug', False):
+            PipelineManager.logger.info("Debug mode, running parallel iteration in this process: " + PipelineManager.ToElementString(PipelineNode))
+            return 0
+
+        MaxWorkers = PipelineNode.attrib.get('MaxWorkers', None)
+        if MaxWorkers is None:
+            return multiprocessing.cpu_count()
+
+        return max(int(ArgSet.SubstituteStringVariables(MaxWorkers)), 1)
+
+    def _ProcessIterateNodeInParallel(self, ArgSet, VolumeElemIter, PipelineNode, MaxWorkers):
+        '''
+        Run the child pipelines of an <Iterate Parallel="true"> node for each match in a separate process.
+
+        The volume is saved before the workers start.  Each worker loads the volume, finds its match,
+        runs the child pipelines with its own copy of the arguments and saves the match.  The children
+        of the iterate node may only change the matched container and the elements below it, a worker
+        that changes anything else fails without saving.  After
+        a worker finishes the matched container is replaced with a link so it is loaded again with
+        the worker's changes the next time it is used.
+        '''
+        Matches = []
+        for VolumeElemChild in VolumeElemIter:
+            if VolumeElemChild.CleanIfInvalid():
+                PipelineManager._SaveNodes(VolumeElemChild.Parent)
+                continue
+
+            Matches.append(VolumeElemChild)
+
+        if len(Matches) == 0:
+            return 0
+
+        try:
+            for m in Matches:
+                if not isinstance(m, VolumeManagerETree.XContainerElementWrapper):
+                    raise ValueError("{0} is not saved in its own VolumeData.xml".format(m.ToElementString()))
+
+            WorkerArgs = _ParallelIterateArguments(ArgSet, self.VolumeTree)
+            MatchLocators = [_NodeLocator(m, self.VolumeTree) for m in Matches]
+        except ValueError as e:
+            PipelineManager.logger.warning("Running iteration in this process, {0}".format(str(e)))
+            return self._ProcessIterateNodeSerially(ArgSet, iter(Matches), PipelineNode)
+
+        # Workers read the volume from disk
+        VolumeManagerETree.VolumeManager.Save(self.VolumeTree)
+        volumedatawriter.Flush()
+        volumedatacache.SaveAll()
+        validationcache.SaveAll()
+
+        VolumePath = self.VolumeTree.attrib['Path']
+        MaxWorkers = min(MaxWorkers, len(Matches))
+        prettyoutput.Log("Iterating over {0} elements with {1} worker processes".format(len(Matches), MaxWorkers))
+
+        NumProcessed = 0
+        Failures = []
+        with _ParallelIterateExecutor(MaxWorkers) as executor:
+            tasks = [executor.submit(_ExecuteIterationInWorker, VolumePath, PipelineNode, WorkerArgs, locator, PipelineName=self.Name) for locator in MatchLocators]
+
+            # Merge results in document order so the saved volume does not depend on which worker finished first.
+            # Every result is collected so the work of the workers that succeeded is kept if another failed.
+            for (VolumeElemChild, task) in zip(Matches, tasks):
+                try:
+                    (NumWorkerProcessed, attrib) = task.result()
+                except Exception as e:
+                    PipelineManager.logger.error("Worker failed on {0}\n{1}".format(VolumeElemChild.ToElementString(), str(e)))
+                    Failures.append(e)
+                    continue
+
+                NumProcessed += NumWorkerProcessed
+                VolumeElemChild.Parent.ReplaceChildWithUpdatedLink(VolumeElemChild, attrib)
+
+        VolumeManagerETree.VolumeManager.Save(self.VolumeTree)
+
+        if len(Failures) > 0:
+            raise Failures[0]
+
+        return NumProcessed
+
+    @classmethod
+    def _EnforceLoadedNodeBudget(cls, VolumeElem, ArgSet):
+        '''Unload the least recently used linked nodes if too many are in memory.  Nodes referenced by pipeline variables are kept'''
+        cache = VolumeElem._GetLinkedNodeCache()
+        if cache is None:
+            return
+
+        InUse = [v for v in ArgSet.Variables.values() if isinstance(v, VolumeManagerETree.XElementWrapper)]
+        cache.EnforceBudget(InUse)
 
     @classmethod
     def _SaveNodes(cls, NodesToSave):
@@ -712,8 +855,10 @@ class PipelineManager(object):
                     if node is None:
                         continue 
                     
+                    _CheckWorkerMayChange(node)
                     VolumeManagerETree.VolumeManager.Save(node)
             else:
+                _CheckWorkerMayChange(NodesToSave)
                 VolumeManagerETree.VolumeManager.Save(NodesToSave)
 
     def ProcessPythonCall(self, ArgSet, VolumeElem, PipelineNode):
@@ -763,9 +908,12 @@ class PipelineManager(object):
 
                 NodesToSave = None
 
+                StageTimer = pipelinetimings.StageTimer(self.VolumeTree.attrib.get("Path", None), self.Name, str(PipelineModule) + '.' + str(PipelineFunction), VolumeElem)
+
                 if not ArgSet.Arguments["debug"]:
                     try:
-                        NodesToSave = stageFunc(**kwargs)
+                        with StageTimer:
+                            NodesToSave = stageFunc(**kwargs)
                     except:
                         errorStr = '\n' + '-' * 60 + '\n'
                         errorStr = errorStr + str(PipelineModule) + '.' + str(PipelineFunction) + " Exception\n"
@@ -775,7 +923,10 @@ class PipelineManager(object):
                         PipelineManager.logger.error(errorStr)
                         # prettyoutput.LogErr(errorStr)
 
-                        self.VolumeTree = VolumeManagerETree.VolumeManager.Load(self.VolumeTree.attrib["Path"], UseCache=False)
+                        # Keep the loaded node budget the volume was opened with
+                        cache = self.VolumeTree._GetLinkedNodeCache()
+                        MaxLoadedNodes = cache.MaxNodes if cache is not None else ArgSet.Arguments.get('maxloadednodes', None)
+                        self.VolumeTree = VolumeManagerETree.VolumeManager.Load(self.VolumeTree.attrib["Path"], UseCache=False, MaxLoadedNodes=MaxLoadedNodes)
                         return
                          
                         
@@ -785,7 +936,8 @@ class PipelineManager(object):
                     # if they return false we do not need to run the expensive save operation
                     print(str(PipelineModule) + '.' + str(PipelineFunction))
                     
-                    NodesToSave = stageFunc(**kwargs)
+                    with StageTimer:
+                        NodesToSave = stageFunc(**kwargs)
 
                 PipelineManager._SaveNodes(NodesToSave)
 
@@ -823,6 +975,215 @@ class PipelineManager(object):
             del ArgSet.Variables[PipelineNode.attrib['VariableName']]
 
 
+# Set in worker processes started for <Iterate Parallel="true"> nodes
+_InParallelIterateWorker = False
+
+# Directory of the container a worker process is running the child pipelines for
+_ParallelIterateWorkerMatchPath = None
+
+
+def _InitParallelIterateWorker(NumProcs):
+    '''Runs in each worker process before it is given work'''
+    global _InParallelIterateWorker
+    _InParallelIterateWorker = True
+
+    # Pools the worker creates share the machine with the other workers
+    templates.Current.NumProcs = NumProcs
+
+
+@contextlib.contextmanager
+def _ParallelIterateExecutor(MaxWorkers):
+    '''
+    Process pool for parallel iterations.  The processors of the machine are
+    divided between the workers, so the pools each worker creates are sized
+    for its share instead of the whole machine.
+    '''
+    WorkerNumProcs = max(1, multiprocessing.cpu_count() // MaxWorkers)
+
+    # Python 3.13 and later report PYTHON_CPU_COUNT from os.cpu_count, which sizes nornir_pools pools created without a thread count
+    PreviousCPUCount = os.environ.get('PYTHON_CPU_COUNT', None)
+    os.environ['PYTHON_CPU_COUNT'] = str(WorkerNumProcs)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=MaxWorkers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_InitParallelIterateWorker,
+                                                    initargs=(WorkerNumProcs,)) as executor:
+            yield executor
+    finally:
+        if PreviousCPUCount is None:
+            del os.environ['PYTHON_CPU_COUNT']
+        else:
+            os.environ['PYTHON_CPU_COUNT'] = PreviousCPUCount
+
+
+def _NodeLocator(Node, VolumeRoot):
+    '''
+    An xpath that finds the node from the volume root in another process.  Each step selects
+    the element by the first of its Path, Name or Number attributes that identifies it.
+    :raises ValueError: If the node cannot be located this way
+    '''
+    steps = []
+    while Node is not VolumeRoot:
+        Parent = Node.Parent
+        if Parent is None:
+            raise ValueError("{0} is not part of the volume".format(Node.ToElementString()))
+
+        tag = Node.tag[:-len('_Link')] if Node.tag.endswith('_Link') else Node.tag
+        step = None
+        for AttribName in ('Path', 'Name', 'Number'):
+            value = Node.attrib.get(AttribName, None)
+            if value is None or ("'" in value and '"' in value):
+                continue
+
+            quote = '"' if "'" in value else "'"
+            candidate = "{0}[@{1}={2}{3}{2}]".format(tag, AttribName, quote, value)
+            if Parent.find(candidate) is Node:
+                step = candidate
+                break
+
+        if step is None:
+            raise ValueError("{0} cannot be located in a worker process".format(Node.ToElementString()))
+
+        steps.append(step)
+        Node = Parent
+
+    return '/'.join(reversed(steps))
+
+
+def _FindByLocator(VolumeRoot, Locator):
+    if len(Locator) == 0:
+        return VolumeRoot
+
+    Node = VolumeRoot.find(Locator)
+    if Node is None:
+        raise PipelineError(VolumeElem=VolumeRoot, message="Could not locate " + Locator + " in worker process")
+
+    return Node
+
+
+def _ParallelIterateArguments(ArgSet, VolumeRoot):
+    '''
+    Copy of the argument set that can be sent to a worker process.  Volume elements are replaced by locators.
+    :raises ValueError: If a volume element variable cannot be located in a worker
+    '''
+    Variables = {}
+    for (key, value) in ArgSet.Variables.items():
+        if isinstance(value, VolumeManagerETree.XElementWrapper):
+            value = (True, _NodeLocator(value, VolumeRoot))
+        else:
+            value = (False, value)
+
+        Variables[key] = value
+
+    return (dict(ArgSet.Arguments), dict(ArgSet.Attribs), dict(ArgSet.Parameters), Variables)
+
+
+def _ExecuteIterationInWorker(VolumePath, PipelineNode, WorkerArgs, MatchLocator, PipelineName=None):
+    '''
+    Run the child pipelines of an <Iterate> node on one element in a worker process
+    :return: (Number of pipelines run, attributes of the matched element)
+    '''
+    global _InParallelIterateWorker
+    global _ParallelIterateWorkerMatchPath
+    _InParallelIterateWorker = True
+
+    (Arguments, Attribs, Parameters, Variables) = WorkerArgs
+
+    VolumeTree = VolumeManagerETree.VolumeManager.Load(VolumePath, MaxLoadedNodes=Arguments.get('maxloadednodes', None))
+
+    ArgSet = ArgumentSet()
+    ArgSet.AddArguments(Arguments)
+    ArgSet.Attribs.update(Attribs)
+    ArgSet.Parameters.update(Parameters)
+    for (key, (IsLocator, value)) in Variables.items():
+        ArgSet.AddVariable(key, _FindByLocator(VolumeTree, value) if IsLocator else value)
+
+    VolumeElemChild = _FindByLocator(VolumeTree, MatchLocator)
+    _ParallelIterateWorkerMatchPath = os.path.normpath(VolumeElemChild.FullPath)
+    ParentState = _WorkerMatchParentState(VolumeElemChild)
+
+    Pipeline = PipelineManager(pipelinesRoot=None, pipelineData=PipelineNode)
+    Pipeline.Name = PipelineName
+    Pipeline.VolumeTree = VolumeTree
+
+    NumProcessed = Pipeline.ExecuteChildPipelines(ArgSet, VolumeElemChild, PipelineNode)
+
+    nornir_pools.WaitOnAllPools()
+
+    # Only the matched container and the elements below it are saved.  The parent process copies the
+    # returned attributes into the link to the match, any other change would be lost.
+    VolumeElemChild = _FindByLocator(Pipeline.VolumeTree, MatchLocator)
+    Changed = _ChangesOutsideWorkerMatch(Pipeline.VolumeTree, VolumeElemChild)
+    if len(Changed) > 0 or _WorkerMatchParentState(VolumeElemChild) != ParentState:
+        Changed.insert(0, VolumeElemChild.Parent)
+        raise PipelineError(VolumeElem=Changed[0], PipelineNode=PipelineNode,
+                            message="Parallel iteration changed elements outside of {0}: {1}".format(_ParallelIterateWorkerMatchPath, ", ".join([str(c.FullPath) for c in Changed])))
+
+    VolumeManagerETree.VolumeManager.Save(VolumeElemChild)
+    volumedatawriter.Flush()
+
+    return (NumProcessed, dict(VolumeElemChild.attrib))
+
+
+def _IsInWorkerMatch(Node):
+    '''True if the node is stored in the VolumeData.xml of the worker's matched container or a container below it'''
+    while not isinstance(Node, VolumeManagerETree.XContainerElementWrapper):
+        Node = Node.Parent
+        if Node is None:
+            return False
+
+    ContainerPath = os.path.normpath(Node.FullPath)
+    return ContainerPath == _ParallelIterateWorkerMatchPath or ContainerPath.startswith(_ParallelIterateWorkerMatchPath + os.sep)
+
+
+def _CheckWorkerMayChange(Node):
+    '''
+    Worker processes may only save the matched container and the elements below it.  Other
+    VolumeData.xml files can be shared with other workers and the parent process.
+    :raises PipelineError: If the node is outside of the matched container
+    '''
+    if _ParallelIterateWorkerMatchPath is None or _IsInWorkerMatch(Node):
+        return
+
+    raise PipelineError(VolumeElem=Node, message="Parallel iteration of {0} cannot save {1}".format(_ParallelIterateWorkerMatchPath, Node.FullPath))
+
+
+def _WorkerMatchParentState(Match):
+    '''Attributes of the match's parent and its other children.  A worker cannot return changes to them.'''
+    Parent = Match.Parent
+    Children = []
+    for child in Parent:
+        if child is Match:
+            continue
+
+        tag = child.tag[:-len('_Link')] if child.tag.endswith('_Link') else child.tag
+        Children.append(repr((tag, sorted(child.attrib.items()))))
+
+    return (repr(sorted(Parent.attrib.items())), sorted(Children))
+
+
+def _ChangesOutsideWorkerMatch(VolumeRoot, Match):
+    '''
+    :return: Containers with unsaved changes that are not the matched container or below it.  The match's
+             parent is always marked as changed because its link copies the match's attributes, so it is
+             checked with _WorkerMatchParentState instead.
+    '''
+    Changed = []
+    Nodes = [VolumeRoot]
+    while len(Nodes) > 0:
+        Node = Nodes.pop()
+        if _IsInWorkerMatch(Node):
+            continue
+
+        if Node.IsDirty and Node is not Match.Parent:
+            Changed.append(Node)
+
+        if Node.__dict__.get('_DirtyDescendants', False):
+            Nodes.extend([child for child in Node if isinstance(child, VolumeManagerETree.XContainerElementWrapper)])
+
+    return Changed
+
+
 def _GetVariableName(PipelineNode):
     if 'VariableName' in PipelineNode.attrib:
         return PipelineNode.attrib['VariableName']
@@ -0,0 +1,336 @@
+'''
+Runs several pipelines from Pipelines.xml on a volume in a single invocation.
+
+Running each pipeline with its own nornir-build command reloads the volume and
+waits for every section to finish a pipeline before the next pipeline starts.
+The scheduler loads the volume once and divides the pipelines into stages.
+Consecutive pipelines that consist of a single <Iterate> over the same xpath,
+such as Prune, Histogram, AdjustContrast, Mosaic and Assemble which all
+iterate Block/Section, form one stage.  A stage becomes a graph of tasks,
+one for each pipeline and matched element, where each task depends on the
+task of the previous pipeline for the same element.  Section N can be
+assembled while section N+1 is still being pruned.  Any other pipeline is a
+stage of its own that runs after every earlier task has finished.
+
+Tasks run in this process by default.  With more than one worker each task
+runs in a worker process as described for <Iterate Parallel="true"> in the
+pipeline manager, so the pipelines of a stage may only change the iterated
+element and the elements below it.  The volume is saved after every task.
+'''
+
+import argparse
+import concurrent.futures
+import copy
+import logging
+
+from . import pipelinemanager
+from . import validationcache
+from . import volumedatacache
+from . import volumedatawriter
+from nornir_buildmanager import VolumeManagerETree
+
+import nornir_pools
+import nornir_shared.prettyoutput as prettyoutput
+
+
+class ScheduledPipeline(object):
+    '''A pipeline and the arguments parsed for it'''
+
+    @property
+    def Name(self):
+        return self._Name
+
+    @property
+    def Pipeline(self):
+        return self._Pipeline
+
+    @property
+    def Args(self):
+        return self._Args
+
+    @property
+    def IterateNode(self):
+        '''The <Iterate> node if the pipeline is a single iteration that can be divided into tasks, otherwise None'''
+        return self._IterateNode
+
+    def __init__(self, Name, Pipeline, Args):
+        self._Name = Name
+        self._Pipeline = Pipeline
+        self._Args = Args
+        self._IterateNode = ScheduledPipeline._SingleIterateNode(Pipeline.PipelineData)
+
+    @classmethod
+    def _SingleIterateNode(cls, PipelineData):
+        Stages = [node for node in PipelineData if node.tag != 'Arguments']
+        if len(Stages) != 1:
+            return None
+
+        node = Stages[0]
+        if node.tag != 'Iterate' or 'Root' in node.attrib:
+            return None
+
+        return node
+
+    def IterateXPath(self):
+        ''':return: The xpath of the <Iterate> node with variables substituted, or None'''
+        if self._IterateNode is None:
+            return None
+
+        return self.Pipeline.CreateArgumentSet(self.Args).SubstituteStringVariables(self._IterateNode.attrib['XPath'])
+
+
+class ScheduledTask(object):
+    '''Run one pipeline's <Iterate> node on one element'''
+
+    def __init__(self, ScheduledPipeline, Locator, Position, PipelineIndex):
+        self.ScheduledPipeline = ScheduledPipeline
+        self.Locator = Locator
+        self.Position = Position
+        self.PipelineIndex = PipelineIndex
+        self.Dependencies = []
+        self.Dependents = []
+
+    @property
+    def Priority(self):
+        '''Tasks for earlier elements run first so each element finishes as soon as possible'''
+        return (self.Position, self.PipelineIndex)
+
+    def __str__(self):
+        return "{0} {1}".format(self.ScheduledPipeline.Name, self.Locator)
+
+
+class PipelineScheduler(object):
+
+    logger = logging.getLogger(__name__ + '.' + 'PipelineScheduler')
+
+    @property
+    def Pipelines(self):
+        return self._Pipelines
+
+    def __init__(self, Pipelines, Args, MaxWorkers=None):
+        '''
+        :param list Pipelines: ScheduledPipeline objects in the order they should run
+        :param Args: Arguments common to all pipelines, including volumepath
+        :param int MaxWorkers: Number of worker processes.  Tasks run in this process if None or less than 2
+        '''
+        self._Pipelines = Pipelines
+        self._Args = Args
+        self._MaxWorkers = MaxWorkers
+        self.VolumeTree = None
+
+        if self._MaxWorkers is not None and self._MaxWorkers > 1 and getattr(Args, 'debug', False):
+            prettyoutput.Log("Debug mode, running all pipelines in this process")
+            self._MaxWorkers = None
+
+    @classmethod
+    def Load(cls, PipelineXml, PipelineNames, Args, PipelineArgs=None, MaxWorkers=None):
+        '''
+        :param list PipelineNames: Names of the pipelines to run, in order
+        :param Args: Parsed arguments common to all pipelines
+        :param list PipelineArgs: Command line arguments parsed separately by each pipeline's argument parser
+        '''
+        if PipelineArgs is None:
+            PipelineArgs = []
+
+        XMLDoc = pipelinemanager.PipelineManager.LoadPipelineXML(PipelineXml)
+
+        Pipelines = []
+        for name in PipelineNames:
+            pipeline = pipelinemanager.PipelineManager.Load(XMLDoc, name)
+            if pipeline is None:
+                raise ValueError("No pipeline found named " + name)
+
+            parser = pipeline.GetArgParser(argparse.ArgumentParser(prog=name, conflict_handler='resolve'), IncludeGlobals=True)
+            (pipeline_args, unused) = parser.parse_known_args(PipelineArgs, namespace=copy.copy(Args))
+            Pipelines.append(ScheduledPipeline(name, pipeline, pipeline_args))
+
+        return PipelineScheduler(Pipelines, Args, MaxWorkers=MaxWorkers)
+
+    def Stages(self):
+        '''
+        :return: List of lists of ScheduledPipelines.  Pipelines in a stage with more than one entry
+                 iterate the same xpath and are divided into tasks.
+        '''
+        stages = []
+        lastXPath = None
+        for p in self._Pipelines:
+            xpath = p.IterateXPath()
+            if xpath is not None and xpath == lastXPath:
+                stages[-1].append(p)
+            else:
+                stages.append([p])
+
+            lastXPath = xpath
+
+        return stages
+
+    def Execute(self):
+        self.VolumeTree = pipelinemanager.PipelineManager.LoadVolume(self._Args)
+
+        for stage in self.Stages():
+            if stage[0].IterateNode is None:
+                self._ExecutePipeline(stage[0])
+            else:
+                self._ExecuteIterateStage(stage)
+
+            self._Save()
+
+        nornir_pools.WaitOnAllPools()
+
+        volumedatawriter.Flush()
+        volumedatacache.SaveAll()
+        validationcache.SaveAll()
+
+    def _Save(self):
+        VolumeManagerETree.VolumeManager.Save(self.VolumeTree)
+
+    def _ExecutePipeline(self, scheduled):
+        prettyoutput.Log("Running pipeline " + scheduled.Name)
+        scheduled.Pipeline.ExecuteOnVolume(scheduled.Args, self.VolumeTree)
+        nornir_pools.WaitOnAllPools()
+
+        # Stages reload the volume after an unhandled exception
+        self.VolumeTree = scheduled.Pipeline.VolumeTree
+
+    def CreateTasks(self, stage):
+        '''
+        Create the tasks for a stage of pipelines that iterate the same xpath.
+        :return: List of ScheduledTasks, each task depends on the task for the same element of the previous pipeline
+        '''
+        xpath = stage[0].IterateXPath()
+
+        Locators = []
+        for elem in self.VolumeTree.findall(xpath):
+            if elem.CleanIfInvalid():
+                pipelinemanager.PipelineManager._SaveNodes(elem.Parent)
+                continue
+
+            if not isinstance(elem, VolumeManagerETree.XContainerElementWrapper):
+                raise ValueError("{0} is not saved in its own VolumeData.xml".format(elem.ToElementString()))
+
+            Locators.append(pipelinemanager._NodeLocator(elem, self.VolumeTree))
+
+        tasks = []
+        for (iPosition, locator) in enumerate(Locators):
+            previous = None
+            for (iPipeline, scheduled) in enumerate(stage):
+                task = ScheduledTask(scheduled, locator, iPosition, iPipeline)
+                if previous is not None:
+                    task.Dependencies.append(previous)
+                    previous.Dependents.append(task)
+
+                tasks.append(task)
+                previous = task
+
+        return tasks
+
+    def _ExecuteIterateStage(self, stage):
+        prettyoutput.Log("Running pipelines {0} for each {1}".format(', '.join([p.Name for p in stage]), stage[0].IterateXPath()))
+
+        try:
+            tasks = self.CreateTasks(stage)
+        except ValueError as e:
+            self.logger.warning("Running pipelines one after another, {0}".format(str(e)))
+            for scheduled in stage:
+                self._ExecutePipeline(scheduled)
+            return
+
+        if self._MaxWorkers is None or self._MaxWorkers < 2:
+            for task in PipelineScheduler.OrderTasks(tasks):
+                self._ExecuteTask(task)
+        else:
+            self._ExecuteTasksInWorkers(tasks)
+
+    @classmethod
+    def OrderTasks(cls, tasks):
+        '''
+        :return: The tasks in the order they run in a single process.  A task is never returned before its dependencies.
+        '''
+        ordered = []
+        remaining = {id(t) : len(t.Dependencies) for t in tasks}
+        ready = [t for t in tasks if remaining[id(t)] == 0]
+        while len(ready) > 0:
+            ready.sort(key=lambda t: t.Priority)
+            task = ready.pop(0)
+            ordered.append(task)
+
+            for dependent in task.Dependents:
+                remaining[id(dependent)] -= 1
+                if remaining[id(dependent)] == 0:
+                    ready.append(dependent)
+
+        return ordered
+
+    def _ExecuteTask(self, task):
+        '''Run a task in this process'''
+        scheduled = task.ScheduledPipeline
+        pipeline = scheduled.Pipeline
+        pipeline.VolumeTree = self.VolumeTree
+
+        elem = pipelinemanager._FindByLocator(self.VolumeTree, task.Locator)
+        ArgSet = pipeline.CreateArgumentSet(scheduled.Args)
+
+        self.logger.info("Running " + str(task))
+        pipeline.ExecuteChildPipelines(ArgSet, elem, scheduled.IterateNode)
+
+        self.VolumeTree = pipeline.VolumeTree
+        self._Save()
+        pipelinemanager.PipelineManager._EnforceLoadedNodeBudget(self.VolumeTree, ArgSet)
+
+    def _MergeWorkerResult(self, task, attrib):
+        '''Replace the element a worker changed with a link so it is loaded again from disk'''
+        (ParentLocator, sep, ChildXPath) = task.Locator.rpartition('/')
+        Parent = pipelinemanager._FindByLocator(self.VolumeTree, ParentLocator)
+        Parent.UpdateLinkedChild(ChildXPath, attrib)
+
+    def _ExecuteTasksInWorkers(self, tasks):
+        '''
+        Run the tasks in worker processes.  If a task fails its dependents are
+        skipped, the results of the other tasks are still merged and the first
+        failure is raised once every other task has finished.
+        '''
+        remaining = {id(t) : len(t.Dependencies) for t in tasks}
+        ready = [t for t in tasks if remaining[id(t)] == 0]
+        running = {}
+        Failures = []
+
+        VolumePath = self.VolumeTree.attrib['Path']
+
+        with pipelinemanager._ParallelIterateExecutor(self._MaxWorkers) as executor:
+            while len(ready) > 0 or len(running) > 0:
+                if len(ready) > 0 and len(running) < self._MaxWorkers:
+                    # Workers read the elements they need from disk
+                    self._Save()
+                    volumedatawriter.Flush()
+
+                    ready.sort(key=lambda t: t.Priority)
+                    while len(ready) > 0 and len(running) < self._MaxWorkers:
+                        task = ready.pop(0)
+                        scheduled = task.ScheduledPipeline
+                        WorkerArgs = pipelinemanager._ParallelIterateArguments(scheduled.Pipeline.CreateArgumentSet(scheduled.Args), self.VolumeTree)
+                        self.logger.info("Starting " + str(task))
+                        future = executor.submit(pipelinemanager._ExecuteIterationInWorker, VolumePath, scheduled.IterateNode, WorkerArgs, task.Locator, PipelineName=scheduled.Name)
+                        running[future] = task
+
+                (done, not_done) = concurrent.futures.wait(list(running.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        (NumProcessed, attrib) = future.result()
+                    except Exception as e:
+                        self.logger.error("Failed {0}, skipping the pipelines that depend on it\n{1}".format(str(task), str(e)))
+                        Failures.append(e)
+                        continue
+
+                    self.logger.info("Finished " + str(task))
+                    self._MergeWorkerResult(task, attrib)
+
+                    for dependent in task.Dependents:
+                        remaining[id(dependent)] -= 1
+                        if remaining[id(dependent)] == 0:
+                            ready.append(dependent)
+
+                self._Save()
+
+        if len(Failures) > 0:
+            raise Failures[0]
@@ -0,0 +1,268 @@
+'''
+Records the time and resources used by each stage function a pipeline calls.
+
+Every <PythonCall> executed by the PipelineManager appends one JSON object to
+PipelineTimings.jsonl in the volume directory.  Each record contains the
+pipeline and stage names, the path of the volume element the stage was
+called on, the section number when the element belongs to a section, and
+measurements taken before and after the call:
+
+* WallTime: Seconds elapsed
+* CPUTime: User and system seconds used by this process, its threads and any child processes that exited during the call
+* ProcessPeakRSS: Largest resident set size the process has reached since it
+  started, in bytes.  This is not the memory used by the call, a stage that
+  follows a memory hungry stage in the same process reports the same peak.
+* BytesRead, BytesWritten: Bytes read and written by this process during the call
+* PoolTasks: Tasks added to nornir_pools pools during the call, the difference of
+  the pools' task counters before and after.  Tasks added to a pool that was
+  closed before the call returned are not counted.
+
+Measurements that are not available on the platform are recorded as null.
+The file is only appended to, so records from worker processes and earlier
+builds accumulate.  The ReportPipelineTimings pipeline summarises it.
+'''
+
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+import nornir_pools
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+TimingsFilename = 'PipelineTimings.jsonl'
+
+
+def TimingsFullPath(VolumePath):
+    return os.path.join(VolumePath, TimingsFilename)
+
+
+def _CPUSeconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _ProcessPeakRSSBytes():
+    ''':return: Largest resident set size of this process since it started, or the current size where the peak is unavailable'''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS reports bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    if psutil is not None:
+        mem = psutil.Process().memory_info()
+        return getattr(mem, 'peak_wset', mem.rss)
+
+    return None
+
+
+def _PoolTaskCounts():
+    ''':return: Dictionary of the number of tasks added to each pool nornir_pools has created, or None if the pools do not count tasks'''
+    pools = getattr(nornir_pools, 'dictKnownPools', None)
+    if pools is None:
+        return None
+
+    counts = {}
+    for (name, pool) in list(pools.items()):
+        count = getattr(pool, 'TasksAdded', None)
+        if count is None:
+            return None
+
+        counts[(name, id(pool))] = count
+
+    return counts
+
+
+def _PoolTasksAdded(start, end):
+    ''':return: Tasks added to pools between two _PoolTaskCounts measurements.  Pools created in between started from zero.'''
+    if start is None or end is None:
+        return None
+
+    return sum([count - start.get(key, 0) for (key, count) in end.items()])
+
+
+def _IOBytes():
+    ''':return: (bytes read, bytes written) by this process or (None, None) if unavailable'''
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return (counters.read_bytes, counters.write_bytes)
+        except (AttributeError, psutil.Error):
+            pass
+
+    try:
+        values = {}
+        with open('/proc/self/io', 'r') as hFile:
+            for line in hFile:
+                (key, sep, value) = line.partition(':')
+                values[key.strip()] = int(value)
+
+        return (values['rchar'], values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return (None, None)
+
+
+def _Difference(end, start):
+    if end is None or start is None:
+        return None
+
+    return end - start
+
+
+def _DescribeNode(VolumeElem, VolumePath):
+    ''':return: (path of the element relative to the volume, section number or None)'''
+    if VolumeElem is None:
+        return (None, None)
+
+    NodePath = None
+    FullPath = getattr(VolumeElem, 'FullPath', None)
+    if isinstance(FullPath, str) and VolumePath is not None:
+        NodePath = os.path.relpath(FullPath, VolumePath).replace(os.sep, '/')
+    else:
+        NodePath = VolumeElem.tag
+
+    SectionNumber = None
+    node = VolumeElem
+    while node is not None:
+        if node.tag == 'Section':
+            try:
+                SectionNumber = int(node.attrib['Number'])
+            except (KeyError, ValueError):
+                pass
+            break
+
+        node = node.__dict__.get('_Parent', None) if hasattr(node, '__dict__') else None
+
+    return (NodePath, SectionNumber)
+
+
+class StageTimer(object):
+    '''
+    Measures one stage function call and appends the record to the volume's timings file:
+
+        with StageTimer(VolumePath, PipelineName, StageName, VolumeElem):
+            stageFunc(**kwargs)
+    '''
+
+    logger = logging.getLogger(__name__ + '.' + 'StageTimer')
+
+    def __init__(self, VolumePath, PipelineName, StageName, VolumeElem=None):
+        self.VolumePath = VolumePath
+        self.PipelineName = PipelineName
+        self.StageName = StageName
+        self.VolumeElem = VolumeElem
+        self.Record = None
+
+    def __enter__(self):
+        self._Start = datetime.datetime.now()
+        (self._StartRead, self._StartWritten) = _IOBytes()
+        self._StartPoolTasks = _PoolTaskCounts()
+        self._StartCPU = _CPUSeconds()
+        self._StartWall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        WallTime = time.perf_counter() - self._StartWall
+        CPUTime = _CPUSeconds() - self._StartCPU
+        (EndRead, EndWritten) = _IOBytes()
+
+        (NodePath, SectionNumber) = _DescribeNode(self.VolumeElem, self.VolumePath)
+
+        self.Record = {'Pipeline' : self.PipelineName,
+                       'Stage' : self.StageName,
+                       'Node' : NodePath,
+                       'Section' : SectionNumber,
+                       'Start' : self._Start.isoformat(),
+                       'WallTime' : round(WallTime, 6),
+                       'CPUTime' : round(CPUTime, 6),
+                       'ProcessPeakRSS' : _ProcessPeakRSSBytes(),
+                       'BytesRead' : _Difference(EndRead, self._StartRead),
+                       'BytesWritten' : _Difference(EndWritten, self._StartWritten),
+                       'PoolTasks' : _PoolTasksAdded(self._StartPoolTasks, _PoolTaskCounts()),
+                       'Succeeded' : exc_type is None,
+                       'PID' : os.getpid()}
+
+        if self.VolumePath is not None:
+            Append(self.VolumePath, self.Record)
+
+        return False
+
+
+def Append(VolumePath, Record):
+    '''Append a record to the timings file of the volume'''
+    try:
+        with open(TimingsFullPath(VolumePath), 'a') as hFile:
+            hFile.write(json.dumps(Record) + '\n')
+    except OSError as e:
+        StageTimer.logger.warning("Could not record pipeline timing in {0}\n{1}".format(VolumePath, str(e)))
+
+
+def Read(VolumePath):
+    ''':return: List of the records in the timings file of the volume.  Unreadable lines are skipped.'''
+    records = []
+    FullPath = TimingsFullPath(VolumePath)
+    if not os.path.exists(FullPath):
+        return records
+
+    with open(FullPath, 'r') as hFile:
+        for line in hFile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A record may be incomplete if a build was killed while writing it
+                continue
+
+    return records
+
+
+def Summarize(records):
+    '''
+    :return: List of dictionaries, one per stage, sorted by total wall time with the slowest first.
+             Each has Stage, Calls, WallTime, CPUTime, ProcessPeakRSS, BytesRead, BytesWritten, PoolTasks and
+             Sections, a list of (WallTime, Section) sorted with the slowest section first.
+    '''
+    stages = {}
+    for r in records:
+        summary = stages.get(r['Stage'], None)
+        if summary is None:
+            summary = {'Stage' : r['Stage'], 'Calls' : 0, 'WallTime' : 0.0, 'CPUTime' : 0.0, 'ProcessPeakRSS' : None,
+                       'BytesRead' : 0, 'BytesWritten' : 0, 'PoolTasks' : 0, '_Sections' : {}}
+            stages[r['Stage']] = summary
+
+        summary['Calls'] += 1
+        summary['WallTime'] += r.get('WallTime', 0.0)
+        summary['CPUTime'] += r.get('CPUTime', 0.0)
+        summary['BytesRead'] += r.get('BytesRead', None) or 0
+        summary['BytesWritten'] += r.get('BytesWritten', None) or 0
+        summary['PoolTasks'] += r.get('PoolTasks', None) or 0
+
+        if r.get('ProcessPeakRSS', None) is not None:
+            summary['ProcessPeakRSS'] = max(summary['ProcessPeakRSS'] or 0, r['ProcessPeakRSS'])
+
+        Section = r.get('Section', None)
+        if Section is not None:
+            summary['_Sections'][Section] = summary['_Sections'].get(Section, 0.0) + r.get('WallTime', 0.0)
+
+    output = []
+    for summary in stages.values():
+        sections = summary.pop('_Sections')
+        summary['Sections'] = sorted([(WallTime, Section) for (Section, WallTime) in sections.items()], reverse=True)
+        output.append(summary)
+
+    return sorted(output, key=lambda s: s['WallTime'], reverse=True)
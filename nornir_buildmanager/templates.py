@@ -34,6 +34,10 @@ class __Config:
 
         return self.__NumProcs
 
+    @NumProcs.setter
+    def NumProcs(self, value):
+        self.__NumProcs = value
+
     def BlobCmd(self):
         return "ir-blob -sh 1 -max 3 -threads " + str(self.NumProcs) + " "
 
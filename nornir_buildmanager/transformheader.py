@@ -0,0 +1,110 @@
+'''
+Reads the metadata of .mosaic and .stos transform files without parsing their transforms.
+
+A .mosaic file begins with a short header that records the number of images,
+followed by an image name and transform for each tile:
+
+    number_of_images: 2
+    pixel_spacing: 1
+    use_std_mask: 0
+    format_version_number: 1
+    image:
+    001.png
+    GridTransform_double_2_2 vp ...
+
+Loading a .mosaic with MosaicFile.Load parses every transform, which for a
+large section means megabytes of text.  Callers that only need the number of
+images or the tile naming convention read the header and the first image
+entry instead.
+'''
+
+import os
+
+from nornir_imageregistration.files import mosaicfile, stosfile
+
+from . import validationcache
+
+
+class TransformFileHeader(object):
+    '''Metadata read from the start of a transform file'''
+
+    @property
+    def FullPath(self):
+        return self._FullPath
+
+    @property
+    def NumberOfImages(self):
+        '''Number of images in a .mosaic file, 1 for a .stos file'''
+        return self._NumberOfImages
+
+    @property
+    def FirstImageName(self):
+        '''File name of the first image listed in a .mosaic file'''
+        return self._FirstImageName
+
+    @property
+    def Checksum(self):
+        '''The checksum MosaicFile.LoadChecksum or StosFile.LoadChecksum returns for the file.  Reuses the validation cache if the file has not changed.'''
+        checksum = validationcache.Get(self._FullPath, 'Checksum')
+        if checksum is None:
+            if self._FullPath.lower().endswith('.stos'):
+                checksum = stosfile.StosFile.LoadChecksum(self._FullPath)
+            else:
+                checksum = mosaicfile.MosaicFile.LoadChecksum(self._FullPath)
+
+            validationcache.Set(self._FullPath, 'Checksum', checksum)
+
+        return checksum
+
+    def __init__(self, FullPath, NumberOfImages, FirstImageName):
+        self._FullPath = FullPath
+        self._NumberOfImages = NumberOfImages
+        self._FirstImageName = FirstImageName
+
+
+def _ReadMosaicHeader(FullPath):
+    NumberOfImages = None
+    FirstImageName = None
+    NumImageEntries = 0
+    ExpectImageName = False
+
+    with open(FullPath, 'r') as hFile:
+        for line in hFile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            if ExpectImageName:
+                FirstImageName = os.path.basename(line)
+                ExpectImageName = False
+            elif line.startswith('number_of_images:'):
+                NumberOfImages = int(line.split(':', 1)[1])
+            elif line.startswith('image:'):
+                NumImageEntries += 1
+                if FirstImageName is None:
+                    # Older files list the image name on the same line
+                    parts = line.split(None, 2)
+                    if len(parts) > 1:
+                        FirstImageName = os.path.basename(parts[1])
+                    else:
+                        ExpectImageName = True
+
+            # Stop at the first image unless the header did not include the count
+            if FirstImageName is not None and NumberOfImages is not None:
+                break
+
+    if NumberOfImages is None:
+        NumberOfImages = NumImageEntries
+
+    return TransformFileHeader(FullPath, NumberOfImages, FirstImageName)
+
+
+def Read(FullPath):
+    ''':return: TransformFileHeader for a .mosaic or .stos file, or None if the file does not exist'''
+    if not os.path.exists(FullPath):
+        return None
+
+    if FullPath.lower().endswith('.stos'):
+        return TransformFileHeader(FullPath, 1, None)
+
+    return _ReadMosaicHeader(FullPath)
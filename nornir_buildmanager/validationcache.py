@@ -0,0 +1,228 @@
+'''
+Persistent cache of values calculated from the files of a volume to validate its elements.
+
+Validating a transform node compares the checksum recorded in the meta-data to
+a checksum calculated by parsing the .mosaic or .stos file.  Validating an
+image node reads the image header to check its dimensions.  Most files of a
+volume do not change between builds, so these values are stored in a single
+pickle file in the volume root next to VolumeData.xml.  Each file's entry
+records the size and modification time of the file when the values were
+calculated.  Values are only returned while the file on disk still has the
+same size and modification time, so a changed file is always measured again.
+Values for files modified within RacyInterval seconds are not stored, because
+a file system with coarse timestamps could change such a file again without
+changing its signature.
+'''
+
+import logging
+import os
+import pickle
+import threading
+import time
+
+import nornir_shared.prettyoutput as prettyoutput
+
+# Values are not stored for files modified this many seconds or less ago
+RacyInterval = 2.0
+
+
+def _StatSignature(fullpath):
+    ''':return: (size, mtime_ns) of the file or None if it does not exist'''
+    try:
+        stats = os.stat(fullpath)
+    except OSError:
+        return None
+
+    return (stats.st_size, stats.st_mtime_ns)
+
+
+class ValidationCache(object):
+    '''Values calculated from the files of a single volume'''
+
+    CacheFilename = 'Validation.cache'
+
+    # Increment if the layout of the pickled data changes
+    FormatVersion = 1
+
+    logger = logging.getLogger(__name__ + '.' + 'ValidationCache')
+
+    @property
+    def VolumePath(self):
+        return self._VolumePath
+
+    @property
+    def FullPath(self):
+        return os.path.join(self._VolumePath, ValidationCache.CacheFilename)
+
+    @property
+    def IsModified(self):
+        return self._Modified
+
+    def __init__(self, VolumePath):
+        self._VolumePath = os.path.abspath(VolumePath)
+        self._Entries = {}
+        self._Modified = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._Entries)
+
+    def _RelativeKey(self, FullPath):
+        '''The key used for a file, or None if the file is not inside the volume'''
+        FullPath = os.path.abspath(FullPath)
+        if not FullPath.startswith(self._VolumePath + os.sep):
+            return None
+
+        return os.path.normcase(os.path.relpath(FullPath, self._VolumePath))
+
+    def Load(self):
+        '''Read the cache file from the volume directory.  A missing or unreadable cache file results in an empty cache'''
+        self._Entries = {}
+        self._Modified = False
+
+        if not os.path.exists(self.FullPath):
+            return
+
+        try:
+            with open(self.FullPath, 'rb') as hFile:
+                (version, entries) = pickle.load(hFile)
+        except Exception as e:
+            self.logger.warning("Ignoring unreadable validation cache {0}\n{1}".format(self.FullPath, str(e)))
+            return
+
+        if version != ValidationCache.FormatVersion:
+            self.logger.info("Ignoring validation cache with outdated format version {0}".format(version))
+            return
+
+        self._Entries = entries
+
+    def Save(self):
+        '''Write the cache file if any entries changed since it was loaded'''
+        if not self._Modified:
+            return
+
+        with self._lock:
+            data = pickle.dumps((ValidationCache.FormatVersion, self._Entries), protocol=pickle.HIGHEST_PROTOCOL)
+            self._Modified = False
+
+        TempFullPath = self.FullPath + '.tmp'
+        try:
+            with open(TempFullPath, 'wb') as hFile:
+                hFile.write(data)
+
+            os.replace(TempFullPath, self.FullPath)
+        except OSError as e:
+            self.logger.warning("Could not save validation cache {0}\n{1}".format(self.FullPath, str(e)))
+
+    def Get(self, FullPath, Name):
+        ''':return: The value stored for the file if it has not changed since, otherwise None'''
+        key = self._RelativeKey(FullPath)
+        if key is None:
+            return None
+
+        entry = self._Entries.get(key, None)
+        if entry is None:
+            return None
+
+        if entry[0] != _StatSignature(FullPath):
+            return None
+
+        return entry[1].get(Name, None)
+
+    def Set(self, FullPath, Name, Value):
+        '''Store a value calculated from the current contents of the file'''
+        key = self._RelativeKey(FullPath)
+        if key is None:
+            return
+
+        signature = _StatSignature(FullPath)
+        if signature is None:
+            self.Remove(FullPath)
+            return
+
+        if time.time_ns() - signature[1] <= RacyInterval * 1e9:
+            return
+
+        with self._lock:
+            entry = self._Entries.get(key, None)
+            if entry is None or entry[0] != signature:
+                entry = (signature, {})
+                self._Entries[key] = entry
+
+            if entry[1].get(Name, None) != Value:
+                entry[1][Name] = Value
+                self._Modified = True
+
+    def Remove(self, FullPath):
+        key = self._RelativeKey(FullPath)
+        if key is None:
+            return
+
+        with self._lock:
+            if key in self._Entries:
+                del self._Entries[key]
+                self._Modified = True
+
+
+# Caches of volumes opened by this process, keyed by the absolute volume path
+__OpenCaches__ = {}
+
+
+def Open(VolumePath):
+    '''Return the cache for the volume, loading it from disk if this is the first request'''
+    VolumePath = os.path.abspath(VolumePath)
+    cache = __OpenCaches__.get(VolumePath, None)
+    if cache is None:
+        cache = ValidationCache(VolumePath)
+        cache.Load()
+        __OpenCaches__[VolumePath] = cache
+
+    return cache
+
+
+def GetCacheForFile(FullPath):
+    '''Return the open cache of the volume containing the file, or None'''
+    FullPath = os.path.abspath(FullPath)
+
+    # Prefer the most specific volume if volumes are nested
+    best = None
+    for (VolumePath, cache) in list(__OpenCaches__.items()):
+        if FullPath.startswith(VolumePath + os.sep):
+            if best is None or len(VolumePath) > len(best.VolumePath):
+                best = cache
+
+    return best
+
+
+def Get(FullPath, Name):
+    ''':return: The value stored for an unchanged file of an open volume, otherwise None'''
+    cache = GetCacheForFile(FullPath)
+    if cache is None:
+        return None
+
+    return cache.Get(FullPath, Name)
+
+
+def Set(FullPath, Name, Value):
+    '''Store a value calculated from a file of an open volume'''
+    cache = GetCacheForFile(FullPath)
+    if cache is None:
+        return
+
+    cache.Set(FullPath, Name, Value)
+
+
+def SaveAll():
+    '''Write every open cache that has changed to disk'''
+    for cache in list(__OpenCaches__.values()):
+        if cache.IsModified:
+            prettyoutput.Log("Saving validation cache %s" % cache.FullPath)
+            cache.Save()
+
+
+def Close(VolumePath):
+    '''Save and forget the cache for the volume'''
+    VolumePath = os.path.abspath(VolumePath)
+    cache = __OpenCaches__.pop(VolumePath, None)
+    if cache is not None:
+        cache.Save()
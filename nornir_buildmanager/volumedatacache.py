@@ -0,0 +1,254 @@
+'''
+Persistent binary cache of the VolumeData.xml files of a volume.
+
+Every VolumeData.xml in the volume is stored in a single pickle file in the
+volume root, keyed by the path of the XML file relative to the volume root.
+Each entry records the size and modification time of the XML file when it was
+cached along with the pickled element tree.  An entry is only used while the XML file on disk still has the same
+size and modification time, so editing a VolumeData.xml by hand or with an
+older version of the build scripts simply causes that file to be parsed again.
+
+Loading a volume then costs a single read of the cache file plus a stat of each
+VolumeData.xml that is visited, instead of an open, read and parse of every
+file.  This matters most on network file systems.
+'''
+
+import logging
+import os
+import pickle
+import threading
+import xml.etree.ElementTree as ElementTree
+
+import nornir_shared.prettyoutput as prettyoutput
+
+
+def _ElementToTuple(element):
+    '''Convert an element tree into nested tuples of (tag, attrib, text, tail, children)'''
+    return (element.tag,
+            dict(element.attrib),
+            element.text,
+            element.tail,
+            tuple([_ElementToTuple(child) for child in element]))
+
+
+def _TupleToElement(entry):
+    '''Rebuild a plain ElementTree.Element tree from the output of _ElementToTuple'''
+    (tag, attrib, text, tail, children) = entry
+    element = ElementTree.Element(tag, attrib)
+    element.text = text
+    element.tail = tail
+    element.extend([_TupleToElement(child) for child in children])
+    return element
+
+
+def _StatSignature(fullpath):
+    ''':return: (size, mtime_ns) of the file or None if it does not exist'''
+    try:
+        stats = os.stat(fullpath)
+    except OSError:
+        return None
+
+    return (stats.st_size, stats.st_mtime_ns)
+
+
+class VolumeDataCache(object):
+    '''Cache of parsed VolumeData.xml files for a single volume'''
+
+    CacheFilename = 'VolumeData.cache'
+
+    # Increment if the layout of the pickled data changes
+    FormatVersion = 1
+
+    logger = logging.getLogger(__name__ + '.' + 'VolumeDataCache')
+
+    @property
+    def VolumePath(self):
+        return self._VolumePath
+
+    @property
+    def FullPath(self):
+        return os.path.join(self._VolumePath, VolumeDataCache.CacheFilename)
+
+    @property
+    def IsModified(self):
+        return self._Modified
+
+    def __init__(self, VolumePath):
+        self._VolumePath = os.path.abspath(VolumePath)
+        self._Entries = {}
+        self._Modified = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._Entries)
+
+    def _RelativeKey(self, XMLFullPath):
+        '''The key used for a VolumeData.xml file, or None if the file is not inside the volume'''
+        XMLFullPath = os.path.abspath(XMLFullPath)
+        if not XMLFullPath.startswith(self._VolumePath + os.sep):
+            return None
+
+        return os.path.normcase(os.path.relpath(XMLFullPath, self._VolumePath))
+
+    def Contains(self, XMLFullPath):
+        return self._RelativeKey(XMLFullPath) is not None
+
+    def Load(self):
+        '''Read the cache file from the volume directory.  A missing or unreadable cache file results in an empty cache'''
+        self._Entries = {}
+        self._Modified = False
+
+        if not os.path.exists(self.FullPath):
+            return
+
+        try:
+            with open(self.FullPath, 'rb') as hFile:
+                (version, entries) = pickle.load(hFile)
+        except Exception as e:
+            self.logger.warning("Ignoring unreadable VolumeData cache {0}\n{1}".format(self.FullPath, str(e)))
+            return
+
+        if version != VolumeDataCache.FormatVersion:
+            self.logger.info("Ignoring VolumeData cache with outdated format version {0}".format(version))
+            return
+
+        self._Entries = entries
+
+    def Save(self):
+        '''Write the cache file if any entries changed since it was loaded'''
+        if not self._Modified:
+            return
+
+        with self._lock:
+            data = pickle.dumps((VolumeDataCache.FormatVersion, self._Entries), protocol=pickle.HIGHEST_PROTOCOL)
+            self._Modified = False
+
+        TempFullPath = self.FullPath + '.tmp'
+        try:
+            with open(TempFullPath, 'wb') as hFile:
+                hFile.write(data)
+
+            os.replace(TempFullPath, self.FullPath)
+        except OSError as e:
+            self.logger.warning("Could not save VolumeData cache {0}\n{1}".format(self.FullPath, str(e)))
+
+    def Parse(self, XMLFullPath):
+        '''
+        Return the root element of the VolumeData.xml file.  The cached copy is
+        used if the file has not changed, otherwise the file is parsed and the
+        cache updated.
+        :param str XMLFullPath: Full path to a VolumeData.xml file
+        :rtype: ElementTree.Element
+        '''
+        key = self._RelativeKey(XMLFullPath)
+        signature = _StatSignature(XMLFullPath)
+
+        if key is not None:
+            if signature is None:
+                # The file was removed, let the parser raise the usual IOError
+                self.Remove(XMLFullPath)
+            else:
+                entry = self._Entries.get(key, None)
+                if entry is not None and entry[0] == signature:
+                    return _TupleToElement(pickle.loads(entry[1]))
+
+        XMLRoot = ElementTree.parse(XMLFullPath).getroot()
+
+        if key is not None and signature is not None:
+            self._SetEntry(key, signature, _ElementToTuple(XMLRoot))
+
+        return XMLRoot
+
+    def Update(self, XMLFullPath, Element):
+        '''Record the contents of a VolumeData.xml file that was just written to disk'''
+        key = self._RelativeKey(XMLFullPath)
+        if key is None:
+            return
+
+        signature = _StatSignature(XMLFullPath)
+        if signature is None:
+            self.Remove(XMLFullPath)
+            return
+
+        self._SetEntry(key, signature, _ElementToTuple(Element))
+
+    def Remove(self, XMLFullPath):
+        key = self._RelativeKey(XMLFullPath)
+        if key is None:
+            return
+
+        with self._lock:
+            if key in self._Entries:
+                del self._Entries[key]
+                self._Modified = True
+
+    def _SetEntry(self, key, signature, value):
+        # Entries are kept pickled, the nested tuples use several times more memory
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._Entries[key] = (signature, data)
+            self._Modified = True
+
+
+# Caches of volumes opened by this process, keyed by the absolute volume path
+__OpenCaches__ = {}
+
+
+def Open(VolumePath):
+    '''Return the cache for the volume, loading it from disk if this is the first request'''
+    VolumePath = os.path.abspath(VolumePath)
+    cache = __OpenCaches__.get(VolumePath, None)
+    if cache is None:
+        cache = VolumeDataCache(VolumePath)
+        cache.Load()
+        __OpenCaches__[VolumePath] = cache
+
+    return cache
+
+
+def GetCacheForFile(XMLFullPath):
+    '''Return the open cache of the volume containing the file, or None'''
+    XMLFullPath = os.path.abspath(XMLFullPath)
+
+    # Prefer the most specific volume if volumes are nested
+    best = None
+    for (VolumePath, cache) in list(__OpenCaches__.items()):
+        if XMLFullPath.startswith(VolumePath + os.sep):
+            if best is None or len(VolumePath) > len(best.VolumePath):
+                best = cache
+
+    return best
+
+
+def Parse(XMLFullPath):
+    '''Parse a VolumeData.xml file using the cache of its volume if one is open'''
+    cache = GetCacheForFile(XMLFullPath)
+    if cache is None:
+        return ElementTree.parse(XMLFullPath).getroot()
+
+    return cache.Parse(XMLFullPath)
+
+
+def Update(XMLFullPath, Element):
+    '''Update the cached contents of a VolumeData.xml file after it has been written'''
+    cache = GetCacheForFile(XMLFullPath)
+    if cache is None:
+        return
+
+    cache.Update(XMLFullPath, Element)
+
+
+def SaveAll():
+    '''Write every open cache that has changed to disk'''
+    for cache in list(__OpenCaches__.values()):
+        if cache.IsModified:
+            prettyoutput.Log("Saving VolumeData cache %s" % cache.FullPath)
+            cache.Save()
+
+
+def Close(VolumePath):
+    '''Save and forget the cache for the volume'''
+    VolumePath = os.path.abspath(VolumePath)
+    cache = __OpenCaches__.pop(VolumePath, None)
+    if cache is not None:
+        cache.Save()
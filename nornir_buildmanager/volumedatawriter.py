@@ -0,0 +1,172 @@
+'''
+Writes VolumeData.xml files on a background thread.
+
+Saving a container serializes it on the calling thread and queues the bytes.
+A single writer thread waits a short time so repeated saves of the same file
+are merged, then writes each file to a temporary file beside it and moves it
+into place with os.replace.  A crash can never leave a partially written
+VolumeData.xml behind, and pipeline stages do not wait on the file system.
+
+Files waiting to be written are visible through GetPending so a node that
+is loaded again before the write completes sees the latest contents.  Flush
+blocks until every queued file is on disk and must be called before other
+processes read the volume.
+'''
+
+import atexit
+import logging
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from . import volumedatacache
+
+# mkstemp creates files only the owner can read, VolumeData.xml files get the permissions open() would give them
+_Umask = os.umask(0)
+os.umask(_Umask)
+_FileMode = 0o666 & ~_Umask
+
+
+class VolumeDataWriter(object):
+    '''Background writer that merges repeated writes to the same file'''
+
+    # Seconds to wait after a write is queued so later saves of the same file replace it
+    CoalesceDelay = 0.25
+
+    logger = logging.getLogger(__name__ + '.' + 'VolumeDataWriter')
+
+    def __init__(self):
+        self._Pending = {}
+        self._Errors = []
+        self._Condition = threading.Condition()
+        self._Busy = False
+        self._Thread = None
+        self._FlushRequested = threading.Event()
+
+    @property
+    def NumPending(self):
+        with self._Condition:
+            return len(self._Pending)
+
+    def _StartThread(self):
+        if self._Thread is None or not self._Thread.is_alive():
+            self._Thread = threading.Thread(target=self._Run, name='VolumeDataWriter', daemon=True)
+            self._Thread.start()
+
+    def Write(self, XMLFullPath, data):
+        '''Queue bytes to be written to the file.  Replaces any queued write to the same file'''
+        XMLFullPath = os.path.abspath(XMLFullPath)
+        with self._Condition:
+            self._Pending[XMLFullPath] = data
+            self._StartThread()
+            self._Condition.notify_all()
+
+    def GetPending(self, XMLFullPath):
+        ''':return: The bytes queued for the file or None if no write is waiting'''
+        with self._Condition:
+            return self._Pending.get(os.path.abspath(XMLFullPath), None)
+
+    def Flush(self):
+        '''Block until every queued write is on disk.  Raises the first error encountered by the writer since the last flush'''
+        self._FlushRequested.set()
+        with self._Condition:
+            while len(self._Pending) > 0 or self._Busy:
+                if self._Thread is None or not self._Thread.is_alive():
+                    self._StartThread()
+                self._Condition.wait(1.0)
+
+            Errors = self._Errors
+            self._Errors = []
+
+        self._FlushRequested.clear()
+
+        if len(Errors) > 0:
+            raise Errors[0]
+
+    def _Run(self):
+        while True:
+            with self._Condition:
+                while len(self._Pending) == 0:
+                    self._Condition.wait()
+
+                self._Busy = True
+
+            try:
+                # Give the pipeline a chance to save the same file again before we write it
+                self._FlushRequested.wait(VolumeDataWriter.CoalesceDelay)
+
+                with self._Condition:
+                    Batch = list(self._Pending.items())
+
+                for (XMLFullPath, data) in Batch:
+                    self._WriteFile(XMLFullPath, data)
+
+                    with self._Condition:
+                        # Keep the entry if a newer version was queued while we were writing
+                        if self._Pending.get(XMLFullPath, None) is data:
+                            del self._Pending[XMLFullPath]
+            finally:
+                with self._Condition:
+                    self._Busy = False
+                    self._Condition.notify_all()
+
+    def _WriteFile(self, XMLFullPath, data):
+        if not os.path.isdir(os.path.dirname(XMLFullPath)):
+            # The node was cleaned and its directory removed after it was saved
+            self.logger.info("Skipping write to removed directory {0}".format(XMLFullPath))
+            return
+
+        # Each writer, including those in other processes, needs its own temporary file
+        TempFullPath = None
+        try:
+            (hTemp, TempFullPath) = tempfile.mkstemp(dir=os.path.dirname(XMLFullPath), suffix='.tmp')
+            with os.fdopen(hTemp, 'wb') as hFile:
+                hFile.write(data)
+
+            os.chmod(TempFullPath, _FileMode)
+
+            os.replace(TempFullPath, XMLFullPath)
+        except Exception as e:
+            if TempFullPath is not None and os.path.exists(TempFullPath):
+                os.remove(TempFullPath)
+
+            self.logger.error("Could not write {0}\n{1}".format(XMLFullPath, str(e)))
+            with self._Condition:
+                self._Errors.append(e)
+            return
+
+        try:
+            volumedatacache.Update(XMLFullPath, ElementTree.fromstring(data))
+        except Exception as e:
+            self.logger.warning("Could not update VolumeData cache for {0}\n{1}".format(XMLFullPath, str(e)))
+
+
+__Writer__ = VolumeDataWriter()
+
+
+def Write(XMLFullPath, data):
+    '''Queue bytes to be written to a VolumeData.xml file'''
+    __Writer__.Write(XMLFullPath, data)
+
+
+def GetPending(XMLFullPath):
+    ''':return: The bytes waiting to be written to the file or None'''
+    return __Writer__.GetPending(XMLFullPath)
+
+
+def Parse(XMLFullPath):
+    '''Parse a VolumeData.xml file, using the queued contents if a write is waiting'''
+    data = __Writer__.GetPending(XMLFullPath)
+    if data is not None:
+        return ElementTree.fromstring(data)
+
+    return volumedatacache.Parse(XMLFullPath)
+
+
+def Flush():
+    '''Wait until every queued VolumeData.xml file is written'''
+    __Writer__.Flush()
+
+
+atexit.register(Flush)
@@ -0,0 +1,63 @@
+'''
+Tests for the in-process image statistics used to choose registration chains
+'''
+
+import os
+import shutil
+import unittest
+
+import numpy
+from PIL import Image
+
+import nornir_buildmanager.operations.helpers.imagestats as imagestats
+import test.testbase
+
+
+class ImageStatsTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(ImageStatsTest, self).setUp()
+
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+        os.makedirs(self.TestOutputPath)
+
+    def tearDown(self):
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+    def testBitDepths(self):
+        '''Statistics of the same image saved with different bit depths should match'''
+        data = numpy.arange(256, dtype=numpy.uint8).reshape((16, 16))
+
+        EightBitFullPath = os.path.join(self.TestOutputPath, 'Eight.png')
+        SixteenBitFullPath = os.path.join(self.TestOutputPath, 'Sixteen.png')
+        Image.fromarray(data).save(EightBitFullPath)
+        Image.fromarray(data.astype(numpy.uint16) * 257).save(SixteenBitFullPath)
+
+        EightBitStats = imagestats.ImageStatistics(EightBitFullPath)
+        SixteenBitStats = imagestats.ImageStatistics(SixteenBitFullPath)
+
+        self.assertAlmostEqual(EightBitStats['Mean'], 0.5)
+        self.assertEqual(EightBitStats['Min'], 0.0)
+        self.assertEqual(EightBitStats['Max'], 1.0)
+
+        for key in EightBitStats:
+            self.assertAlmostEqual(EightBitStats[key], SixteenBitStats[key])
+
+    def testCache(self):
+        '''Statistics are calculated again only when the checksum changes'''
+        ImageFullPath = os.path.join(self.TestOutputPath, 'Image.png')
+        Image.fromarray(numpy.zeros((8, 8), dtype=numpy.uint8)).save(ImageFullPath)
+
+        self.assertEqual(imagestats.CachedImageStatistics(ImageFullPath, Checksum='1')['Mean'], 0.0)
+
+        Image.fromarray(numpy.full((8, 8), 255, dtype=numpy.uint8)).save(ImageFullPath)
+        self.assertEqual(imagestats.CachedImageStatistics(ImageFullPath, Checksum='1')['Mean'], 0.0)
+        self.assertEqual(imagestats.CachedImageStatistics(ImageFullPath, Checksum='2')['Mean'], 1.0)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
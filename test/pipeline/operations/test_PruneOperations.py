@@ -6,6 +6,7 @@ Created on Feb 14, 2013
 import os
 import unittest
 
+from nornir_buildmanager.operations import pruneobj
 from nornir_buildmanager.operations.pruneobj import PruneObj
 from nornir_imageregistration.files.mosaicfile import MosaicFile
 import test.pipeline.setup_pipeline
@@ -123,6 +124,24 @@ class PruneTest(test.pipeline.setup_pipeline.ImportOnlySetup):
         Output = PruneObj.PruneMosaic({}, PruneNode=PruneNode, TransformNode=self.StageTransformNode, OutputTransformName='Prune', Logger=self.Logger)
         self.assertIsNone(Output)
 
+    def testCachedPruneScores(self):
+        '''Scores read from the prune feature cache should match the scores calculated for the tiles'''
+
+        self.LoadMetaData()
+
+        TileNames = list(MosaicFile.Load(self.StageTransformNode.FullPath).ImageToTransformString.keys())
+
+        Scores = PruneObj.ScoreTiles(self.LevelNode.FullPath, TileNames, 0.1)
+        self.assertEqual(len(Scores), self.TilePyramidNode.NumberOfTiles)
+        self.assertTrue(os.path.exists(os.path.join(self.LevelNode.FullPath, pruneobj.PruneFeatureCacheFilename)))
+
+        CachedScores = PruneObj.ScoreTiles(self.LevelNode.FullPath, TileNames, 0.1)
+        self.assertEqual(Scores, CachedScores)
+
+        # Scores for a different overlap are calculated again
+        OverlapScores = PruneObj.ScoreTiles(self.LevelNode.FullPath, TileNames, 0.2)
+        self.assertEqual(len(OverlapScores), len(Scores))
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
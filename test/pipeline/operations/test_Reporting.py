@@ -0,0 +1,84 @@
+'''
+Tests for the thumbnail cache used by the HTML report
+'''
+
+import os
+import shutil
+import unittest
+
+import numpy
+from PIL import Image
+
+import nornir_buildmanager.operations.reporting as reporting
+import test.testbase
+
+
+# Thumbnails written by _CreateThumbnail
+ThumbnailsCreated = []
+
+
+def _CreateThumbnail(InputFullPath, OutputFullPath, Size):
+    ThumbnailsCreated.append(InputFullPath)
+    with Image.open(InputFullPath) as img:
+        img.resize((Size, Size)).save(OutputFullPath, format='PNG')
+
+
+class ReportThumbnailTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(ReportThumbnailTest, self).setUp()
+
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+        os.makedirs(self.TestOutputPath)
+
+        self.SourceFullPath = os.path.join(self.TestOutputPath, 'Source.png')
+        Image.fromarray(numpy.arange(256, dtype=numpy.uint8).reshape((16, 16))).save(self.SourceFullPath)
+
+        self.ReportFullPath = os.path.join(self.TestOutputPath, 'Report.html')
+        del ThumbnailsCreated[:]
+
+    def tearDown(self):
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+    def _Report(self):
+        ''':return: (HTMLPaths, thumbnail full path) after a report that uses a thumbnail of the source image'''
+        Paths = reporting.HTMLPaths(self.TestOutputPath, self.ReportFullPath)
+        Paths.CreateOutputDirs()
+
+        (ImgSrcPath, ThumbnailFullPath, CreateThumbnail) = Paths.CachedThumbnailPaths(self.SourceFullPath, 'Source.png', 8)
+        self.assertEqual(os.path.join(self.TestOutputPath, ImgSrcPath), ThumbnailFullPath)
+        if CreateThumbnail:
+            reporting._WriteThumbnail(_CreateThumbnail, self.SourceFullPath, ThumbnailFullPath, 8)
+
+        return (Paths, ThumbnailFullPath)
+
+    def testThumbnailCache(self):
+        (Paths, FirstThumbnail) = self._Report()
+        self.assertTrue(os.path.exists(FirstThumbnail))
+        self.assertEqual(len(ThumbnailsCreated), 1)
+
+        # A second report of an unchanged source uses the same thumbnail
+        (Paths, SecondThumbnail) = self._Report()
+        self.assertEqual(FirstThumbnail, SecondThumbnail)
+        self.assertEqual(len(ThumbnailsCreated), 1, "Thumbnail should not be created again for an unchanged source")
+
+        # A newer source gets a new thumbnail
+        stat = os.stat(self.SourceFullPath)
+        os.utime(self.SourceFullPath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        (Paths, UpdatedThumbnail) = self._Report()
+        self.assertNotEqual(FirstThumbnail, UpdatedThumbnail)
+        self.assertEqual(len(ThumbnailsCreated), 2)
+
+        # Only the thumbnail of the earlier source is unused by the last report
+        self.assertEqual(Paths.RemoveUnusedThumbnails(), 1)
+        self.assertFalse(os.path.exists(FirstThumbnail))
+        self.assertTrue(os.path.exists(UpdatedThumbnail))
+        self.assertEqual(os.listdir(Paths.ThumbnailDir), [os.path.basename(UpdatedThumbnail)])
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
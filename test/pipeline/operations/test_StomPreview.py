@@ -0,0 +1,54 @@
+'''
+Tests for the registration previews built from ir-stom output
+'''
+
+import os
+import shutil
+import unittest
+
+import numpy
+from PIL import Image
+
+import nornir_buildmanager.operations.block as block
+import test.testbase
+
+
+class StomPreviewTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(StomPreviewTest, self).setUp()
+
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+        os.makedirs(self.TestOutputPath)
+
+    def tearDown(self):
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+    def testMixedBitDepths(self):
+        '''Inputs of different bit depths are compared on the same scale'''
+        ControlFullPath = os.path.join(self.TestOutputPath, 'Control.png')
+        WarpedFullPath = os.path.join(self.TestOutputPath, 'Warped.png')
+        OverlayFullPath = os.path.join(self.TestOutputPath, 'Overlay.png')
+        DiffFullPath = os.path.join(self.TestOutputPath, 'Diff.png')
+        WarpedOutputFullPath = os.path.join(self.TestOutputPath, 'WarpedOutput.png')
+
+        Image.fromarray(numpy.full((4, 4), 128, dtype=numpy.uint8)).save(ControlFullPath)
+        block._WriteArrayImage(numpy.full((4, 4), 128 * 257, dtype=numpy.uint16), WarpedFullPath)
+
+        block.WriteStomPreviewImages(ControlFullPath, WarpedFullPath, OverlayFullPath, DiffFullPath, WarpedOutputFullPath)
+
+        Overlay = numpy.asarray(Image.open(OverlayFullPath))
+        self.assertTrue((Overlay == 128).all())
+
+        Diff = numpy.asarray(Image.open(DiffFullPath))
+        self.assertEqual(Diff.max(), 0)
+
+        self.assertTrue((numpy.asarray(Image.open(WarpedOutputFullPath)) == 128 * 257).all())
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -19,9 +19,13 @@ from test.pipeline.setup_pipeline import *
 
 import nornir_buildmanager as nb
 import nornir_buildmanager.build as build
+import nornir_buildmanager.operations.tile
 import nornir_buildmanager.operations.setters as setters
 import nornir_imageregistration.tileset as tiles
+from nornir_imageregistration import tileset_functions
+import nornir_pools
 import numpy as np
+from PIL import Image
 
 
 # class EvaluateFilterTest(ImportOnlySetup):
@@ -217,6 +221,183 @@ class BuildTilePyramidTest(PrepareSetup):
         self.RemoveAndRegenerateTile(RegenFunction=self.RunAdjustContrast, RegenKwargs={'Sections' : 690}, section_number=690, channel='TEM', filter_name='Leveled', level=4)       
 
 
+class StreamingTilesetLevelsTest(unittest.TestCase):
+    '''Levels built in one streaming pass or updated incrementally must match levels built one at a time from the level below'''
+
+    TileDim = (8, 6)
+    GridDim = (13, 11)
+    NumLevels = 4
+
+    def setUp(self):
+        self.OutputPath = tempfile.mkdtemp()
+        self.SourcePath = os.path.join(self.OutputPath, '001')
+        os.makedirs(self.SourcePath)
+
+        rng = np.random.RandomState(0)
+        for iY in range(0, self.GridDim[0]):
+            for iX in range(0, self.GridDim[1]):
+                # Leave holes in the grid
+                if (iX + iY) % 7 == 3:
+                    continue
+
+                tile = rng.randint(0, 256, self.TileDim).astype(np.uint8)
+                Image.fromarray(tile).save(self.TilePath(self.SourcePath, iX, iY))
+
+    def tearDown(self):
+        shutil.rmtree(self.OutputPath)
+
+    def TilePath(self, LevelPath, iX, iY):
+        return nornir_buildmanager.operations.tile._GridTileFullPath(LevelPath, '', '.png', iX, iY)
+
+    def BuildLevel(self, SourcePath, SourceGridDim, DestPath):
+        os.makedirs(DestPath)
+        DestGridDim = ((SourceGridDim[0] + 1) // 2, (SourceGridDim[1] + 1) // 2)
+        for iY in range(0, DestGridDim[0]):
+            for iX in range(0, DestGridDim[1]):
+                Quadrants = [self.TilePath(SourcePath, (iX * 2) + dX, (iY * 2) + dY) for (dY, dX) in ((0, 0), (0, 1), (1, 0), (1, 1))]
+                if not any([os.path.exists(path) for path in Quadrants]):
+                    continue
+
+                # The routine BuildTilesetPyramid used before levels were built in memory
+                tileset_functions.CreateOneTilesetTileWithPillow(self.TileDim,
+                                                                 TopLeft=Quadrants[0], TopRight=Quadrants[1],
+                                                                 BottomLeft=Quadrants[2], BottomRight=Quadrants[3],
+                                                                 OutputFileFullPath=self.TilePath(DestPath, iX, iY))
+
+        return DestGridDim
+
+    def BuildExpectedLevels(self, Name):
+        ExpectedPaths = []
+        (SourcePath, GridDim) = (self.SourcePath, self.GridDim)
+        for iLevel in range(0, self.NumLevels):
+            DestPath = os.path.join(self.OutputPath, '%s%d' % (Name, iLevel))
+            GridDim = self.BuildLevel(SourcePath, GridDim, DestPath)
+            ExpectedPaths.append(DestPath)
+            SourcePath = DestPath
+
+        return ExpectedPaths
+
+    def CompareLevels(self, ExpectedPaths, DestPaths):
+        for (Expected, Actual) in zip(ExpectedPaths, DestPaths):
+            ExpectedTiles = sorted(glob.glob1(Expected, '*.png'))
+            self.assertEqual(ExpectedTiles, sorted(glob.glob1(Actual, '*.png')), "Levels have different tiles")
+            for filename in ExpectedTiles:
+                ExpectedTile = nornir_buildmanager.operations.tile._ReadGridTile(os.path.join(Expected, filename))
+                ActualTile = nornir_buildmanager.operations.tile._ReadGridTile(os.path.join(Actual, filename))
+                self.assertTrue(np.array_equal(ExpectedTile, ActualTile), "Tile %s differs" % filename)
+
+    def testStreaming(self):
+        ExpectedPaths = self.BuildExpectedLevels('Expected')
+
+        TileBytes = self.TileDim[0] * self.TileDim[1]
+        MergeBytes = TileBytes * nornir_buildmanager.operations.tile._StreamingMergeTiles
+        # Memory for all levels in one band, for column bands of two levels, and for a single level in two tile wide bands
+        for MaxMemory in (1 << 30, MergeBytes + (TileBytes * 20), TileBytes):
+            DestPaths = [os.path.join(self.OutputPath, '%d_%d' % (MaxMemory, iLevel)) for iLevel in range(0, self.NumLevels)]
+            BuildTilesetLevelsStreaming(self.SourcePath, self.GridDim, DestPaths, self.TileDim, '', '.png', MaxMemory=MaxMemory)
+            self.CompareLevels(ExpectedPaths, DestPaths)
+
+    def UpdateLevels(self, DestPaths):
+        ''':return: Number of tiles updated in each level'''
+        NumUpdated = []
+        (SourcePath, GridDim) = (self.SourcePath, self.GridDim)
+        for DestPath in DestPaths:
+            NumUpdated.append(UpdateTilesetLevel(SourcePath, GridDim, DestPath, self.TileDim, '', '.png'))
+            (SourcePath, GridDim) = (DestPath, ((GridDim[0] + 1) // 2, (GridDim[1] + 1) // 2))
+
+        return NumUpdated
+
+    def testUpdate(self):
+        DestPaths = [os.path.join(self.OutputPath, 'Updated%d' % iLevel) for iLevel in range(0, self.NumLevels)]
+        BuildTilesetLevelsStreaming(self.SourcePath, self.GridDim, DestPaths, self.TileDim, '', '.png')
+        self.assertEqual(self.UpdateLevels(DestPaths), [0] * self.NumLevels, "Nothing changed, no tiles should be updated")
+
+        # Change one tile, add a tile in a hole and remove the only source tile of a corner tile
+        Image.fromarray(np.full(self.TileDim, 255, dtype=np.uint8)).save(self.TilePath(self.SourcePath, 5, 5))
+        Image.fromarray(np.full(self.TileDim, 128, dtype=np.uint8)).save(self.TilePath(self.SourcePath, 3, 0))
+        os.remove(self.TilePath(self.SourcePath, 10, 12))
+
+        self.assertEqual(self.UpdateLevels(DestPaths), [3, 3, 2, 1])
+        self.CompareLevels(self.BuildExpectedLevels('Expected'), DestPaths)
+
+
+class HistogramPartialsTest(unittest.TestCase):
+    '''The histogram of a set of tiles is the sum of the tile histograms over the range of the data, only changed tiles are read again'''
+
+    NumBins = 64
+    MinVal = 1000
+    MaxVal = 3000
+
+    def setUp(self):
+        self.OutputPath = tempfile.mkdtemp()
+        self.LevelPath = os.path.join(self.OutputPath, '001')
+        os.makedirs(self.LevelPath)
+        self.PartialsFullPath = os.path.join(self.OutputPath, 'HistogramTest' + nornir_buildmanager.operations.tile.HistogramPartialsExtension)
+
+        self.rng = np.random.RandomState(0)
+        self.TileFullPaths = []
+        for iTile in range(0, 6):
+            TileFullPath = os.path.join(self.LevelPath, '%03d.png' % iTile)
+            self.WriteTile(TileFullPath)
+            self.TileFullPaths.append(TileFullPath)
+
+    def tearDown(self):
+        shutil.rmtree(self.OutputPath)
+
+    def WriteTile(self, TileFullPath, MinVal=None, MaxVal=None):
+        '''Write a tile of random values that includes the minimum and maximum'''
+        if MinVal is None:
+            MinVal = self.MinVal
+        if MaxVal is None:
+            MaxVal = self.MaxVal
+
+        tile = self.rng.randint(MinVal, MaxVal + 1, (16, 24)).astype(np.uint16)
+        tile[0, 0] = MinVal
+        tile[0, 1] = MaxVal
+        Image.fromarray(tile).save(TileFullPath)
+
+        # Move the modification time forward in case the file system has coarse timestamps
+        stat = os.stat(TileFullPath)
+        os.utime(TileFullPath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def ExpectedBins(self, TileFullPaths, MinVal, MaxVal):
+        pixels = np.concatenate([np.asarray(Image.open(path)).ravel() for path in TileFullPaths])
+        return np.histogram(pixels, bins=self.NumBins, range=(MinVal, MaxVal))[0]
+
+    def Update(self, TileFullPaths):
+        return UpdateHistogramPartials(TileFullPaths, self.PartialsFullPath, self.NumBins, Pool=nornir_pools.GetGlobalSerialPool())
+
+    def runTest(self):
+        (Bins, MinVal, MaxVal, NumRead) = self.Update(self.TileFullPaths)
+        self.assertEqual(NumRead, len(self.TileFullPaths), "Each tile should be read once")
+        self.assertEqual((MinVal, MaxVal), (self.MinVal, self.MaxVal), "Histogram should span the values in the tiles")
+        self.assertTrue(np.array_equal(Bins, self.ExpectedBins(self.TileFullPaths, self.MinVal, self.MaxVal)))
+
+        (Bins, MinVal, MaxVal, NumRead) = self.Update(self.TileFullPaths)
+        self.assertEqual(NumRead, 0, "Unchanged tiles should not be read again")
+
+        # Replace one tile and prune another without changing the range
+        self.WriteTile(self.TileFullPaths[2])
+        Remaining = self.TileFullPaths[0:4] + self.TileFullPaths[5:]
+        (Bins, MinVal, MaxVal, NumRead) = self.Update(Remaining)
+        self.assertEqual(NumRead, 1)
+        self.assertTrue(np.array_equal(Bins, self.ExpectedBins(Remaining, self.MinVal, self.MaxVal)))
+
+        # A tile that extends the range changes the bins, only that tile is read
+        self.WriteTile(self.TileFullPaths[3], MaxVal=4000)
+        (Bins, MinVal, MaxVal, NumRead) = self.Update(Remaining)
+        self.assertEqual((MinVal, MaxVal), (self.MinVal, 4000))
+        self.assertEqual(NumRead, 1)
+        self.assertTrue(np.array_equal(Bins, self.ExpectedBins(Remaining, self.MinVal, 4000)))
+
+        # Pruning the tile with the largest value narrows the range without reading any tile
+        Remaining = [path for path in Remaining if path != self.TileFullPaths[3]]
+        (Bins, MinVal, MaxVal, NumRead) = self.Update(Remaining)
+        self.assertEqual((MinVal, MaxVal), (self.MinVal, self.MaxVal))
+        self.assertEqual(NumRead, 0)
+        self.assertTrue(np.array_equal(Bins, self.ExpectedBins(Remaining, self.MinVal, self.MaxVal)))
+
+
 class AutoLevelHistogramTest(PrepareSetup):
 
     @property
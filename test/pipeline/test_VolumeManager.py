@@ -6,11 +6,15 @@ Created on Feb 18, 2013
 import glob
 import logging
 import os
+import pickle
 import shutil
 import unittest
 
 from nornir_buildmanager.VolumeManagerETree import *
 import nornir_buildmanager.build
+import nornir_buildmanager.validationcache
+import nornir_buildmanager.volumedatacache
+import nornir_buildmanager.volumedatawriter
 import nornir_shared.files
 import nornir_shared.misc
 import test.testbase
@@ -104,6 +108,260 @@ class VolumeManagerFilterTest(VolumeManagerTestBase):
         nornir_buildmanager.build.Execute(buildArgs=[self.TestOutputPath, 'ListFilterContrast'])
         
 
+class VolumeDataCacheTest(VolumeManagerTestBase):
+
+    def runTest(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        section = SectionNode.Create(17)
+        [added_section, section] = block.UpdateOrAddChild(section)
+        self.VolumeObj.Save()
+
+        nornir_buildmanager.volumedatawriter.Flush()
+        nornir_buildmanager.volumedatacache.SaveAll()
+        cache_fullpath = os.path.join(self.VolumeFullPath, nornir_buildmanager.volumedatacache.VolumeDataCache.CacheFilename)
+        self.assertTrue(os.path.exists(cache_fullpath), "Saving the volume should populate the VolumeData cache")
+
+        # Load the cache from disk the same way a new process would
+        nornir_buildmanager.volumedatacache.Close(self.VolumeFullPath)
+        cache = nornir_buildmanager.volumedatacache.Open(self.VolumeFullPath)
+        self.assertGreater(len(cache), 0, "Cache should contain the saved VolumeData.xml files")
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        loaded_section = self.VolumeObj.find("Block/Section[@Number='17']")
+        self.assertIsNotNone(loaded_section, "Section should load from the VolumeData cache")
+        self.assertEqual(loaded_section.Number, 17)
+
+        # Change the section file behind the cache's back, the cached copy must not be used
+        section_xml_fullpath = os.path.join(loaded_section.FullPath, 'VolumeData.xml')
+        with open(section_xml_fullpath, 'r') as hFile:
+            section_xml = hFile.read()
+
+        with open(section_xml_fullpath, 'w') as hFile:
+            hFile.write(section_xml.replace('Name="0017"', 'Name="Edited"'))
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        loaded_section = self.VolumeObj.find("Block/Section[@Number='17']")
+        self.assertEqual(loaded_section.Name, "Edited", "Modified VolumeData.xml must be parsed again")
+
+
+class ValidationCacheTest(VolumeManagerTestBase):
+
+    def runTest(self):
+        DataFullPath = os.path.join(self.VolumeFullPath, 'Data.mosaic')
+        with open(DataFullPath, 'w') as hFile:
+            hFile.write('Original')
+
+        # Values for files modified moments ago are not stored
+        nornir_buildmanager.validationcache.Set(DataFullPath, 'Checksum', 'A')
+        self.assertIsNone(nornir_buildmanager.validationcache.Get(DataFullPath, 'Checksum'))
+
+        os.utime(DataFullPath, ns=(10 ** 9, 10 ** 9))
+        nornir_buildmanager.validationcache.Set(DataFullPath, 'Checksum', 'A')
+        self.assertEqual(nornir_buildmanager.validationcache.Get(DataFullPath, 'Checksum'), 'A')
+
+        # Load the cache from disk the same way a new process would
+        nornir_buildmanager.validationcache.Close(self.VolumeFullPath)
+        self.assertTrue(os.path.exists(os.path.join(self.VolumeFullPath, nornir_buildmanager.validationcache.ValidationCache.CacheFilename)))
+        nornir_buildmanager.validationcache.Open(self.VolumeFullPath)
+        self.assertEqual(nornir_buildmanager.validationcache.Get(DataFullPath, 'Checksum'), 'A')
+
+        with open(DataFullPath, 'w') as hFile:
+            hFile.write('Changed')
+
+        self.assertIsNone(nornir_buildmanager.validationcache.Get(DataFullPath, 'Checksum'), "Values for a changed file must not be used")
+
+
+class LinkedNodeCacheTest(VolumeManagerTestBase):
+
+    def runTest(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        for iSection in range(1, 21):
+            block.GetOrCreateSection(iSection)
+
+        self.VolumeObj.Save()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath, MaxLoadedNodes=5)
+        cache = self.VolumeObj._LinkedNodeCache
+
+        SectionNumbers = []
+        for section in self.VolumeObj.findall("Block/Section"):
+            SectionNumbers.append(section.Number)
+            cache.EnforceBudget([section])
+            self.assertLessEqual(len(cache), 5, "Linked nodes beyond the budget should be unloaded")
+
+            loaded_block = self.VolumeObj.find("Block")
+            self.assertTrue(any(child is section for child in loaded_block), "Node in use must not be unloaded")
+
+        self.assertEqual(sorted(SectionNumbers), list(range(1, 21)), "Every section should be found once while nodes are unloaded during the search")
+
+        # Unloaded sections are replaced by links and load again on demand
+        self.assertIsNotNone(self.VolumeObj.find("Block/Section_Link"))
+        section = self.VolumeObj.find("Block/Section[@Number='3']")
+        self.assertIsNotNone(section)
+        self.assertEqual(section.Number, 3)
+
+
+class VolumeManagerDirtyTrackingTest(VolumeManagerTestBase):
+
+    def _VolumeDataModifiedTimes(self):
+        nornir_buildmanager.volumedatawriter.Flush()
+        files = glob.glob(os.path.join(self.VolumeFullPath, '**', 'VolumeData.xml'), recursive=True)
+        return {f : os.stat(f).st_mtime_ns for f in files}
+
+    def _ChangedFiles(self, OriginalTimes):
+        return sorted([f for (f, mtime) in self._VolumeDataModifiedTimes().items() if OriginalTimes.get(f, None) != mtime])
+
+    def runTest(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        for iSection in range(1, 4):
+            (added_section, section) = block.GetOrCreateSection(iSection)
+            section.GetOrCreateChannel('TEM')
+
+        self.VolumeObj.Save()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        channels = list(self.VolumeObj.findall("Block/Section/Channel"))
+        self.assertEqual(len(channels), 3)
+        self.assertFalse(self.VolumeObj.IsDirty, "Loaded volume should not need to be saved")
+
+        OriginalTimes = self._VolumeDataModifiedTimes()
+        self.VolumeObj.Save()
+        self.assertEqual(self._ChangedFiles(OriginalTimes), [], "Saving an unchanged volume should not write any files")
+
+        # Changing a container's attributes rewrites its file and the parent file containing its link
+        section = self.VolumeObj.find("Block/Section[@Number='2']")
+        section.attrib['Test'] = 'Value'
+        self.assertTrue(section.IsDirty)
+        self.VolumeObj.Save()
+        self.assertEqual(self._ChangedFiles(OriginalTimes), sorted([os.path.join(section.FullPath, 'VolumeData.xml'),
+                                                                    os.path.join(section.Parent.FullPath, 'VolumeData.xml')]))
+        self.assertFalse(section.IsDirty)
+
+        # Adding a child only rewrites the parent and the new container
+        OriginalTimes = self._VolumeDataModifiedTimes()
+        (added_channel, channel) = section.GetOrCreateChannel('LM')
+        VolumeManager.Save(section)
+        self.assertEqual(self._ChangedFiles(OriginalTimes), sorted([os.path.join(section.FullPath, 'VolumeData.xml'),
+                                                                    os.path.join(channel.FullPath, 'VolumeData.xml')]))
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        section = self.VolumeObj.find("Block/Section[@Number='2']")
+        self.assertEqual(section.attrib['Test'], 'Value')
+        self.assertIsNotNone(section.find("Channel[@Name='LM']"))
+
+
+class VolumeManagerPickleTest(VolumeManagerTestBase):
+    '''Unpickled elements keep their attributes and still track attribute changes'''
+
+    def runTest(self):
+        block = BlockNode.Create("TEM")
+        (added_section, section) = block.GetOrCreateSection(4)
+
+        copied_block = pickle.loads(pickle.dumps(block))
+        copied_section = copied_block.find("Section[@Number='4']")
+        self.assertEqual(dict(copied_block.attrib), dict(block.attrib))
+        self.assertEqual(dict(copied_section.attrib), dict(section.attrib))
+
+        copied_section.__dict__['_Dirty'] = False
+        copied_section.attrib['Test'] = 'Value'
+        self.assertTrue(copied_section.IsDirty, "Attribute changes on an unpickled element should mark it dirty")
+
+
+class VolumeManagerChildIndexTest(VolumeManagerTestBase):
+
+    def _CheckSections(self, block, Numbers):
+        for iSection in Numbers:
+            section = block.GetSection(iSection)
+            self.assertIsNotNone(section, "Section %d not found" % iSection)
+            self.assertEqual(int(section.Number), iSection)
+            self.assertEqual(section, block.find("Section[@Number='%d']" % iSection), "Index and XPath lookup should return the same section")
+
+    def runTest(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        Numbers = list(range(1, 51))
+        for iSection in reversed(Numbers):
+            (added_section, section) = block.GetOrCreateSection(iSection)
+            self.assertTrue(added_section)
+
+        self._CheckSections(block, Numbers)
+        self.assertIsNone(block.GetSection(100))
+
+        # Adding a section that already exists returns the existing section
+        (added_section, section) = block.UpdateOrAddChildByAttrib(SectionNode.Create(7), 'Number')
+        self.assertFalse(added_section)
+        self.assertEqual(block.GetChildrenByAttrib('Section', 'Number', 7), [section])
+
+        # Sorting keeps the index
+        block.sort()
+        self._CheckSections(block, Numbers)
+
+        # Removing a section removes it from the index
+        block.remove(block.GetSection(10))
+        self.assertIsNone(block.GetSection(10))
+        Numbers.remove(10)
+
+        # Renumbering a section is visible to the next lookup
+        section = block.GetSection(20)
+        section.Number = 200
+        self.assertIsNone(block.GetSection(20))
+        self.assertEqual(block.GetSection(200), section)
+        section.Number = 20
+
+        (added_channel, channel) = block.GetSection(5).GetOrCreateChannel('TEM')
+        self.assertEqual(block.GetSection(5).GetChildByAttrib('Channel', 'Name', 'TEM'), channel)
+
+        self.VolumeObj.Save()
+
+        # Sections are links after loading, lookups must load them
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        block = self.VolumeObj.find("Block[@Name='TEM']")
+        self._CheckSections(block, Numbers)
+        self.assertIsNone(block.GetSection(10))
+        self.assertEqual(block.GetSection(5).GetChildByAttrib('Channel', 'Name', 'TEM').Name, 'TEM')
+
+        # Unloading a section back to a link keeps it findable
+        section = block.GetSection(30)
+        block.ReplaceChildWithLink(section)
+        self.assertIsNotNone(block.GetSection(30))
+        self.assertTrue(isinstance(block.GetSection(30), SectionNode))
+
+
+class VolumeDataWriterTest(VolumeManagerTestBase):
+
+    def runTest(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        section = SectionNode.Create(5)
+        [added_section, section] = block.UpdateOrAddChild(section)
+
+        # Repeated saves of the same node are merged into a single pending write
+        for iSave in range(0, 5):
+            section.attrib['SaveCount'] = str(iSave)
+            section.Save()
+
+        section_xml_fullpath = os.path.join(section.FullPath, 'VolumeData.xml')
+        loaded = nornir_buildmanager.volumedatawriter.Parse(section_xml_fullpath)
+        self.assertEqual(loaded.attrib['SaveCount'], '4', "Parse should return the latest queued contents")
+
+        nornir_buildmanager.volumedatawriter.Flush()
+        self.assertIsNone(nornir_buildmanager.volumedatawriter.GetPending(section_xml_fullpath), "Flush should write every queued file")
+        self.assertFalse(os.path.exists(section_xml_fullpath + '.tmp'), "Temporary files should be moved into place")
+
+        with open(section_xml_fullpath, 'rb') as hFile:
+            saved = ElementTree.fromstring(hFile.read())
+
+        self.assertEqual(saved.attrib['SaveCount'], '4')
+
+
 class VolumeManagerAppendTest(VolumeManagerTestBase):
 
     def runTest(self):
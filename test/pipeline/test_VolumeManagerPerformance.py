@@ -0,0 +1,193 @@
+'''
+Micro-benchmarks for wrapping elements, attribute access and find on XElementWrapper.
+
+The legacy classes below reproduce the class lookup and attribute dispatch
+used before the tag registry and per-class __setattr__ cache were added so
+both can be timed on the same synthetic tree.
+
+The benchmarks build trees of up to 100,000 elements, so they only run when
+the TESTBENCHMARKS environment variable is set.  Timings are written to the
+log.
+'''
+
+import logging
+import os
+import time
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+from nornir_buildmanager.VolumeManagerETree import *
+from nornir_buildmanager.VolumeManagerETree import _TrackedAttrib
+import nornir_shared.reflection as reflection
+
+
+class _LegacyAttributeAccess(object):
+    '''Attribute dispatch of XElementWrapper without the per-class cache'''
+
+    def __getattr__(self, name):
+        if name in self.__dict__:
+            return self.__dict__[name]
+
+        superClass = super(XElementWrapper, self)
+        if not superClass is None:
+            try:
+                if hasattr(superClass, '__getattr__'):
+                    return superClass.__getattr__(name)
+            except AttributeError:
+                pass
+
+        if(name in self.attrib):
+            return self.attrib[name]
+
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if(hasattr(self.__class__, name)):
+            attribute = getattr(self.__class__, name)
+            if isinstance(attribute, property):
+                if not attribute.fset is None:
+                    attribute.fset(self, value)
+                    return
+            else:
+                if name == 'attrib':
+                    value = _TrackedAttrib(self, value)
+
+                ElementTree.Element.__setattr__(self, name, value)
+
+                if name == 'attrib':
+                    self._OnAttribChanged()
+                elif name == 'text' or name == 'tail':
+                    self._MarkDirty()
+                return
+
+        if(name in self.__dict__):
+            self.__dict__[name] = value
+        elif(name[0] == '_'):
+            self.__dict__[name] = value
+        elif(self.attrib is not None):
+            if not isinstance(value, str):
+                if isinstance(value, float):
+                    self.attrib[name] = '%g' % value
+                else:
+                    self.attrib[name] = str(value)
+            else:
+                self.attrib[name] = value
+
+
+__LegacyClasses__ = {}
+
+
+def _LegacyWrapElement(e):
+    '''Wrap an element using a reflection lookup for every element, as WrapElement used to'''
+    OverrideClass = reflection.get_module_class('nornir_buildmanager.VolumeManagerETree', e.tag + 'Node', LogErrIfNotFound=False)
+    if OverrideClass is None:
+        if "Path" in e.attrib:
+            OverrideClass = XContainerElementWrapper
+        else:
+            OverrideClass = XElementWrapper
+
+    LegacyClass = __LegacyClasses__.get(OverrideClass, None)
+    if LegacyClass is None:
+        LegacyClass = type('Legacy' + OverrideClass.__name__, (_LegacyAttributeAccess, OverrideClass), {})
+        __LegacyClasses__[OverrideClass] = LegacyClass
+
+    return LegacyClass.wrap(e)
+
+
+def _CreateSyntheticTree(NumNodes):
+    '''Create a plain element tree similar to a loaded volume with NumNodes elements below the root'''
+    root = ElementTree.Element('Block', {'Name' : 'TEM', 'Path' : 'TEM'})
+    Tags = ['Section', 'Channel', 'Filter', 'Transform', 'Image', 'Comment']
+    for i in range(0, NumNodes):
+        tag = Tags[i % len(Tags)]
+        attrib = {'Name' : str(i), 'CreationDate' : '2014-01-01 00:00:00'}
+        if tag in ('Section', 'Channel', 'Filter'):
+            attrib['Path'] = '%04d' % i
+        if tag == 'Section':
+            attrib['Number'] = str(i)
+
+        ElementTree.SubElement(root, tag, attrib)
+
+    return root
+
+
+RunBenchmarks = unittest.skipUnless('TESTBENCHMARKS' in os.environ, "Set TESTBENCHMARKS to run benchmarks")
+
+
+@RunBenchmarks
+class XElementWrapperBenchmark(unittest.TestCase):
+
+    NumNodes = 100000
+
+    def _TimeWrap(self, root, WrapFunc):
+        start = time.perf_counter()
+        wrapped = [WrapFunc(e) for e in root]
+        return (time.perf_counter() - start, wrapped)
+
+    def _TimeAccess(self, nodes):
+        start = time.perf_counter()
+        for n in nodes:
+            n.CreationDate
+            n.Name = n.Name + 'x'
+            n.Custom = 'Value'
+            n._Scratch = 1
+        return time.perf_counter() - start
+
+    def runTest(self):
+        root = _CreateSyntheticTree(XElementWrapperBenchmark.NumNodes)
+
+        (legacy_wrap_time, legacy_nodes) = self._TimeWrap(root, _LegacyWrapElement)
+        (wrap_time, nodes) = self._TimeWrap(root, lambda e: VolumeManager.WrapElement(e)[1])
+
+        for (legacy, node) in zip(legacy_nodes, nodes):
+            self.assertTrue(isinstance(legacy, type(node)), "Registry must choose the same class as the reflection lookup")
+
+        legacy_access_time = self._TimeAccess(legacy_nodes)
+        access_time = self._TimeAccess(nodes)
+
+        for (legacy, node) in zip(legacy_nodes, nodes):
+            self.assertEqual(legacy.attrib['Name'], node.attrib['Name'])
+            self.assertEqual(node.attrib['Custom'], 'Value')
+            self.assertEqual(node._Scratch, 1)
+
+        logger = logging.getLogger(__name__)
+        logger.info("%d nodes, wrap legacy %.2fs cached %.2fs, access legacy %.2fs cached %.2fs" % (XElementWrapperBenchmark.NumNodes,
+                                                                                                    legacy_wrap_time, wrap_time,
+                                                                                                    legacy_access_time, access_time))
+
+
+@RunBenchmarks
+class XPathFindBenchmark(unittest.TestCase):
+    '''Compare find on a wrapped tree against ElementTree's generic XPath matcher'''
+
+    NumSections = 2000
+
+    def runTest(self):
+        root = _CreateSyntheticTree(XPathFindBenchmark.NumSections * 6)
+        block = VolumeManager.WrapElement(root)[1]
+        for i in range(0, len(block)):
+            block._ReplaceChildIfUnwrapped(block[i])
+
+        Numbers = [int(e.attrib['Number']) for e in block if 'Number' in e.attrib]
+        XPaths = ["Section[@Number='%d']" % n for n in Numbers]
+
+        start = time.perf_counter()
+        generic = [ElementTree.Element.find(block, xpath) for xpath in XPaths]
+        generic_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [block.find(xpath) for xpath in XPaths]
+        find_time = time.perf_counter() - start
+
+        for (g, f) in zip(generic, found):
+            self.assertTrue(g is f, "Indexed find must return the same element as ElementTree")
+
+        self.assertIsNone(block.find("Section[@Number='-1']"))
+        self.assertEqual(len(list(block.findall("Section[@Number='%d']" % Numbers[0]))), 1)
+
+        logging.getLogger(__name__).info("%d lookups, find generic %.2fs indexed %.2fs" % (len(XPaths), generic_time, find_time))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+Tests for the cached directory listings used to validate volume elements
+'''
+
+import glob
+import os
+import shutil
+import unittest
+
+import nornir_buildmanager.filesystemsnapshot as filesystemsnapshot
+import test.testbase
+
+
+class FileSystemSnapshotTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(FileSystemSnapshotTest, self).setUp()
+
+        self.DirFullPath = os.path.join(self.TestOutputPath, 'Level')
+        if os.path.exists(self.DirFullPath):
+            shutil.rmtree(self.DirFullPath)
+
+        os.makedirs(os.path.join(self.DirFullPath, 'Sub'))
+        for name in ['001.png', '002.png', '.hidden.png', 'Notes.txt']:
+            open(os.path.join(self.DirFullPath, name), 'w').close()
+
+        filesystemsnapshot.Invalidate()
+
+    def tearDown(self):
+        if os.path.exists(self.DirFullPath):
+            shutil.rmtree(self.DirFullPath)
+
+        filesystemsnapshot.Invalidate()
+
+    def testQueries(self):
+        self.assertEqual(filesystemsnapshot.Glob(self.DirFullPath, '*.png'), sorted(glob.glob(os.path.join(self.DirFullPath, '*.png'))))
+        self.assertEqual(filesystemsnapshot.ListDir(self.DirFullPath), sorted(os.listdir(self.DirFullPath)))
+        self.assertTrue(filesystemsnapshot.Exists(os.path.join(self.DirFullPath, '001.png')))
+        self.assertTrue(filesystemsnapshot.IsFile(os.path.join(self.DirFullPath, '001.png')))
+        self.assertTrue(filesystemsnapshot.IsDir(os.path.join(self.DirFullPath, 'Sub')))
+        self.assertFalse(filesystemsnapshot.Exists(os.path.join(self.DirFullPath, 'Missing.png')))
+        self.assertEqual(filesystemsnapshot.ListDir(os.path.join(self.DirFullPath, 'Missing')), [])
+
+    def testChanges(self):
+        '''Listings are read again after the directory changes'''
+        TileFullPath = os.path.join(self.DirFullPath, '003.png')
+        self.assertFalse(filesystemsnapshot.Exists(TileFullPath))
+
+        open(TileFullPath, 'w').close()
+        self.assertTrue(filesystemsnapshot.Exists(TileFullPath))
+
+        os.remove(TileFullPath)
+        self.assertFalse(filesystemsnapshot.Exists(TileFullPath))
+
+    def testUnchangedDirectoryIsNotListedAgain(self):
+        # Make the directory old enough that its listing can be trusted
+        os.utime(self.DirFullPath, ns=(0, 10 ** 9))
+
+        snapshot = filesystemsnapshot.GetSnapshot(self.DirFullPath)
+        self.assertIs(filesystemsnapshot.GetSnapshot(self.DirFullPath), snapshot)
+
+    def testRecentlyModifiedDirectoryIsNotListed(self):
+        '''Entries of a directory being written to are checked individually instead of listing the directory for each query'''
+        Scans = []
+        OriginalScan = filesystemsnapshot.DirectorySnapshot.Scan
+
+        def CountingScan(Path):
+            Scans.append(Path)
+            return OriginalScan(Path)
+
+        filesystemsnapshot.DirectorySnapshot.Scan = CountingScan
+        try:
+            for i in range(10):
+                open(os.path.join(self.DirFullPath, '%03d.tif' % i), 'w').close()
+                self.assertTrue(filesystemsnapshot.Exists(os.path.join(self.DirFullPath, '%03d.tif' % i)))
+                self.assertFalse(filesystemsnapshot.Exists(os.path.join(self.DirFullPath, 'Missing.tif')))
+        finally:
+            filesystemsnapshot.DirectorySnapshot.Scan = OriginalScan
+
+        self.assertEqual(len(Scans), 0)
+
+        # A listing taken while the directory is still changing is not kept
+        self.assertIsNot(filesystemsnapshot.GetSnapshot(self.DirFullPath), filesystemsnapshot.GetSnapshot(self.DirFullPath))
+
+    def testLookupUsesFileSystemCase(self):
+        snapshot = filesystemsnapshot.DirectorySnapshot.Scan(self.DirFullPath)
+        self.assertFalse(snapshot.Lookup('001.png'))
+        self.assertTrue(snapshot.Lookup('Sub'))
+        self.assertEqual(snapshot.Lookup('Notes.txt'), False)
+        self.assertEqual(snapshot.Lookup('notes.txt') is not None, os.path.normcase('Notes.txt') == os.path.normcase('notes.txt'))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
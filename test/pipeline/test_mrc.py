@@ -0,0 +1,145 @@
+'''
+Tests for reading tiles from SerialEM .mrc files
+'''
+
+import os
+import pickle
+import shutil
+import unittest
+
+import numpy
+
+from PIL import Image
+
+import nornir_buildmanager.importers.mrc as mrc
+import nornir_buildmanager.importers.shared as shared
+import test.testbase
+
+
+def LegacyAdjustContrast(tiles, min_max_gamma):
+    '''The float conversion MRCImport used before contrast was applied with a lookup table'''
+    dt = tiles.dtype
+    imgs = numpy.transpose(numpy.asarray(tiles), (0, 2, 1))
+
+    outliers = imgs > min_max_gamma.max
+    imgs = imgs.astype(numpy.float32)
+    imgs[outliers] = imgs[outliers] / 2.0
+    scale = numpy.iinfo(dt).max / min_max_gamma.max
+    if min_max_gamma.min > 0:
+        imgs = (imgs - min_max_gamma.min) * scale
+    else:
+        imgs = imgs * scale
+
+    return imgs.round().astype(dt)
+
+
+def WriteTileStack(OutputPath, tiles, HeaderLength=1024):
+    '''Write the tiles after a blank header the way an mrc file stores them'''
+    FullPath = os.path.join(OutputPath, 'Tiles.mrc')
+    with open(FullPath, 'wb') as hFile:
+        hFile.write(b'\0' * HeaderLength)
+        hFile.write(numpy.ascontiguousarray(tiles).tobytes())
+
+    return mrc.MRCTileStack(FullPath, offset=HeaderLength, dtype=tiles.dtype, shape=tiles.shape)
+
+
+class MRCTileStackTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(MRCTileStackTest, self).setUp()
+
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+        os.makedirs(self.TestOutputPath)
+
+    def tearDown(self):
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+    def testTilesAreMapped(self):
+        tiles = numpy.arange(3 * 4 * 5, dtype=numpy.uint16).reshape((3, 4, 5))
+        tile_stack = WriteTileStack(self.TestOutputPath, tiles)
+
+        self.assertTrue(isinstance(tile_stack.tiles, numpy.memmap))
+        for iTile in range(tiles.shape[0]):
+            self.assertTrue((tile_stack.get_tile_as_numpy(iTile) == tiles[iTile]).all())
+
+    def testPickleOnlyStoresLocation(self):
+        '''Tile stacks are passed to worker processes, which map the file themselves'''
+        tiles = numpy.arange(2 * 4 * 4, dtype=numpy.uint8).reshape((2, 4, 4))
+        tile_stack = WriteTileStack(self.TestOutputPath, tiles)
+        tile_stack.tiles
+
+        data = pickle.dumps(tile_stack)
+        self.assertLess(len(data), tiles.nbytes + 512)
+
+        copy = pickle.loads(data)
+        self.assertIsNone(copy._tiles)
+        self.assertTrue((copy.tiles == tiles).all())
+
+
+
+class MRCContrastTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(MRCContrastTest, self).setUp()
+
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+        os.makedirs(self.TestOutputPath)
+
+    def tearDown(self):
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+    def CheckMatchesLegacy(self, dtype, min_max_gamma_list):
+        dt_max = numpy.iinfo(dtype).max
+        # Every pixel value, arranged as two tiles
+        tiles = numpy.arange(dt_max + 1, dtype=numpy.int64).astype(dtype).reshape((2, 2, -1))
+
+        for min_max_gamma in min_max_gamma_list:
+            min_max_gamma = shared.MinMaxGamma(*min_max_gamma)
+            Expected = LegacyAdjustContrast(tiles, min_max_gamma)
+            for iTile in range(tiles.shape[0]):
+                Actual = mrc.MRCImport._AdjustContrast(tiles[iTile], min_max_gamma)
+                self.assertEqual(Actual.dtype, Expected.dtype)
+                self.assertTrue((Actual == Expected[iTile]).all(), "Lookup table does not match the float conversion for {0}".format(str(min_max_gamma)))
+
+    def testUInt8MatchesLegacy(self):
+        self.CheckMatchesLegacy(numpy.uint8, [(0, 255, 1.0), (10, 200, 1.0), (0, 100, 1.0)])
+
+    def testUInt16MatchesLegacy(self):
+        self.CheckMatchesLegacy(numpy.uint16, [(0, 65535, 1.0), (1000, 16383, 1.0), (0, 4095, 1.0)])
+
+    def testGamma(self):
+        '''Gamma other than 1.0 changes the mid-tones but not the end points of the range'''
+        tile = numpy.asarray([[0, 64], [128, 255]], dtype=numpy.uint8)
+        Linear = mrc.MRCImport._AdjustContrast(tile, shared.MinMaxGamma(0, 255, 1.0))
+        Bright = mrc.MRCImport._AdjustContrast(tile, shared.MinMaxGamma(0, 255, 2.0))
+
+        self.assertEqual(Bright[0, 0], 0)
+        self.assertEqual(Bright[1, 1], 255)
+        self.assertTrue((Bright[Linear > 0] >= Linear[Linear > 0]).all())
+        self.assertEqual(Bright[1, 0], round(((64 / 255.0) ** 0.5) * 255))
+
+    def test8BitTilesAreWrittenAs16BitPNG(self):
+        '''8-bit tiles keep the 16-bit PNG format earlier imports produced'''
+        tiles = numpy.arange(2 * 8 * 8, dtype=numpy.uint8).reshape((2, 8, 8))
+        tile_stack = WriteTileStack(self.TestOutputPath, tiles)
+        min_max_gamma = shared.MinMaxGamma(0, 127, 1.0)
+
+        self.assertEqual(mrc.MRCImport.ExportImageBatch(tile_stack, self.TestOutputPath, '.png', 0, 2, min_max_gamma), 2)
+
+        Expected = LegacyAdjustContrast(tiles, min_max_gamma)
+        for iTile in range(tiles.shape[0]):
+            filename = mrc.GetFileNameForTileNumber(iTile, '.png')
+            with Image.open(os.path.join(self.TestOutputPath, filename)) as im:
+                self.assertIn(im.mode, ('I', 'I;16'))
+                self.assertTrue((numpy.asarray(im) == Expected[iTile]).all())
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -3,10 +3,16 @@ Created on Jan 6, 2014
 
 @author: u0490822
 '''
+import multiprocessing
+import os
+import shutil
+import tempfile
 import unittest
 
 import nornir_buildmanager.argparsexml as argparsexml
 import nornir_buildmanager.pipelinemanager as pm
+import nornir_buildmanager.templates
+from nornir_buildmanager.VolumeManagerETree import BlockNode, VolumeManager
 import xml.etree.ElementTree as etree
 
 ArgumentXML = '<Arguments> \
@@ -105,6 +111,69 @@ class Test(unittest.TestCase):
         kwargs = argset.KeyWordArgs()
         print((repr(kwargs)))
 
+    def test_ParallelWorkerCount(self):
+        argset = pm.ArgumentSet()
+        argset.AddArguments({'debug' : False, 'Workers' : 3})
+
+        self.assertEqual(pm.PipelineManager._ParallelWorkerCount(LoadPipeline(PipelineNode), argset), 0)
+
+        node = LoadPipeline('<Iterate VariableName="ChannelNode" XPath="Channel" Parallel="true" MaxWorkers="#Workers"/>')
+        self.assertEqual(pm.PipelineManager._ParallelWorkerCount(node, argset), 3)
+
+        argset.Arguments['debug'] = True
+        self.assertEqual(pm.PipelineManager._ParallelWorkerCount(node, argset), 0, "Debug mode should not start worker processes")
+
+    def test_NodeLocator(self):
+        block = BlockNode.Create('TEM')
+        sections = [block.GetOrCreateSection(i)[1] for i in range(1, 4)]
+        (added, channel) = sections[1].GetOrCreateChannel('TEM')
+
+        locator = pm._NodeLocator(channel, block)
+        self.assertTrue(pm._FindByLocator(block, locator) is channel)
+        self.assertTrue(pm._FindByLocator(block, '') is block)
+
+        argset = pm.ArgumentSet()
+        argset.AddVariable('ChannelNode', channel)
+        argset.AddVariable('Value', 5)
+        (Arguments, Attribs, Parameters, Variables) = pm._ParallelIterateArguments(argset, block)
+        self.assertEqual(Variables['ChannelNode'], (True, locator))
+        self.assertEqual(Variables['Value'], (False, 5))
+
+    def test_ParallelIterateExecutor(self):
+        PreviousCPUCount = os.environ.get('PYTHON_CPU_COUNT', None)
+        with pm._ParallelIterateExecutor(2) as executor:
+            (InWorker, NumProcs) = executor.submit(_WorkerState).result()
+
+        self.assertTrue(InWorker)
+        self.assertEqual(NumProcs, max(1, multiprocessing.cpu_count() // 2), "Workers should divide the processors between them")
+        self.assertEqual(os.environ.get('PYTHON_CPU_COUNT', None), PreviousCPUCount)
+
+    def test_ReloadAfterStageFailureKeepsLoadedNodeBudget(self):
+        VolumePath = tempfile.mkdtemp()
+        try:
+            VolumeTree = VolumeManager.Load(VolumePath, Create=True, MaxLoadedNodes=7)
+
+            Pipeline = pm.PipelineManager(pipelinesRoot=None, pipelineData=etree.fromstring('<Pipeline Name="Test"/>'))
+            Pipeline.VolumeTree = VolumeTree
+
+            argset = pm.ArgumentSet()
+            argset.AddArguments({'debug' : False, 'verbose' : False})
+            CallNode = etree.fromstring('<PythonCall Module="test.pipeline.test_pipelinemanager" Function="_FailingStage"/>')
+            Pipeline.ProcessPythonCall(argset, VolumeTree, CallNode)
+
+            self.assertFalse(Pipeline.VolumeTree is VolumeTree, "The volume should be loaded again after a stage fails")
+            self.assertEqual(Pipeline.VolumeTree._GetLinkedNodeCache().MaxNodes, 7)
+        finally:
+            shutil.rmtree(VolumePath)
+
+
+def _FailingStage(**kwargs):
+    raise ValueError("Stage failure")
+
+
+def _WorkerState():
+    return (pm._InParallelIterateWorker, nornir_buildmanager.templates.Current.NumProcs)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,164 @@
+'''
+Tests for running several pipelines with the PipelineScheduler
+'''
+
+import argparse
+import os
+import shutil
+import unittest
+
+from nornir_buildmanager.VolumeManagerETree import *
+import nornir_buildmanager.pipelinescheduler as pipelinescheduler
+from nornir_buildmanager.pipeline_exceptions import PipelineError
+import test.testbase
+import xml.etree.ElementTree as etree
+
+
+PipelinesXML = '''<Pipelines>
+    <Pipeline Name="First">
+        <Arguments>
+            <Argument flag="-Label" dest="Label" default="A" help="Value recorded by the stage"/>
+        </Arguments>
+        <Iterate VariableName="SectionNode" XPath="Block/Section">
+            <PythonCall Module="test.pipeline.test_pipelinescheduler" Function="RecordStage" Stage="First" Label="#Label"/>
+        </Iterate>
+    </Pipeline>
+    <Pipeline Name="Second">
+        <Iterate VariableName="SectionNode" XPath="Block/Section">
+            <PythonCall Module="test.pipeline.test_pipelinescheduler" Function="RecordStage" Stage="Second" Label="B"/>
+        </Iterate>
+    </Pipeline>
+    <Pipeline Name="FailSection">
+        <Iterate VariableName="SectionNode" XPath="Block/Section">
+            <PythonCall Module="test.pipeline.test_pipelinescheduler" Function="FailOnSection" FailSection="2"/>
+        </Iterate>
+    </Pipeline>
+    <Pipeline Name="ChangeBlock">
+        <Arguments>
+            <Argument flag="-SaveBlock" dest="SaveBlock" default="False" help="Return the changed block from the stage"/>
+        </Arguments>
+        <Iterate VariableName="SectionNode" XPath="Block/Section">
+            <PythonCall Module="test.pipeline.test_pipelinescheduler" Function="ChangeBlock" SaveBlock="#SaveBlock"/>
+        </Iterate>
+    </Pipeline>
+    <Pipeline Name="BlockLevel">
+        <Select VariableName="BlockNode" XPath="Block"/>
+        <PythonCall Module="test.pipeline.test_pipelinescheduler" Function="RecordBlockStage"/>
+    </Pipeline>
+</Pipelines>'''
+
+# Order the stages were called in by the test pipelines
+StagesRun = []
+
+
+def RecordStage(SectionNode, Stage, Label, **kwargs):
+    StagesRun.append((Stage, int(SectionNode.Number)))
+    SectionNode.attrib[Stage] = Label
+    return SectionNode
+
+
+def FailOnSection(SectionNode, FailSection, **kwargs):
+    '''Stages are generators, so an exception raised while the pipeline manager saves the yielded nodes is not caught by the stage call'''
+    if int(SectionNode.Number) == int(FailSection):
+        raise ValueError("Section {0} failed".format(FailSection))
+
+    yield SectionNode
+
+
+def ChangeBlock(SectionNode, SaveBlock, **kwargs):
+    '''Changes the block, which a worker running the stage for one section cannot do'''
+    BlockNode = SectionNode.Parent
+    BlockNode.attrib['ChangedBySection' + str(SectionNode.Number)] = 'True'
+    return BlockNode if SaveBlock == 'True' else SectionNode
+
+
+def RecordBlockStage(BlockNode, **kwargs):
+    StagesRun.append(('BlockLevel', None))
+    BlockNode.attrib['BlockLevel'] = str(len(StagesRun))
+    return BlockNode
+
+
+class PipelineSchedulerTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(PipelineSchedulerTest, self).setUp()
+
+        self.VolumeFullPath = self.TestOutputPath
+        if os.path.exists(self.VolumeFullPath):
+            shutil.rmtree(self.VolumeFullPath)
+
+        VolumeObj = VolumeManager.Load(self.VolumeFullPath, Create=True)
+        (added, block) = VolumeObj.UpdateOrAddChild(BlockNode.Create('TEM'))
+        for iSection in range(1, 4):
+            block.GetOrCreateSection(iSection)
+
+        VolumeObj.Save()
+        del StagesRun[:]
+
+    def tearDown(self):
+        if os.path.exists(self.VolumeFullPath):
+            shutil.rmtree(self.VolumeFullPath)
+
+    def _CreateScheduler(self, PipelineNames, PipelineArgs=None, MaxWorkers=None):
+        args = argparse.Namespace(volumepath=self.VolumeFullPath, debug=False, verbose=False)
+        return pipelinescheduler.PipelineScheduler.Load(etree.ElementTree(etree.XML(PipelinesXML)), PipelineNames, args, PipelineArgs=PipelineArgs, MaxWorkers=MaxWorkers)
+
+    def testStages(self):
+        scheduler = self._CreateScheduler(['First', 'Second', 'BlockLevel', 'First'])
+        stages = [[p.Name for p in stage] for stage in scheduler.Stages()]
+        self.assertEqual(stages, [['First', 'Second'], ['BlockLevel'], ['First']])
+
+    def testExecute(self):
+        SectionNumbers = [int(section.Number) for section in VolumeManager.Load(self.VolumeFullPath).findall('Block/Section')]
+        self.assertEqual(len(SectionNumbers), 3)
+
+        scheduler = self._CreateScheduler(['First', 'Second', 'BlockLevel'], PipelineArgs=['-Label', 'X'])
+        scheduler.Execute()
+
+        # Each section runs both pipelines before the next section starts, the block pipeline waits for all sections
+        Expected = []
+        for iSection in SectionNumbers:
+            Expected.extend([('First', iSection), ('Second', iSection)])
+        Expected.append(('BlockLevel', None))
+
+        self.assertEqual(StagesRun, Expected)
+
+        VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        for section in VolumeObj.findall('Block/Section'):
+            self.assertEqual(section.attrib['First'], 'X', "Pipeline arguments should be parsed for each pipeline")
+            self.assertEqual(section.attrib['Second'], 'B')
+
+        self.assertEqual(VolumeObj.find('Block').attrib['BlockLevel'], '7')
+
+    def testExecuteInWorkers(self):
+        scheduler = self._CreateScheduler(['First', 'FailSection', 'Second'], PipelineArgs=['-Label', 'X'], MaxWorkers=2)
+        self.assertRaises(ValueError, scheduler.Execute)
+
+        # Sections the failure did not affect finish every pipeline, the failed section skips the pipelines after the failure
+        VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        for section in VolumeObj.findall('Block/Section'):
+            self.assertEqual(section.attrib['First'], 'X')
+            if int(section.Number) == 2:
+                self.assertFalse('Second' in section.attrib, "Pipelines after a failed task should not run")
+            else:
+                self.assertEqual(section.attrib['Second'], 'B', "Tasks for other sections should finish when one fails")
+
+    def testWorkerChangesOutsideMatch(self):
+        # A worker can neither save the block nor leave changes to it that would be lost.
+        # A PipelineError raised while a stage runs exits the pipeline.
+        for SaveBlock in ('True', 'False'):
+            scheduler = self._CreateScheduler(['ChangeBlock'], PipelineArgs=['-SaveBlock', SaveBlock], MaxWorkers=2)
+            self.assertRaises((PipelineError, SystemExit), scheduler.Execute)
+
+            BlockObj = VolumeManager.Load(self.VolumeFullPath).find('Block')
+            self.assertFalse([key for key in BlockObj.attrib if key.startswith('ChangedBySection')], "Workers should not change the block")
+
+        # Running in this process the stage may change the block
+        self._CreateScheduler(['ChangeBlock'], PipelineArgs=['-SaveBlock', 'True']).Execute()
+        BlockObj = VolumeManager.Load(self.VolumeFullPath).find('Block')
+        self.assertEqual(len([key for key in BlockObj.attrib if key.startswith('ChangedBySection')]), 3)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+Tests for the per stage timing records written by the pipeline manager
+'''
+
+import os
+import shutil
+import unittest
+
+from nornir_buildmanager.VolumeManagerETree import *
+import nornir_buildmanager.pipelinetimings as pipelinetimings
+import test.testbase
+
+
+class PipelineTimingsTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(PipelineTimingsTest, self).setUp()
+
+        self.VolumeFullPath = self.TestOutputPath
+        if os.path.exists(self.VolumeFullPath):
+            shutil.rmtree(self.VolumeFullPath)
+
+        os.makedirs(self.VolumeFullPath)
+
+    def tearDown(self):
+        if os.path.exists(self.VolumeFullPath):
+            shutil.rmtree(self.VolumeFullPath)
+
+    def testStageTimer(self):
+        block = BlockNode.Create('TEM')
+        (added, section) = block.GetOrCreateSection(7)
+
+        with pipelinetimings.StageTimer(self.VolumeFullPath, 'Test', 'module.Stage', section) as timer:
+            with open(os.path.join(self.VolumeFullPath, 'Data.bin'), 'wb') as hFile:
+                hFile.write(b'\0' * 65536)
+
+        try:
+            with pipelinetimings.StageTimer(self.VolumeFullPath, 'Test', 'module.Failed', block):
+                raise ValueError("Stage failure")
+        except ValueError:
+            pass
+
+        records = pipelinetimings.Read(self.VolumeFullPath)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0], timer.Record)
+        self.assertEqual(records[0]['Section'], 7)
+        self.assertEqual(records[0]['Pipeline'], 'Test')
+        self.assertTrue(records[0]['Succeeded'])
+        self.assertGreaterEqual(records[0]['WallTime'], 0)
+        if records[0]['BytesWritten'] is not None:
+            self.assertGreaterEqual(records[0]['BytesWritten'], 65536)
+
+        self.assertFalse(records[1]['Succeeded'])
+        self.assertIsNone(records[1]['Section'])
+
+    def testSummarize(self):
+        records = [{'Stage' : 'A', 'Section' : 1, 'WallTime' : 1.0, 'CPUTime' : 2.0, 'ProcessPeakRSS' : 10, 'PoolTasks' : 4},
+                   {'Stage' : 'A', 'Section' : 2, 'WallTime' : 3.0, 'CPUTime' : 1.0, 'ProcessPeakRSS' : 30, 'PoolTasks' : None},
+                   {'Stage' : 'A', 'Section' : 1, 'WallTime' : 0.5, 'CPUTime' : 0.5, 'ProcessPeakRSS' : None},
+                   {'Stage' : 'B', 'Section' : None, 'WallTime' : 10.0, 'CPUTime' : 1.0}]
+
+        summary = pipelinetimings.Summarize(records)
+        self.assertEqual([s['Stage'] for s in summary], ['B', 'A'])
+        self.assertEqual(summary[1]['Calls'], 3)
+        self.assertEqual(summary[1]['WallTime'], 4.5)
+        self.assertEqual(summary[1]['ProcessPeakRSS'], 30)
+        self.assertEqual(summary[1]['PoolTasks'], 4)
+        self.assertEqual(summary[1]['Sections'], [(3.0, 2), (1.5, 1)])
+        self.assertEqual(summary[0]['Sections'], [])
+
+    def testPoolTasksAdded(self):
+        start = {('Global', 1) : 5}
+        end = {('Global', 1) : 8, ('Tiles', 2) : 3}
+        self.assertEqual(pipelinetimings._PoolTasksAdded(start, end), 6, "Pools created during the call count from zero")
+        self.assertIsNone(pipelinetimings._PoolTasksAdded(None, end))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
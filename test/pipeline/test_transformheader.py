@@ -0,0 +1,67 @@
+'''
+Tests for reading transform file metadata without parsing the transforms
+'''
+
+import os
+import shutil
+import unittest
+
+import nornir_buildmanager.transformheader as transformheader
+import test.testbase
+
+
+class TransformHeaderTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(TransformHeaderTest, self).setUp()
+
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+        os.makedirs(self.TestOutputPath)
+
+    def tearDown(self):
+        if os.path.exists(self.TestOutputPath):
+            shutil.rmtree(self.TestOutputPath)
+
+    def _WriteMosaic(self, Filename, Lines):
+        FullPath = os.path.join(self.TestOutputPath, Filename)
+        with open(FullPath, 'w') as hFile:
+            hFile.write('\n'.join(Lines) + '\n')
+
+        return FullPath
+
+    def testMosaicHeader(self):
+        FullPath = self._WriteMosaic('Grid.mosaic', ['number_of_images: 2',
+                                                     'pixel_spacing: 1',
+                                                     'use_std_mask: 0',
+                                                     'format_version_number: 1',
+                                                     'image:',
+                                                     '0001.012.png',
+                                                     'GridTransform_double_2_2 vp 8 0 0 0 0 0 0 0 0 fp 7 0 1 1 1 0 0 0',
+                                                     'image:',
+                                                     '0001.013.png',
+                                                     'GridTransform_double_2_2 vp 8 0 0 0 0 0 0 0 0 fp 7 0 1 1 1 0 0 0'])
+
+        header = transformheader.Read(FullPath)
+        self.assertEqual(header.NumberOfImages, 2)
+        self.assertEqual(header.FirstImageName, '0001.012.png')
+
+    def testHeaderWithoutImageCount(self):
+        '''Images are counted if the header does not record the number of images'''
+        FullPath = self._WriteMosaic('Old.mosaic', ['format_version_number: 0',
+                                                    'image: 012.png GridTransform_double_2_2 vp 8 0 0 0 0 0 0 0 0',
+                                                    'image: 013.png GridTransform_double_2_2 vp 8 0 0 0 0 0 0 0 0',
+                                                    'image: 014.png GridTransform_double_2_2 vp 8 0 0 0 0 0 0 0 0'])
+
+        header = transformheader.Read(FullPath)
+        self.assertEqual(header.NumberOfImages, 3)
+        self.assertEqual(header.FirstImageName, '012.png')
+
+    def testMissingFile(self):
+        self.assertIsNone(transformheader.Read(os.path.join(self.TestOutputPath, 'Missing.mosaic')))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()